@@ -12,25 +12,43 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
+import collections
 import json
 import os
+import signal
+import sys
 
-from cloudant.client import Cloudant
 from dotenv import load_dotenv
-from slackclient import SlackClient
-from watson_developer_cloud import ConversationV1
-from watson_developer_cloud import DiscoveryV1
 
-from watsononlinestore.database.cloudant_online_store import \
-    CloudantOnlineStore
+from watsononlinestore import cassette
+from watsononlinestore import fair_scheduler
+from watsononlinestore import log_config
+from watsononlinestore import startup
+from watsononlinestore.database.throttle import CloudantThrottle
+from watsononlinestore.database.throttle import parse_budgets
+from watsononlinestore.inbound_queue import InboundQueue
+from watsononlinestore.slack_events import SlackEventsServer
+from watsononlinestore.slack_outbox import SlackOutbox
+from watsononlinestore.stats import STATS_INTERVAL
+from watsononlinestore.stats import StatsLogger
+from watsononlinestore.supervisor import DRAIN_TIMEOUT
+from watsononlinestore.supervisor import Supervisor
 from watsononlinestore.watson_online_store import WatsonOnlineStore
 
+# The SDKs (slackclient, watson_developer_cloud and cloudant, also used by
+# the Cloudant stores) and the optional product tables (NumPy) are slow to
+# import. They are imported when first used, and only if they are used,
+# timed in the startup report.
 
 MISSING_ENV_VARS = "ERROR: Required environment variables are not set."
 
 
 class WatsonEnv:
 
+    # CassetteWriter recording the services when RECORD_CASSETTE is set.
+    cassette_writer = None
+
     def __init__(self):
         pass
 
@@ -71,6 +89,7 @@ class WatsonEnv:
 
     @staticmethod
     def get_watson_online_store():
+        timer = startup.StartupTimer()
         load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
         # Use these env vars first if set
@@ -82,6 +101,9 @@ class WatsonEnv:
         cloudant_password = os.environ.get("CLOUDANT_PASSWORD")
         cloudant_url = os.environ.get("CLOUDANT_URL")
         cloudant_db_name = os.environ.get("CLOUDANT_DB_NAME")
+        # "sqlite" keeps customers in a local file instead of Cloudant.
+        store_backend = os.environ.get('STORE_BACKEND', 'cloudant')
+        sqlite_path = os.environ.get('SQLITE_PATH', 'watsononlinestore.db')
 
         # TODO: It looks like we'll want to make discovery required too.
         discovery_username = os.environ.get('DISCOVERY_USERNAME')
@@ -125,62 +147,317 @@ class WatsonEnv:
                     discovery_password or discovery_creds['password']
 
         # If we still don't have all the above plus a few, then no WOS.
-        if not all((slack_bot_token,
+        required = [slack_bot_token,
                     conversation_username,
-                    conversation_password,
-                    cloudant_username,
-                    cloudant_password,
-                    cloudant_url,
-                    cloudant_db_name)):
+                    conversation_password]
+        if store_backend == 'cloudant':
+            required += [cloudant_username,
+                         cloudant_password,
+                         cloudant_url,
+                         cloudant_db_name]
+        if not all(required):
             print(MISSING_ENV_VARS)
             return None
 
         if 'placeholder' in slack_bot_token:
             raise Exception("SLACK_BOT_TOKEN needs to be set correctly. "
                             "It is currently set to 'placeholder'.")
+        # Init Watson Discovery only if all the env vars are set.
+        use_discovery = all((discovery_username,
+                             discovery_password,
+                             discovery_environment_id,
+                             discovery_collection_id or
+                             os.environ.get('DISCOVERY_SOURCES')))
+        timer.lap('env')
+
+        from slackclient import SlackClient
+        from watson_developer_cloud import ConversationV1
+        if use_discovery:
+            from watson_developer_cloud import DiscoveryV1
+        if store_backend == 'sqlite':
+            from watsononlinestore.database.sqlite_online_store import \
+                SQLiteOnlineStore
+        else:
+            from cloudant.client import Cloudant
+            from watsononlinestore.database.cloudant_online_store import \
+                CloudantOnlineStore
+            from watsononlinestore.database.cloudant_session_store import \
+                CloudantSessionStore
+            from watsononlinestore.database.customer_cache import \
+                CACHE_TTL
+            from watsononlinestore.database.customer_cache import \
+                ChangesFollower
+            from watsononlinestore.database.customer_cache import \
+                CustomerCache
+        timer.lap('import')
+
         slack_client = SlackClient(slack_bot_token)
-        # If BOT_ID wasn't set, we can get it using SlackClient and user ID.
-        if not bot_id:
-            bot_id = WatsonEnv.get_slack_user_id(slack_client)
-            if not bot_id:
-                print("Error: Missing BOT_ID or invalid SLACK_BOT_USER.")
-                return None
+
+        # Optionally record the traffic of every service to a cassette
+        # that tools/replay_cassette.py can replay offline.
+        writer = None
+        if os.environ.get('RECORD_CASSETTE'):
+            writer = cassette.CassetteWriter(os.environ['RECORD_CASSETTE'])
+            atexit.register(writer.close)
+            WatsonEnv.cassette_writer = writer
+            # The bot ID lookup below stays off the cassette.
+            recorded_slack_client = cassette.Recorder(
+                slack_client, cassette.SLACK, writer)
 
         conversation_client = ConversationV1(
             username=conversation_username,
             password=conversation_password,
             version='2016-07-11')
+        if writer:
+            conversation_client = cassette.Recorder(
+                conversation_client, cassette.CONVERSATION, writer)
 
-        cloudant_online_store = CloudantOnlineStore(
-            Cloudant(
+        session_store = None
+        cloudant_throttle = None
+        customer_cache = None
+        if store_backend == 'sqlite':
+            online_store = SQLiteOnlineStore(sqlite_path)
+        else:
+            # Connected by the store's init() among the startup probes.
+            cloudant_client = Cloudant(
                 cloudant_username,
                 cloudant_password,
-                url=cloudant_url,
-                connect=True
-            ),
-            cloudant_db_name
-        )
-        #
-        # Init Watson Discovery only if all the env vars are set.
-        #
+                url=cloudant_url
+            )
+            # Requests per second allowed by the Cloudant plan, by class.
+            cloudant_throttle = CloudantThrottle(
+                parse_budgets(os.environ.get('CLOUDANT_BUDGETS')))
+            # Optionally keep each customer's docs in their own partition.
+            cloudant_partitioned = os.environ.get(
+                'CLOUDANT_PARTITIONED', 'false').lower() == 'true'
+            # Optionally cache customer docs, refreshed from the _changes feed
+            # so that writes from other instances are seen within a second.
+            if os.environ.get('CUSTOMER_CACHE', 'false').lower() == 'true':
+                customer_cache = CustomerCache(ttl=float(os.environ.get(
+                    'CUSTOMER_CACHE_TTL', CACHE_TTL)))
+                ChangesFollower(
+                    Cloudant(cloudant_username,
+                             cloudant_password,
+                             url=cloudant_url),
+                    cloudant_db_name,
+                    customer_cache
+                ).start()
+
+            online_store = CloudantOnlineStore(
+                cloudant_client,
+                cloudant_db_name,
+                partitioned=cloudant_partitioned,
+                cache=customer_cache,
+                cloudant_throttle=cloudant_throttle)
+
+            # Keep sessions in Cloudant to share them between instances.
+            if os.environ.get('SESSION_STORE', 'memory') == 'cloudant':
+                session_store = CloudantSessionStore(
+                    cloudant_client,
+                    cloudant_db_name,
+                    partitioned=cloudant_partitioned,
+                    cloudant_throttle=cloudant_throttle)
+        # Optionally buffer cart updates and write them in the background.
+        if os.environ.get('CART_WRITE_BEHIND', 'false').lower() == 'true':
+            online_store.enable_write_behind(
+                flush_interval=float(
+                    os.environ.get('CART_FLUSH_INTERVAL', 0.5)),
+                journal_path=os.environ.get('CART_JOURNAL'))
+        if writer:
+            online_store = cassette.Recorder(online_store, cassette.STORE,
+                                             writer)
+
         discovery_client = None
-        if all((discovery_username,
-                discovery_password,
-                discovery_environment_id,
-                discovery_collection_id)):
+        if use_discovery:
             discovery_client = DiscoveryV1(
                 version='2016-11-07',
                 username=discovery_username,
                 password=discovery_password)
-        watsononlinestore = WatsonOnlineStore(bot_id,
-                                              slack_client,
-                                              conversation_client,
-                                              discovery_client,
-                                              cloudant_online_store)
+            if writer:
+                discovery_client = cassette.Recorder(
+                    discovery_client, cassette.DISCOVERY, writer)
+        timer.lap('clients')
+
+        # The network calls needed before the first answer don't depend on
+        # each other, so they are made concurrently.
+        probes = collections.OrderedDict()
+        if not bot_id:
+            # If BOT_ID wasn't set, get it using SlackClient and user ID.
+            probes['bot_id'] = lambda: WatsonEnv.get_slack_user_id(
+                slack_client)
+        probes['workspace'] = lambda: \
+            WatsonOnlineStore.setup_conversation_workspace(
+                conversation_client, os.environ)
+        # make sure DB exists
+        probes['store'] = online_store.init
+        results = startup.run_probes(timer, probes)
+        timer.lap('probes')
+        bot_id = bot_id or results.get('bot_id')
+        if not bot_id:
+            print("Error: Missing BOT_ID or invalid SLACK_BOT_USER.")
+            return None
+
+        if writer:
+            writer.write_info(bot_id=bot_id, environ=dict(
+                (name, os.environ[name])
+                for name in cassette.REPLAY_ENVIRON if name in os.environ))
+            slack_client = recorded_slack_client
+
+        # Queue outgoing messages to stay within Slack's rate limits.
+        slack_outbox = None
+        if os.environ.get('SLACK_OUTBOX', 'true').lower() == 'true':
+            slack_outbox = SlackOutbox(slack_client)
+
+        # Optional "similar products" table, see
+        # tools/build_similar_products.py. Needs NumPy.
+        similar = None
+        if os.environ.get('SIMILAR_PRODUCTS'):
+            from watsononlinestore.similar_products import SimilarProducts
+            try:
+                similar = SimilarProducts(os.environ['SIMILAR_PRODUCTS'])
+            except Exception as e:
+                print("Similar products are disabled: %s" % e)
+
+        # Optional category index for browse queries, see
+        # tools/build_category_index.py.
+        categories = None
+        if os.environ.get('CATEGORY_INDEX'):
+            from watsononlinestore.category_index import CategoryIndex
+            try:
+                categories = CategoryIndex(os.environ['CATEGORY_INDEX'])
+            except Exception as e:
+                print("Category index is disabled: %s" % e)
+
+        watsononlinestore = WatsonOnlineStore(
+            bot_id,
+            slack_client,
+            conversation_client,
+            discovery_client,
+            online_store,
+            session_store=session_store,
+            slack_outbox=slack_outbox,
+            similar_products=similar,
+            category_index=categories,
+            workspace_id=results['workspace'])
+        watsononlinestore.store_ready = True
+        # Optionally take turns fairly between users, see fair_scheduler.
+        if os.environ.get('FAIR_SCHEDULING', 'false').lower() == 'true':
+            watsononlinestore.enable_fair_scheduling(
+                rate=float(os.environ.get('USER_RATE',
+                                          fair_scheduler.USER_RATE)),
+                burst=float(os.environ.get('USER_BURST',
+                                           fair_scheduler.USER_BURST)),
+                user_queue_size=int(os.environ.get(
+                    'USER_QUEUE_SIZE', fair_scheduler.USER_QUEUE_SIZE)))
+        # Keep messages on disk until answered, see inbound_queue.
+        if os.environ.get('INBOUND_QUEUE'):
+            watsononlinestore.enable_inbound_queue(
+                InboundQueue(os.environ['INBOUND_QUEUE']))
+        # Log the counters of the components every STATS_INTERVAL seconds.
+        stats_interval = float(os.environ.get('STATS_INTERVAL',
+                                              STATS_INTERVAL))
+        if stats_interval > 0:
+            stats_logger = StatsLogger(stats_interval)
+            if cloudant_throttle is not None:
+                stats_logger.add('cloudant_throttle',
+                                 cloudant_throttle.metrics)
+            if customer_cache is not None:
+                stats_logger.add('customer_cache', customer_cache.metrics)
+            if slack_outbox is not None:
+                stats_logger.add('slack_outbox', slack_outbox.metrics)
+            stats_logger.add('discovery_flight',
+                             WatsonOnlineStore.discovery_flight.metrics)
+            stats_logger.start()
+            atexit.register(stats_logger.stop)
+        timer.lap('bot')
+        print("Startup timing: %s" % timer.report())
         return watsononlinestore
 
 
+def run_supervised(workers, slack_signing_secret, inbound_path=None):
+    """Run turns in worker processes, until SIGTERM drains them.
+
+    :param int workers: worker processes
+    :param str slack_signing_secret: Events API mode when set, else RTM
+    :param str inbound_path: inbound queue kept by the supervisor
+    """
+    # Only events for the bot are stored and routed.
+    bot_id = os.environ.get('BOT_ID')
+    if not bot_id:
+        from slackclient import SlackClient
+        bot_id = WatsonEnv.get_slack_user_id(
+            SlackClient(os.environ.get('SLACK_BOT_TOKEN')))
+        if not bot_id:
+            print("Error: Missing BOT_ID or invalid SLACK_BOT_USER.")
+            sys.exit(1)
+        # So that the workers don't look it up again.
+        os.environ['BOT_ID'] = bot_id
+    inbound_queue = None
+    if inbound_path:
+        inbound_queue = InboundQueue(inbound_path)
+    supervisor = Supervisor(WatsonEnv.get_watson_online_store, bot_id,
+                            workers, inbound_queue=inbound_queue)
+    supervisor.start()
+
+    def drain(signum, frame):
+        print("Draining workers...")
+        supervisor.drain(float(os.environ.get('DRAIN_TIMEOUT',
+                                              DRAIN_TIMEOUT)))
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, drain)
+
+    if slack_signing_secret:
+        SlackEventsServer(
+            supervisor,
+            slack_signing_secret,
+            port=int(os.environ.get('PORT', 3000)),
+            workers=int(os.environ.get('SLACK_EVENTS_WORKERS', 1))
+        ).serve_forever()
+    else:
+        from slackclient import SlackClient
+        supervisor.run_rtm(SlackClient(os.environ.get('SLACK_BOT_TOKEN')))
+
+
 if __name__ == "__main__":
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    # Log through a background writer, see LOG_* in env.sample.
+    atexit.register(log_config.configure(os.environ).stop)
+
+    # With a signing secret, receive Slack events over HTTP instead of RTM
+    # so that several instances can run behind a load balancer.
+    slack_signing_secret = os.environ.get('SLACK_SIGNING_SECRET')
+
+    # Optionally use more cores with worker processes, see supervisor.
+    workers = int(os.environ.get('WORKERS', 1))
+    if workers > 1 and os.environ.get('RECORD_CASSETTE'):
+        print("RECORD_CASSETTE records a single process, ignoring WORKERS.")
+        workers = 1
+    if workers > 1:
+        # The supervisor keeps the inbound queue, not the workers, which
+        # would each replay the messages of all the others.
+        run_supervised(workers, slack_signing_secret,
+                       os.environ.pop('INBOUND_QUEUE', None))
+        sys.exit(0)
+
     watsononlinestore = WatsonEnv.get_watson_online_store()
+    if watsononlinestore is None:
+        # The reason was printed while setting up.
+        sys.exit(1)
+
+    # kill -USR2 <pid> switches turn profiling on or off, see PROFILE_*.
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, watsononlinestore.profiler.toggle)
 
-    watsononlinestore.run()
+    if slack_signing_secret:
+        if WatsonEnv.cassette_writer:
+            # Record the inbound event batches too.
+            watsononlinestore = cassette.Recorder(
+                watsononlinestore, cassette.BOT, WatsonEnv.cassette_writer)
+        SlackEventsServer(
+            watsononlinestore,
+            slack_signing_secret,
+            port=int(os.environ.get('PORT', 3000)),
+            workers=int(os.environ.get('SLACK_EVENTS_WORKERS', 1))
+        ).serve_forever()
+    else:
+        watsononlinestore.run()
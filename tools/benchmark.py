@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Run the micro-benchmarks of watsononlinestore/tests/benchmarks.py and
+# compare them with the stored baseline. Exits with status 1 when a
+# benchmark is slower than its baseline by more than the threshold.
+#
+# Usage:
+#   python tools/benchmark.py [--threshold 0.25] [--json] [name ...]
+#   python tools/benchmark.py --save [name ...]   # update the baseline
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore.tests import benchmarks  # noqa
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run (default: all of %s)' %
+                             ', '.join(benchmarks.BENCHMARKS))
+    parser.add_argument('--threshold', type=float,
+                        default=benchmarks.REGRESSION_THRESHOLD,
+                        help='fraction slower than the baseline that fails')
+    parser.add_argument('--baseline', default=benchmarks.BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--json', action='store_true',
+                        help='print the comparison as JSON')
+    args = parser.parse_args()
+
+    # Only warnings are logged, so that log output doesn't end up in the
+    # timings, whatever LOG_LEVEL the bot runs with.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = benchmarks.run(args.names or None)
+    baseline = benchmarks.load_baseline(args.baseline)
+    if args.save:
+        baseline.update(results)
+        benchmarks.save_baseline(baseline, args.baseline)
+        print("Saved %d results to %s" % (len(results), args.baseline))
+        sys.exit(0)
+
+    comparison = benchmarks.compare(results, baseline, args.threshold)
+    if args.json:
+        json.dump(comparison, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print("%-40s %12s %12s %8s" % (
+            'benchmark', 'usec/call', 'baseline', 'ratio'))
+        for name, row in comparison.items():
+            base = ratio = '-'
+            if row['baseline'] is not None:
+                base = '%.2f' % (row['baseline'] * 1e6)
+                ratio = '%.2f' % row['ratio']
+            print("%-40s %12.2f %12s %8s%s" % (
+                name, row['seconds'] * 1e6, base, ratio,
+                '  REGRESSED' if row['regressed'] else ''))
+    if any(row['regressed'] for row in comparison.values()):
+        sys.exit(1)
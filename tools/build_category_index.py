@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Build the category index for browse queries from the bundled product
+# HTML. Run it whenever the HTML loaded into Discovery changes.
+#
+# Usage:
+#   python tools/build_category_index.py [path]
+#
+# Writes the index to path (default data/category_index.json). Set
+# CATEGORY_INDEX=<path> to use it in the bot.
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore import category_index  # noqa
+from watsononlinestore import similar_products  # noqa
+
+logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+CORPORA = (('ibm_store_html', 'ibm_store'),
+           ('amazon_data_html', 'amazon'))
+
+if __name__ == "__main__":
+    path = os.path.join(DATA_DIR, 'category_index.json')
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+
+    corpora = [(data_source, similar_products.load_products(
+                    os.path.join(DATA_DIR, directory), data_source))
+               for directory, data_source in CORPORA]
+    counts = category_index.build(corpora, path)
+    print("Wrote %s with %s categories." % (path, counts))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Build the "similar products" table from the bundled product HTML.
+# Requires NumPy.
+#
+# Usage:
+#   python tools/build_similar_products.py [prefix] [k]
+#
+# Writes <prefix>.json, <prefix>.neighbors.npy and <prefix>.scores.npy
+# (default prefix data/similar_products). Set SIMILAR_PRODUCTS=<prefix>
+# to use the table in the bot.
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore import similar_products  # noqa
+
+logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+CORPORA = (('ibm_store_html', 'ibm_store'),
+           ('amazon_data_html', 'amazon'))
+
+if __name__ == "__main__":
+    prefix = os.path.join(DATA_DIR, 'similar_products')
+    if len(sys.argv) > 1:
+        prefix = sys.argv[1]
+    k = similar_products.TOP_K
+    if len(sys.argv) > 2:
+        k = int(sys.argv[2])
+
+    products = []
+    for directory, data_source in CORPORA:
+        products += similar_products.load_products(
+            os.path.join(DATA_DIR, directory), data_source)
+    similar_products.build(products, prefix, k=k)
+    print("Wrote the %d nearest neighbors of %d products to %s.*" %
+          (k, len(products), prefix))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Back up, migrate or seed the customers of the watson-online-store
+# database as NDJSON (one JSON doc per line).
+#
+# Usage:
+#   python tools/bulk_customers.py export <file or ->
+#   python tools/bulk_customers.py import <file or -> [concurrency]
+#
+# Uses the CLOUDANT_* settings from the environment (or .env), including
+# CLOUDANT_PARTITIONED and CLOUDANT_BUDGETS.
+
+import logging
+import os
+import sys
+
+from cloudant.client import Cloudant
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore.database import bulk  # noqa
+from watsononlinestore.database.cloudant_online_store import \
+    CloudantOnlineStore  # noqa
+from watsononlinestore.database.throttle import CloudantThrottle  # noqa
+from watsononlinestore.database.throttle import parse_budgets  # noqa
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'import'):
+        print("usage: bulk_customers.py export|import <file or -> "
+              "[concurrency]")
+        sys.exit(1)
+    load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+    client = Cloudant(os.environ.get('CLOUDANT_USERNAME'),
+                      os.environ.get('CLOUDANT_PASSWORD'),
+                      url=os.environ.get('CLOUDANT_URL'))
+    store = CloudantOnlineStore(
+        client,
+        os.environ.get('CLOUDANT_DB_NAME'),
+        partitioned=os.environ.get(
+            'CLOUDANT_PARTITIONED', 'false').lower() == 'true',
+        cloudant_throttle=CloudantThrottle(
+            parse_budgets(os.environ.get('CLOUDANT_BUDGETS'))))
+    path = sys.argv[2]
+
+    if sys.argv[1] == 'export':
+        out = sys.stdout if path == '-' else open(path, 'w')
+        try:
+            count = bulk.export_customers(store, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write("Exported %d customers.\n" % count)
+    else:
+        store.init()
+        concurrency = bulk.IMPORT_CONCURRENCY
+        if len(sys.argv) > 3:
+            concurrency = int(sys.argv[3])
+        lines = sys.stdin if path == '-' else open(path)
+        try:
+            counts = bulk.import_customers(store, lines,
+                                           concurrency=concurrency)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        print("Imported %(imported)d customers, skipped %(skipped)d lines, "
+              "%(conflicts)d already existed, %(failed)d failed." % counts)
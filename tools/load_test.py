@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Measure how many turns per second the bot sustains, with fake Slack,
+# Conversation, Discovery and Cloudant backends. Prints a JSON report of
+# throughput and p50/p95/p99 turn latency per scenario.
+#
+# Usage:
+#   python tools/load_test.py [--users 20] [--iterations 5] [--bots 4]
+#       [--scenario shopper --scenario browser] [--data-source amazon]
+#       [--latency conversation=0.05,discovery=0.2~0.05,cloudant=0.01]
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore.tests import loadgen  # noqa
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=20,
+                        help='virtual users per scenario')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='times each user runs its scenario')
+    parser.add_argument('--bots', type=int, default=4,
+                        help='bot instances taking turns concurrently')
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(loadgen.SCENARIOS),
+                        help='scenario to run, repeatable (default: all)')
+    parser.add_argument('--data-source', default='amazon',
+                        choices=sorted(loadgen.HTML_DIRS))
+    parser.add_argument('--latency', default='',
+                        help='backend=seconds[~jitter],... for backends '
+                             + ', '.join(loadgen.BACKENDS))
+    args = parser.parse_args()
+
+    # The bot logs every turn at DEBUG, which would dominate the timings.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    load_test = loadgen.LoadTest(loadgen.parse_latencies(args.latency),
+                                 data_source=args.data_source,
+                                 bots=args.bots)
+    report = load_test.run(args.scenario or sorted(loadgen.SCENARIOS),
+                           args.users, args.iterations)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
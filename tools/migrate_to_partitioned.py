@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Copy the watson-online-store database into a new partitioned database.
+#
+# Usage:
+#   python tools/migrate_to_partitioned.py <target db name> [batch size]
+#
+# Uses the CLOUDANT_* settings from the environment (or .env). When done,
+# set CLOUDANT_DB_NAME to the target and CLOUDANT_PARTITIONED=true.
+
+import logging
+import os
+import sys
+
+from cloudant.client import Cloudant
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore.database import partitioning  # noqa
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: migrate_to_partitioned.py <target db name> "
+              "[batch size]")
+        sys.exit(1)
+    load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+    client = Cloudant(os.environ.get('CLOUDANT_USERNAME'),
+                      os.environ.get('CLOUDANT_PASSWORD'),
+                      url=os.environ.get('CLOUDANT_URL'))
+    batch_size = partitioning.MIGRATION_BATCH_SIZE
+    if len(sys.argv) > 2:
+        batch_size = int(sys.argv[2])
+
+    counts = partitioning.migrate_to_partitioned(
+        client, os.environ.get('CLOUDANT_DB_NAME'), sys.argv[1],
+        batch_size=batch_size)
+    print("Copied %(copied)d docs, skipped %(skipped)d, "
+          "%(conflicts)d already existed." % counts)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Replay a cassette recorded with RECORD_CASSETTE=<file> through the bot,
+# offline. The recorded Slack event batches are handled one turn at a
+# time, with every service answered from the cassette. Prints a JSON
+# report of the turns, their latency and how the calls were matched.
+#
+# Usage:
+#   python tools/replay_cassette.py <cassette> [--latency-scale 1.0]
+#       [--strict]
+#
+# --latency-scale 0 replays without the recorded service latency, to
+# measure the bot's own processing.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from watsononlinestore import cassette  # noqa
+from watsononlinestore.tests import loadgen  # noqa
+from watsononlinestore.watson_online_store import WatsonOnlineStore  # noqa
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cassette')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='replayed seconds per recorded second')
+    parser.add_argument('--strict', action='store_true',
+                        help='only answer calls with recorded arguments')
+    args = parser.parse_args()
+
+    # The bot logs every turn at DEBUG, which would dominate the timings.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    replayer = cassette.Replayer.load(args.cassette,
+                                      latency_scale=args.latency_scale,
+                                      strict=args.strict)
+    info = replayer.info()
+    os.environ.update(info.get('environ', {}))
+    discovery_client = None
+    if replayer.recorded(cassette.DISCOVERY):
+        discovery_client = replayer.client(cassette.DISCOVERY)
+    bot = WatsonOnlineStore(info.get('bot_id', 'UREPLAY'),
+                            replayer.client(cassette.SLACK),
+                            replayer.client(cassette.CONVERSATION),
+                            discovery_client,
+                            replayer.client(cassette.STORE))
+
+    latencies = []
+    errors = 0
+    start = time.time()
+    for batch in replayer.event_batches():
+        turn_start = time.time()
+        try:
+            bot.handle_slack_output(batch)
+        except Exception:
+            logging.exception("Replayed turn failed:")
+            errors += 1
+        latencies.append(time.time() - turn_start)
+    duration = time.time() - start
+
+    latencies.sort()
+    report = {
+        'turns': len(latencies),
+        'errors': errors,
+        'duration': round(duration, 4),
+        'turns_per_second': round(
+            len(latencies) / duration if duration else 0.0, 2),
+        'latency': dict(('p%d' % p, round(loadgen.percentile(latencies, p),
+                                          4))
+                        for p in loadgen.PERCENTILES),
+        'calls': dict(replayer.counters),
+    }
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
@@ -0,0 +1,361 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Record and replay the traffic of the bot's external services.
+
+A Recorder wraps a client (Conversation, Discovery, Slack, the online
+store) and writes every call, with its arguments, its response or error
+and how long it took, to a cassette: gzip compressed JSON lines.
+
+A Replayer reads a cassette and serves replay clients standing in for
+the recorded ones. Each call gets the recorded response of the same
+call, sleeping for the recorded latency times a scale factor (0 for no
+latency). Inbound Slack event batches can be replayed through the bot
+with tools/replay_cassette.py, making captured sessions repeatable
+offline benchmarks.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Services of a bot, by the names recorders are given in run.py.
+CONVERSATION = 'conversation'
+DISCOVERY = 'discovery'
+SLACK = 'slack'
+STORE = 'store'
+# The bot itself, recording the event batches of the Events API.
+BOT = 'bot'
+# Settings of the recorded bot, see CassetteWriter.write_info().
+INFO = 'info'
+
+# Calls not worth recording when they return nothing, like the RTM
+# reads the run loop makes twice a second.
+SKIP_EMPTY = frozenset([(SLACK, 'rtm_read')])
+# Settings a replay needs to configure the bot like the recorded one.
+REPLAY_ENVIRON = ('WORKSPACE_ID', 'WORKSPACE_NAME', 'DISCOVERY_DATA_SOURCE',
+                  'DISCOVERY_ENVIRONMENT_ID', 'DISCOVERY_COLLECTION_ID',
+                  'DISCOVERY_SOURCES', 'DISCOVERY_SCORE_FILTER')
+# Seconds between flushes of the cassette. Flushing every call would
+# compress poorly, and a dying process loses at most this much.
+FLUSH_INTERVAL = 1.0
+
+
+def to_json(value):
+    """JSON fallback for objects like OnlineStoreCustomer."""
+    if hasattr(value, '__dict__'):
+        return dict(value.__dict__)
+    return repr(value)
+
+
+def request_key(args, kwargs):
+    """Comparable form of the arguments of a call.
+
+    :rtype: str
+    """
+    return json.dumps([args, kwargs], sort_keys=True, default=to_json)
+
+
+class CassetteWriter(object):
+
+    def __init__(self, path, clock=time.time):
+        """Appends recorded calls to a gzip compressed cassette.
+
+        :param str path: cassette file, e.g. session.jsonl.gz
+        :param clock: function returning the current time in seconds
+        """
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'ab')
+        self.start = self.last_flush = clock()
+
+    def write(self, entry):
+        """Write one recorded call.
+
+        :param dict entry: see Recorder
+        """
+        line = json.dumps(entry, sort_keys=True, default=to_json) + '\n'
+        with self.lock:
+            self.file.write(line.encode('utf-8'))
+            if self.clock() - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = self.clock()
+
+    def write_info(self, **info):
+        """Record settings needed to replay, like the bot ID."""
+        self.write({'service': INFO, 'method': INFO, 'args': [],
+                    'kwargs': {}, 'response': info})
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Recorder(object):
+
+    def __init__(self, client, service, writer, clock=time.time):
+        """Proxy of a client recording its calls to a cassette.
+
+        Attributes are passed through. Calls of public methods are
+        recorded as:
+
+            {"service": ..., "method": ..., "args": [...], "kwargs": {...},
+             "at": seconds since recording started, "elapsed": seconds,
+             "response": ...} or "error": {"type": ..., "message": ...,
+             "status_code": ...}
+
+        :param client: client to wrap
+        :param str service: name of the service, e.g. DISCOVERY
+        :param CassetteWriter writer: cassette to write to
+        :param clock: function returning the current time in seconds
+        """
+        self._client = client
+        self._service = service
+        self._writer = writer
+        self._clock = clock
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def recorded(*args, **kwargs):
+            start = self._clock()
+            entry = {'service': self._service, 'method': name,
+                     'args': list(args), 'kwargs': kwargs,
+                     'at': round(start - self._writer.start, 6)}
+            try:
+                response = attr(*args, **kwargs)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                entry['error'] = {
+                    'type': type(e).__name__, 'message': str(e),
+                    'status_code': getattr(response, 'status_code', None)}
+                entry['elapsed'] = round(self._clock() - start, 6)
+                self._writer.write(entry)
+                raise
+            if response or (self._service, name) not in SKIP_EMPTY:
+                entry['response'] = response
+                entry['elapsed'] = round(self._clock() - start, 6)
+                self._writer.write(entry)
+            return response
+
+        return recorded
+
+
+class CassetteMiss(Exception):
+    """No recorded call left to answer a replayed call."""
+
+
+class _Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ReplayedError(Exception):
+
+    def __init__(self, error):
+        """Error raised again from a cassette.
+
+        :param dict error: 'type', 'message' and 'status_code' of the
+                           recorded error. A status code is kept on
+                           self.response, like HTTP errors of the clients.
+        """
+        super(ReplayedError, self).__init__(
+            "%s: %s" % (error.get('type'), error.get('message')))
+        self.error = error
+        self.response = _Response(error.get('status_code'))
+
+
+def read_cassette(path):
+    """Recorded calls of a cassette, in recording order.
+
+    :param str path: cassette file
+    :rtype: list
+    """
+    entries = []
+    with gzip.open(path, 'rb') as cassette:
+        try:
+            for number, line in enumerate(cassette, 1):
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    LOG.warning("Skipping bad cassette line %d of %s" %
+                                (number, path))
+        except (EOFError, IOError, OSError):
+            # The recording process died before closing the cassette.
+            LOG.warning("Cassette %s is truncated after %d calls." %
+                        (path, len(entries)))
+    return entries
+
+
+class Replayer(object):
+
+    def __init__(self, entries, latency_scale=1.0, strict=False,
+                 sleep=time.sleep):
+        """Answers calls from recorded calls.
+
+        A call is answered by the first unused recorded call of the same
+        method with the same arguments or, failing that, by the next
+        unused recorded call of the same method.
+
+        :param list entries: recorded calls, see read_cassette()
+        :param float latency_scale: replayed latency per recorded second,
+                                    0 to answer at once
+        :param bool strict: only answer calls with the same arguments
+        :param sleep: sleep function, for testing
+        """
+        self.latency_scale = latency_scale
+        self.strict = strict
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.calls = collections.defaultdict(list)
+        self.entries = entries
+        for entry in entries:
+            self.calls[(entry['service'], entry['method'])].append(
+                (request_key(entry['args'], entry['kwargs']), entry))
+        self.counters = collections.Counter()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Replayer of a cassette file.
+
+        :param str path: cassette file
+        :param kwargs: see Replayer
+        :rtype: Replayer
+        """
+        return cls(read_cassette(path), **kwargs)
+
+    def info(self):
+        """Settings recorded with CassetteWriter.write_info().
+
+        :rtype: dict
+        """
+        info = {}
+        for entry in self.entries:
+            if entry['service'] == INFO:
+                info.update(entry['response'])
+        return info
+
+    def recorded(self, service):
+        """Whether any call of a service was recorded.
+
+        :rtype: bool
+        """
+        return any(entry['service'] == service for entry in self.entries)
+
+    def client(self, service):
+        """Replay client standing in for a recorded one.
+
+        :param str service: name the service was recorded with
+        :rtype: ReplayClient
+        """
+        return ReplayClient(self, service)
+
+    def take(self, service, method, args, kwargs):
+        """Find and use up the recorded call answering a call.
+
+        :returns: recorded call
+        :rtype: dict
+        :raise CassetteMiss: when no recorded call is left
+        """
+        key = request_key(list(args), kwargs)
+        with self.lock:
+            calls = self.calls.get((service, method)) or []
+            for index, (recorded_key, entry) in enumerate(calls):
+                if recorded_key == key:
+                    self.counters['matched'] += 1
+                    return calls.pop(index)[1]
+            if calls and not self.strict:
+                self.counters['in_order'] += 1
+                return calls.pop(0)[1]
+            self.counters['missed'] += 1
+        raise CassetteMiss("No recorded %s.%s call left for %s" %
+                           (service, method, key[:200]))
+
+    def replay(self, service, method, args, kwargs):
+        """Answer a call like it was answered when recorded.
+
+        :returns: recorded response
+        :raise ReplayedError: when the recorded call failed
+        :raise CassetteMiss: when no recorded call is left
+        """
+        entry = self.take(service, method, args, kwargs)
+        delay = entry.get('elapsed', 0) * self.latency_scale
+        if delay > 0:
+            self.sleep(delay)
+        if 'error' in entry:
+            raise ReplayedError(entry['error'])
+        return entry.get('response')
+
+    def event_batches(self):
+        """Inbound Slack event batches, in recording order.
+
+        Batches come from non-empty RTM reads and from the Events API
+        batches recorded on the bot.
+
+        :rtype: list
+        """
+        batches = []
+        for entry in self.entries:
+            key = (entry['service'], entry['method'])
+            if key == (SLACK, 'rtm_read') and entry.get('response'):
+                batches.append(entry['response'])
+            elif (key in ((BOT, 'handle_slack_output'),
+                          (BOT, 'handle_accepted_output')) and
+                  entry['args']):
+                batches.append(entry['args'][0])
+        return batches
+
+
+class ReplayClient(object):
+
+    def __init__(self, replayer, service):
+        """Client whose method calls are answered by a Replayer.
+
+        Methods never recorded still answer: rtm_connect with True and
+        rtm_read with no events, so the bot can run on a cassette without
+        a live Slack connection.
+        """
+        self._replayer = replayer
+        self._service = service
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def replayed(*args, **kwargs):
+            try:
+                return self._replayer.replay(self._service, name, args,
+                                             kwargs)
+            except CassetteMiss:
+                if (self._service, name) == (SLACK, 'rtm_read'):
+                    return []
+                if (self._service, name) == (SLACK, 'rtm_connect'):
+                    return True
+                raise
+
+        return replayed
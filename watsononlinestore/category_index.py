@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Category to products index for browse queries.
+
+Browse queries like "show me hats" name a category rather than a
+product. An offline build step (tools/build_category_index.py) reads the
+product HTML that is loaded into Discovery and maps the categories the
+stores give their products to tokens: IBM store pages carry
+"Category:mug/mugs/cup/cups" markers, and the amazon breadcrumbs listed
+in AMAZON_CATEGORIES are mapped to tokens in the same format. The index
+is a JSON file:
+
+    {"sources": {"<data source>": {
+        "products": [{"name": ..., "url": ..., "image": ...}, ...],
+        "categories": {"<token>": [<product index>, ...], ...}}}}
+
+Lookups are a dict access per data source, and products keep the order
+of the corpus, so the same query always lists the same products.
+"""
+
+import json
+import re
+
+from watsononlinestore import similar_products
+
+CATEGORY_RE = re.compile(r'Category:\s*([\w/-]+)')
+# Breadcrumbs of an amazon product page, e.g. "Men > Shoes > Running".
+BREADCRUMBS_RE = re.compile(
+    r'id="wayfinding-breadcrumbs_feature_div"(.*?)</ul>', re.S)
+BREADCRUMB_RE = re.compile(r'<a\b[^>]*>(.*?)</a>', re.S)
+# Amazon breadcrumbs that are browse categories, with their tokens in the
+# format of the IBM store markers. Other breadcrumbs name departments or
+# audiences ("Clothing, Shoes & Jewelry", "Men") and are not indexed.
+AMAZON_CATEGORIES = {
+    'pants': 'pants/pant/trousers',
+    'active pants': 'pants/pant',
+    'shirts': 'shirt/shirts',
+    'shirts & tees': 'shirt/shirts/tee/tees',
+    't-shirts': 'shirt/shirts/tee/tees',
+    'tops & tees': 'top/tops/tee/tees',
+    'undershirts': 'undershirt/undershirts',
+    'shoes': 'shoe/shoes',
+    'fashion sneakers': 'sneaker/sneakers',
+    'hiking boots': 'boot/boots',
+    'backpacks': 'backpack/backpacks',
+    'books': 'book/books',
+}
+# Words around the category in browse queries, e.g. "show me some hats".
+QUERY_FILLER_WORDS = frozenset((
+    'show', 'see', 'find', 'get', 'buy', 'want', 'need', 'like', 'looking',
+    'look', 'some', 'any', 'all', 'the', 'your', 'you', 'have', 'what',
+    'please', 'can', 'could', 'would', 'for', 'got', 'browse'))
+
+
+def breadcrumbs(html):
+    """Breadcrumbs of an amazon product page.
+
+    :param str html: product page
+    :returns: lowercase breadcrumbs, most general first
+    :rtype: list
+    """
+    match = BREADCRUMBS_RE.search(html)
+    if not match:
+        return []
+    return [' '.join(crumb.lower().split())
+            for crumb in BREADCRUMB_RE.findall(match.group(1))]
+
+
+def product_categories(product, data_source):
+    """Category tokens of a product.
+
+    :param dict product: product from similar_products.load_products(),
+                         the page is only needed for amazon products
+    :param str data_source: "ibm_store" or "amazon"
+    :returns: tokens in the order they were found, without duplicates
+    :rtype: list
+    """
+    tokens = []
+    if data_source == 'ibm_store':
+        marker = CATEGORY_RE.search(product['text'])
+        if marker:
+            tokens = marker.group(1).lower().split('/')
+    else:
+        for crumb in breadcrumbs(product.get('html', '')):
+            if crumb in AMAZON_CATEGORIES:
+                tokens.extend(AMAZON_CATEGORIES[crumb].split('/'))
+    seen = set()
+    return [t for t in tokens if t and not (t in seen or seen.add(t))]
+
+
+def build(corpora, path):
+    """Build and save the category index.
+
+    :param list corpora: (data_source, products) pairs, with products
+                         from similar_products.load_products()
+    :param str path: JSON file to write
+    :returns: number of category tokens by data source
+    :rtype: dict
+    """
+    sources = {}
+    for data_source, products in corpora:
+        source = sources.setdefault(data_source,
+                                    {'products': [], 'categories': {}})
+        for product in products:
+            index = len(source['products'])
+            source['products'].append(dict(
+                (key, product[key]) for key in ('name', 'url', 'image')))
+            for token in product_categories(product, data_source):
+                source['categories'].setdefault(token, []).append(index)
+    with open(path, 'w') as index_file:
+        json.dump({'sources': sources}, index_file, sort_keys=True)
+    return dict((data_source, len(source['categories']))
+                for data_source, source in sources.items())
+
+
+def category_token(query):
+    """The category a browse query names, if it names a single one.
+
+    :param str query: e.g. "show me some hats"
+    :returns: lowercase token, or None
+    :rtype: str
+    """
+    words = [word for word in similar_products.tokenize(query or '')
+             if word not in QUERY_FILLER_WORDS]
+    if len(words) != 1:
+        return None
+    return words[0]
+
+
+class CategoryIndex(object):
+
+    def __init__(self, path):
+        """Category index written by build().
+
+        :param str path: JSON file of the index
+        """
+        with open(path) as index_file:
+            self.sources = json.load(index_file)['sources']
+
+    def lookup(self, query, data_sources):
+        """Products of the category named by a browse query.
+
+        :param str query: the user's query, e.g. "show me hats"
+        :param list data_sources: data sources to list products from, in
+                                  order
+        :returns: products with 'name', 'url' and 'image' in a stable
+                  order, or None if the query is not a known category
+        :rtype: list
+        """
+        token = category_token(query)
+        if token is None:
+            return None
+        products = []
+        for data_source in data_sources:
+            source = self.sources.get(data_source)
+            if source is None:
+                continue
+            products.extend(source['products'][index]
+                            for index in source['categories'].get(token, ()))
+        return products or None
@@ -0,0 +1,167 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Streaming export and import of customer docs as NDJSON.
+
+Every line of the file is one customer doc without its _rev. Exports
+page through a Mango query with bookmarks. Imports write batches with
+_bulk_docs, a few at a time. Neither keeps more than a page or a few
+batches in memory, however big the database is.
+"""
+
+import json
+import logging
+import threading
+
+from cloudant.query import Query
+
+from watsononlinestore.database import partitioning
+from watsononlinestore.database import throttle
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+# Docs per Mango query page when exporting.
+EXPORT_PAGE_SIZE = 500
+# Docs per _bulk_docs request when importing.
+IMPORT_BATCH_SIZE = 500
+# _bulk_docs requests in flight when importing.
+IMPORT_CONCURRENCY = 4
+
+CUSTOMER_SELECTOR = {'type': 'customer'}
+
+
+def export_customers(store, out, page_size=EXPORT_PAGE_SIZE):
+    """Write all customer docs to a file, one JSON doc per line.
+
+    :param CloudantOnlineStore store: store to export from
+    :param out: file-like object to write to
+    :param int page_size: docs per query page
+    :returns: number of docs exported
+    :rtype: int
+    """
+    count = 0
+    bookmark = None
+    store.connect()
+    db = store.client[store.db_name]
+    while True:
+        kwargs = {'limit': page_size}
+        if bookmark:
+            kwargs['bookmark'] = bookmark
+        query = Query(db, selector=CUSTOMER_SELECTOR)
+        page = store.throttle.call(throttle.QUERY, query, **kwargs)
+        docs = page.get('docs', [])
+        for doc in docs:
+            doc = dict(doc)
+            doc.pop('_rev', None)
+            out.write(json.dumps(doc, sort_keys=True) + '\n')
+        count += len(docs)
+        LOG.info('Exported %d customers.' % count)
+        bookmark = page.get('bookmark')
+        if len(docs) < page_size or not bookmark:
+            break
+    return count
+
+
+def import_doc(store, line):
+    """Turn an NDJSON line into a doc to write, or None to skip it.
+
+    :rtype: dict, None
+    """
+    line = line.strip()
+    if not line:
+        return None
+    doc = json.loads(line)
+    if doc.get('type') != 'customer' or not doc.get('email'):
+        return None
+    doc.pop('_rev', None)
+    if store.partitioned:
+        doc['_id'] = partitioning.customer_doc_id(doc['email'])
+    return doc
+
+
+def import_customers(store, lines, batch_size=IMPORT_BATCH_SIZE,
+                     concurrency=IMPORT_CONCURRENCY):
+    """Write customer docs from NDJSON lines into the store.
+
+    Docs that already exist are reported as conflicts and left alone, so
+    an import can be re-run.
+
+    :param CloudantOnlineStore store: store to import into
+    :param lines: iterable of NDJSON lines, e.g. an open file
+    :param int batch_size: docs per _bulk_docs request
+    :param int concurrency: _bulk_docs requests in flight
+    :returns: counts of 'imported', 'skipped', 'conflicts' and 'failed'
+    :rtype: dict
+    """
+    counts = {'imported': 0, 'skipped': 0, 'conflicts': 0, 'failed': 0}
+    lock = threading.Lock()
+    batches = queue.Queue(maxsize=concurrency)
+
+    def write(db, batch):
+        try:
+            results = store.throttle.call(throttle.WRITE, db.bulk_docs, batch)
+        except Exception:
+            LOG.exception('Bulk write of %d docs failed:' % len(batch))
+            with lock:
+                counts['failed'] += len(batch)
+            return
+        with lock:
+            for result in results:
+                if result.get('error') == 'conflict':
+                    counts['conflicts'] += 1
+                elif 'error' in result:
+                    LOG.error('Failed to import %s: %s' %
+                              (result.get('id'), result))
+                    counts['failed'] += 1
+                else:
+                    counts['imported'] += 1
+
+    def worker(db):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            write(db, batch)
+
+    store.connect()
+    db = store.client[store.db_name]
+    workers = [threading.Thread(target=worker, args=(db,))
+               for _ in range(concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    try:
+        batch = []
+        for line in lines:
+            doc = import_doc(store, line)
+            if doc is None:
+                with lock:
+                    counts['skipped'] += 1
+                continue
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                batches.put(batch)  # blocks while all workers are busy
+                batch = []
+        if batch:
+            batches.put(batch)
+    finally:
+        for _ in workers:
+            batches.put(None)
+        for thread in workers:
+            thread.join()
+    LOG.info('Imported %s' % counts)
+    return counts
@@ -0,0 +1,205 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Shopping cart items as stored in customer docs.
+
+A cart is a list of items like:
+
+    {'id': '131628', 'name': 'Eye-Bee-M Cap',
+     'url': 'http://...ProductDetail.aspx?pid=131628',
+     'qty': 2, 'added': 1508330000}
+
+Carts used to be lists of "<name>: <url>\\n" strings. Those are converted
+when a cart is read and are written back in the new form with the next
+cart update.
+"""
+
+import time
+import uuid
+
+PID_TAG = 'pid='
+
+# Cart operations, see apply_ops()
+ADD = 'add'
+DELETE = 'delete'
+# IDs of the last operations applied to a cart, kept with it so that an
+# operation written again after a crash is only applied once.
+APPLIED_OPS_KEPT = 100
+
+
+def product_id(url, name=''):
+    """Get the ID used to key a product in the cart.
+
+    IBM store URLs carry a product ID. Other products are keyed by URL,
+    or by name when there is no URL.
+
+    :param str url: product url
+    :param str name: product name
+    :rtype: str
+    """
+    if url and PID_TAG in url:
+        return url[url.rfind(PID_TAG) + len(PID_TAG):]
+    return url or name
+
+
+def new_cart_item(name, url, quantity=1, added=None):
+    """Create a cart item.
+
+    :param str name: product name
+    :param str url: product url
+    :param int quantity: number of products
+    :param int added: epoch seconds when added, defaults to now
+    :rtype: dict
+    """
+    return {
+        'id': product_id(url, name),
+        'name': name,
+        'url': url,
+        'qty': quantity,
+        'added': int(time.time()) if added is None else added,
+    }
+
+
+def migrate_cart(cart):
+    """Convert a cart that may hold old style string entries.
+
+    Items are merged by product ID, so duplicated strings become a single
+    item with a quantity.
+
+    :param list cart: shopping_cart from a customer doc
+    :returns: cart of item dicts
+    :rtype: list
+    """
+    items = []
+    by_id = {}
+    for entry in cart or []:
+        if not isinstance(entry, dict):
+            name, _, url = entry.strip().rpartition(': ')
+            if not name:
+                name, url = url, ''
+            entry = new_cart_item(name, url, added=0)
+        existing = by_id.get(entry['id'])
+        if existing is None:
+            entry = dict(entry)
+            by_id[entry['id']] = entry
+            items.append(entry)
+        else:
+            existing['qty'] += entry.get('qty', 1)
+    return items
+
+
+def add_item(cart, item):
+    """Add an item to a migrated cart, or increase its quantity.
+
+    :param list cart: cart returned by migrate_cart
+    :param dict item: item returned by new_cart_item
+    """
+    for entry in cart:
+        if entry['id'] == item['id']:
+            entry['qty'] += item['qty']
+            return
+    cart.append(dict(item))
+
+
+def remove_item(cart, item_id):
+    """Remove the item with a product ID from a migrated cart.
+
+    :param list cart: cart returned by migrate_cart
+    :param str item_id: product ID of the item
+    :returns: True if an item was removed
+    :rtype: bool
+    """
+    for index, entry in enumerate(cart):
+        if entry['id'] == item_id:
+            del cart[index]
+            return True
+    return False
+
+
+def apply_ops(cart, ops):
+    """Apply cart operations to a migrated cart.
+
+    :param list cart: cart returned by migrate_cart
+    :param list ops: ['add', item] and ['delete', item_id] pairs, which
+                     may have an op ID as a third element, see op_id()
+    :returns: True if the cart changed
+    :rtype: bool
+    """
+    changed = False
+    for entry in ops:
+        op, arg = entry[0], entry[1]
+        if op == ADD:
+            add_item(cart, arg)
+            changed = True
+        elif op == DELETE:
+            changed = remove_item(cart, arg) or changed
+    return changed
+
+
+def op_id(op):
+    """ID of a cart operation, or None if it has none.
+
+    :param list op: operation, see apply_ops()
+    :rtype: str, None
+    """
+    return op[2] if len(op) > 2 else None
+
+
+def with_op_id(op):
+    """The operation with an ID, a new one if it has none.
+
+    A retried operation must keep its ID, so that it is applied once even
+    if the failed attempt was written after all.
+
+    :param list op: operation, see apply_ops()
+    :rtype: list
+    """
+    if op_id(op) is not None:
+        return op
+    return [op[0], op[1], uuid.uuid4().hex]
+
+
+def unapplied_ops(ops, applied):
+    """Operations not applied yet, by their IDs.
+
+    Operations without an ID are always applied.
+
+    :param list ops: operations, see apply_ops()
+    :param list applied: IDs of applied operations
+    :rtype: list
+    """
+    applied = set(applied or [])
+    return [op for op in ops if op_id(op) is None or op_id(op) not in applied]
+
+
+def remember_ops(applied, ops):
+    """Add the IDs of operations to the applied ones.
+
+    :param list applied: IDs of applied operations
+    :param list ops: operations just applied
+    :returns: the last APPLIED_OPS_KEPT IDs
+    :rtype: list
+    """
+    ids = [op_id(op) for op in ops if op_id(op) is not None]
+    return (list(applied or []) + ids)[-APPLIED_OPS_KEPT:]
+
+
+def format_item(item):
+    """Format a cart item for display.
+
+    :param dict item: cart item
+    :rtype: str
+    """
+    text = item['name'] + ': ' + item['url']
+    if item['qty'] > 1:
+        text += ' (x%d)' % item['qty']
+    return text
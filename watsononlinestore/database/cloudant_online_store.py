@@ -11,36 +11,107 @@
 # under the License.
 
 import logging
+import threading
+
+from cloudant.document import Document
 from cloudant.query import Query
 
-logging.basicConfig(level=logging.DEBUG)
+from watsononlinestore import resilience
+from watsononlinestore.database import cart
+from watsononlinestore.database import partitioning
+from watsononlinestore.database import throttle
+from watsononlinestore.database.online_store import OnlineStore
+from watsononlinestore.log_config import Payload
+
 LOG = logging.getLogger(__name__)
 
+# Retries for Cloudant reads, which are safe to repeat.
+READ_RETRIES = 2
+
+_connect_lock = threading.Lock()
+_connected_clients = []
+
+
+def connect_once(client):
+    """Connect a Cloudant client, unless it already is.
+
+    Connecting logs the client's previous session out, and disconnecting
+    ends it for every thread, so the session is opened once and shared by
+    every store using the client. The client renews it when it expires.
+
+    :param Cloudant client: client to connect
+    """
+    with _connect_lock:
+        if not any(connected is client for connected in _connected_clients):
+            client.connect()
+            _connected_clients.append(client)
+
 
-class CloudantOnlineStore(object):
+class CloudantOnlineStore(OnlineStore):
 
-    def __init__(self, client, db_name):
+    def __init__(self, client, db_name, partitioned=False, cache=None,
+                 cloudant_throttle=None):
         """Creates a new instance of CloudantOnlineStore.
 
         :param Cloudant client: instance of cloudant client to connect to
         :param str db_name: name of the database to use
+        :param bool partitioned: use a database partitioned by customer,
+                                 see database.partitioning
+        :param CustomerCache cache: optional cache of customer docs, kept
+                                    coherent by a ChangesFollower
+        :param CloudantThrottle cloudant_throttle: request budgets, shared
+                                                   with other users of the
+                                                   account
         """
         self.client = client
         self.db_name = db_name
+        self.partitioned = partitioned
+        self.cache = cache
+        self.throttle = cloudant_throttle or throttle.CloudantThrottle()
+        self.breaker = resilience.get_breaker('cloudant')
+
+    def connect(self):
+        """Connect the client, once for all its users."""
+        connect_once(self.client)
+
+    def guarded(self, func, retries=0, request_class=throttle.WRITE):
+        """Run func on the database, within the turn deadline.
+
+        Calls fail fast with CircuitOpenError while Cloudant is failing.
+        Requests are throttled and retried on 429 by self.throttle. Each
+        attempt is timed on its own, and the backoff after a 429 is not:
+        a 429 is an answer, so it doesn't count against the breaker.
+
+        :param func: function taking the database as its argument
+        :param int retries: extra attempts, only for idempotent reads
+        :param request_class: throttle class of the requests func makes
+        :returns: result of func
+        """
+        self.connect()
+        return self.throttle.call(
+            request_class, resilience.guarded_call, self.breaker, func,
+            self.client[self.db_name], guard_retries=retries,
+            guard_answered=throttle.is_rate_limited,
+            deadline=resilience.current_deadline())
 
     def init(self):
         """Creates and initializes the database.
         """
-        try:
-            self.client.connect()
-            LOG.info('Getting database...')
-            if self.db_name not in self.client.all_dbs():
-                LOG.info('Creating database {}...'.format(self.db_name))
-                self.client.create_database(self.db_name)
-            else:
-                LOG.info('Database {} exists.'.format(self.db_name))
-        finally:
-            self.client.disconnect()
+        self.connect()
+        LOG.info('Getting database...')
+        if self.db_name not in self.client.all_dbs():
+            LOG.info('Creating database %s...', self.db_name)
+            self.client.create_database(self.db_name,
+                                        partitioned=self.partitioned)
+        else:
+            LOG.info('Database %s exists.', self.db_name)
+            props = self.client[self.db_name].metadata().get('props', {})
+            if bool(props.get('partitioned')) != self.partitioned:
+                LOG.error('Database {} partitioned={}, but the store is '
+                          'configured with partitioned={}. See '
+                          'tools/migrate_to_partitioned.py.'.format(
+                              self.db_name, props.get('partitioned'),
+                              self.partitioned))
 
     # User
 
@@ -60,6 +131,9 @@ class CloudantOnlineStore(object):
             'last_name': customer.last_name,
             'shopping_cart': customer.shopping_cart
         }
+        if self.partitioned:
+            customer_doc['_id'] = partitioning.customer_doc_id(
+                customer.email)
 
         self.add_doc_if_not_exists(customer_doc, 'email')
 
@@ -68,63 +142,104 @@ class CloudantOnlineStore(object):
 
         :param str customer_str: customer (email addr)
 
-        :returns: document with customer info
+        :returns: document with customer info, None when not found or
+                  Cloudant failed
         :rtype: dict
         """
-        return self.find_doc('customer', 'email', customer_str)
+        try:
+            return self.lookup_customer(customer_str)
+        except Exception:
+            LOG.exception("Cloudant DB exception:")
+            return None
 
-    def list_shopping_cart(self, customer_str):
-        """Get shopping cart info for a given customer.
+    def lookup_customer(self, customer_str):
+        """Like find_customer(), but raises when Cloudant fails.
 
         :param str customer_str: customer (email addr)
+        :returns: document with customer info, None when not found
+        :rtype: dict
+        :raise Exception: when the lookup failed
+        """
+        if self.cache is not None:
+            doc = self.cache.get(customer_str)
+            if doc is not None:
+                return doc
+        doc = self.query_doc('customer', 'email', customer_str)
+        if doc and self.cache is not None:
+            self.cache.put(customer_str, doc)
+        return doc
+
+    @staticmethod
+    def fetch_doc(db, doc_id):
+        """Read a doc fresh from the database, for updating it.
+
+        Another process may have changed the doc since we last read it,
+        so don't rely on the client's local document cache.
+
+        :rtype: Document
+        """
+        current_doc = Document(db, doc_id)
+        current_doc.fetch()
+        return current_doc
+
+    def save_customer_doc(self, customer_str, current_doc):
+        """Save an updated customer doc and refresh the cache.
+        """
+        current_doc.save()
+        if self.cache is not None:
+            self.cache.put(customer_str, dict(current_doc))
 
-        :returns: shopping cart
-        :rtype: list
+    def partition_for(self, doc_type, property_name, property_value):
+        """Partition to search for a doc, or None to search everywhere.
+
+        :rtype: str, None
+        """
+        if (self.partitioned and doc_type == 'customer' and
+                property_name == 'email'):
+            return partitioning.partition_key(property_value)
+        return None
+
+    def list_stored_cart(self, customer_str):
+        """Get the shopping cart as stored, ignoring buffered updates.
+
+        :param str customer_str: customer (email addr)
+        :rtype: list, None
         """
         doc = self.find_customer(customer_str)
         if doc:
-            return doc['shopping_cart']
+            return cart.migrate_cart(doc['shopping_cart'])
         return doc  # None
 
-    def add_to_shopping_cart(self, customer_str, item):
-        """Adds item to shopping cart for customer.
+    def apply_cart_ops(self, customer_str, ops):
+        """Apply cart operations with one read-modify-write of the doc.
+
+        The IDs of the operations applied are saved with the cart, in
+        applied_ops, so operations with IDs are only applied once.
 
         :param str customer_str: customer (email addr)
-        :param str item: item to add
+        :param list ops: operations, see cart.apply_ops()
+        :raise Exception: when the doc could not be read or saved
         """
-        user_doc = self.find_doc(
-            'customer', 'email', customer_str)
-        try:
-            self.client.connect()
-            current_doc = self.client[self.db_name][user_doc['_id']]
-            if current_doc:
-                current_doc['shopping_cart'].append(item)
-                current_doc.save()
-        except Exception:
-            LOG.exception("Cloudant DB exception:")
+        user_doc = self.lookup_customer(customer_str)
+        if not user_doc:
+            LOG.warning("Customer %s not found." % customer_str)
+            return
 
-        finally:
-            self.client.disconnect()
+        def update(db):
+            current_doc = self.fetch_doc(db, user_doc['_id'])
+            items = cart.migrate_cart(current_doc['shopping_cart'])
+            applied = (current_doc['applied_ops']
+                       if 'applied_ops' in current_doc else [])
+            new_ops = cart.unapplied_ops(ops, applied)
+            changed = cart.apply_ops(items, new_ops)
+            remembered = cart.remember_ops(applied, new_ops)
+            # Operations changing nothing need not be remembered.
+            if changed:
+                current_doc['shopping_cart'] = items
+                current_doc['applied_ops'] = remembered
+                self.save_customer_doc(customer_str, current_doc)
 
-    def delete_item_shopping_cart(self, customer_str, item):
-        """Deletes item from shopping cart for customer.
-        :param str customer_str: The customer specified by the user
-        :param str item: item to delete
-        """
-        user_doc = self.find_doc(
-            'customer', 'email', customer_str)
-        try:
-            self.client.connect()
-            current_doc = self.client[self.db_name][user_doc['_id']]
-            if current_doc:
-                if item in current_doc['shopping_cart']:
-                    current_doc['shopping_cart'].remove(item)
-                    current_doc.save()
-        except Exception:
-            LOG.exception("Cloudant DB exception:")
-
-        finally:
-            self.client.disconnect()
+        self.guarded(update, request_class=(throttle.LOOKUP, throttle.WRITE))
 
     # Cloudant Helper Methods
 
@@ -136,25 +251,44 @@ class CloudantOnlineStore(object):
         :param str property_value: value that should match for the specified
                                    property name
 
-        :returns: doc from query or None
+        In a partitioned database, customers are looked up with a query
+        scoped to their partition.
+
+        :returns: doc from query or None, also when Cloudant failed
         :rtype: dict, None
         """
         try:
-            self.client.connect()
-            db = self.client[self.db_name]
-            selector = {
-                '_id': {'$gt': 0},
-                'type': doc_type,
-                property_name: property_value
-            }
-            query = Query(db, selector=selector)
+            return self.query_doc(doc_type, property_name, property_value)
+        except Exception:
+            LOG.exception("Cloudant DB exception:")
+
+    def query_doc(self, doc_type, property_name, property_value):
+        """Like find_doc(), but raises when Cloudant fails.
+
+        :returns: doc from query or None
+        :rtype: dict, None
+        :raise Exception: when the query failed
+        """
+        selector = {
+            '_id': {'$gt': 0},
+            'type': doc_type,
+            property_name: property_value
+        }
+        partition_key = self.partition_for(
+            doc_type, property_name, property_value)
+
+        def find(db):
+            if partition_key:
+                query = Query(db, selector=selector,
+                              partition_key=partition_key)
+            else:
+                query = Query(db, selector=selector)
             for doc in query()['docs']:
                 return doc
             return None
-        except Exception:
-            LOG.exception("Cloudant DB exception:")
-        finally:
-            self.client.disconnect()
+
+        return self.guarded(find, retries=READ_RETRIES,
+                            request_class=throttle.QUERY)
 
     def add_doc_if_not_exists(self, doc, unique_property_name):
         """Adds a new doc to Cloudant if a doc with the same value for
@@ -170,16 +304,13 @@ class CloudantOnlineStore(object):
         existing_doc = self.find_doc(
             doc_type, unique_property_name, property_value)
         if existing_doc is not None:
-            LOG.debug('Existing {} doc where {}={}:\n{}'.format(
-                doc_type, unique_property_name, property_value, existing_doc))
+            LOG.debug('Existing %s doc where %s=%s:\n%s', doc_type,
+                      unique_property_name, property_value,
+                      Payload(existing_doc))
         else:
-            LOG.debug('Creating {} doc where {}={}'.format(
-                doc_type, unique_property_name, property_value))
+            LOG.debug('Creating %s doc where %s=%s', doc_type,
+                      unique_property_name, property_value)
             try:
-                self.client.connect()
-                db = self.client[self.db_name]
-                db.create_document(doc)
+                self.guarded(lambda db: db.create_document(doc))
             except Exception:
                 LOG.exception("Cloudant DB exception:")
-            finally:
-                self.client.disconnect()
@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from cloudant.document import Document
+from requests.exceptions import HTTPError
+
+from watsononlinestore import resilience
+from watsononlinestore.database import partitioning
+from watsononlinestore.database.cloudant_online_store import connect_once
+from watsononlinestore.database import throttle
+from watsononlinestore.session_store import Session
+from watsononlinestore.session_store import SessionConflict
+from watsononlinestore.session_store import SessionStore
+
+LOG = logging.getLogger(__name__)
+
+
+class CloudantSessionStore(SessionStore):
+
+    def __init__(self, client, db_name, partitioned=False,
+                 cloudant_throttle=None):
+        """Session store keeping one Cloudant document per session.
+
+        Sessions are shared by every bot process using the same database.
+        The serialized session is stored as a single string field, and
+        the document _rev is used to detect concurrent writes.
+
+        :param Cloudant client: instance of cloudant client to connect to
+        :param str db_name: name of the database to use
+        :param bool partitioned: the database is partitioned, so session
+                                 docs get a partition of their own user
+        :param CloudantThrottle cloudant_throttle: request budgets, shared
+                                                   with the online store
+        """
+        self.client = client
+        self.db_name = db_name
+        self.partitioned = partitioned
+        self.throttle = cloudant_throttle or throttle.CloudantThrottle()
+        self.breaker = resilience.get_breaker('cloudant')
+
+    def doc_id(self, session_id):
+        if self.partitioned:
+            return partitioning.partition_key(session_id) + ':session'
+        return 'session:' + session_id
+
+    def guarded(self, request_class, func, *args, **kwargs):
+        """Make Cloudant requests like CloudantOnlineStore.guarded()."""
+        connect_once(self.client)
+        return self.throttle.call(
+            request_class, resilience.guarded_call, self.breaker, func,
+            *args, guard_answered=throttle.is_rate_limited,
+            deadline=resilience.current_deadline(), **kwargs)
+
+    def load(self, session_id):
+        return self.guarded(throttle.LOOKUP, self._load, session_id,
+                            guard_retries=2)
+
+    def _load(self, session_id):
+        doc = Document(self.client[self.db_name], self.doc_id(session_id))
+        try:
+            doc.fetch()
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return Session(session_id)
+            raise
+        return Session.loads(session_id, doc['data'],
+                             version=doc.get('version', 0),
+                             rev=doc['_rev'])
+
+    def save(self, session):
+        doc = {
+            '_id': self.doc_id(session.session_id),
+            'type': 'session',
+            'version': session.version + 1,
+            'data': session.dumps(),
+        }
+        if session.rev:
+            doc['_rev'] = session.rev
+        result = self.guarded(throttle.WRITE, self._bulk_save, doc)
+
+        if result.get('error') == 'conflict':
+            raise SessionConflict(session.session_id)
+        if 'error' in result:
+            raise Exception("Cloudant session save failed: %s" % result)
+        session.version += 1
+        session.rev = result['rev']
+
+    def _bulk_save(self, doc):
+        # _bulk_docs creates or updates with a single request.
+        return self.client[self.db_name].bulk_docs([doc])[0]
@@ -0,0 +1,221 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import copy
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Customer docs kept per process.
+CACHE_SIZE = 10000
+# Seconds a doc may stay cached. Only a safety net for a change that
+# arrives between reading a doc and caching it, or while the _changes
+# feed is failing.
+CACHE_TTL = 30
+# Milliseconds a longpoll _changes request waits for changes.
+LONGPOLL_TIMEOUT = 25000
+# Seconds to wait after a failed _changes request. Doubled up to the max.
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+
+class CustomerCache(object):
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, clock=time.time):
+        """LRU cache of customer docs by email.
+
+        Safe to share between threads. Callers get copies, so cached docs
+        are only changed through put().
+
+        :param int size: maximum number of customers cached
+        :param float ttl: seconds before a cached doc is read again
+        :param clock: function returning the current time in seconds
+        """
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.docs = collections.OrderedDict()
+        self.emails_by_id = {}
+        self.stats = collections.Counter()
+
+    def get(self, email):
+        """Cached customer doc, or None.
+
+        :param str email: customer email
+        :rtype: dict, None
+        """
+        with self.lock:
+            doc = self.docs.get(email)
+            if doc is not None and self.clock() - doc[0] > self.ttl:
+                self._remove(email)
+                doc = None
+            if doc is None:
+                self.stats['misses'] += 1
+                return None
+            self.docs[email] = self.docs.pop(email)  # most recently used
+            self.stats['hits'] += 1
+            return copy.deepcopy(doc[1])
+
+    def put(self, email, doc):
+        """Cache a customer doc.
+
+        :param str email: customer email
+        :param dict doc: customer doc, including _id
+        """
+        with self.lock:
+            self._remove(email)
+            self.docs[email] = (self.clock(), copy.deepcopy(doc))
+            self.emails_by_id[doc['_id']] = email
+            while len(self.docs) > self.size:
+                oldest = next(iter(self.docs))
+                self._remove(oldest)
+
+    def invalidate(self, email):
+        with self.lock:
+            if self._remove(email):
+                self.stats['invalidations'] += 1
+
+    def _remove(self, email):
+        doc = self.docs.pop(email, None)
+        if doc is not None:
+            self.emails_by_id.pop(doc[1]['_id'], None)
+        return doc is not None
+
+    def apply_change(self, doc):
+        """Update the cache with a doc from the _changes feed.
+
+        Only customers that are already cached are refreshed, so following
+        the feed never grows the cache.
+
+        :param dict doc: changed doc (with _deleted set for deletions)
+        """
+        with self.lock:
+            email = self.emails_by_id.get(doc['_id'])
+            if email is None:
+                return
+            cached = self.docs.get(email)
+            if cached is not None and cached[1].get('_rev') == doc.get('_rev'):
+                return  # our own write
+            self._remove(email)
+            if doc.get('_deleted') or doc.get('email') != email:
+                self.stats['invalidations'] += 1
+                return
+            self.docs[email] = (self.clock(), copy.deepcopy(doc))
+            self.emails_by_id[doc['_id']] = email
+            self.stats['refreshes'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.docs.clear()
+            self.emails_by_id.clear()
+
+    def metrics(self):
+        """Counters of hits, misses, refreshes and invalidations.
+
+        :rtype: dict
+        """
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics['size'] = len(self.docs)
+        for key in ('hits', 'misses', 'refreshes', 'invalidations'):
+            metrics.setdefault(key, 0)
+        return metrics
+
+
+class ChangesFollower(object):
+
+    def __init__(self, client, db_name, cache,
+                 longpoll_timeout=LONGPOLL_TIMEOUT):
+        """Keep a CustomerCache coherent by following the _changes feed.
+
+        A background thread makes longpoll _changes requests filtered to
+        customer docs with a _selector, so writes by other bot processes
+        or by admins reach the cache as soon as they are committed. It
+        follows from the current sequence: the cache starts empty, so
+        older changes don't matter.
+
+        :param Cloudant client: cloudant client for the follower alone,
+                                since it stays connected
+        :param str db_name: name of the database to follow
+        :param CustomerCache cache: cache to refresh
+        :param int longpoll_timeout: milliseconds per longpoll request
+        """
+        self.client = client
+        self.db_name = db_name
+        self.cache = cache
+        self.longpoll_timeout = longpoll_timeout
+        self.since = 'now'
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """Make one _changes request and apply the results.
+
+        :returns: number of changes applied
+        :rtype: int
+        """
+        db = self.client[self.db_name]
+        response = db.r_session.post(
+            db.database_url + '/_changes',
+            params={'feed': 'longpoll',
+                    'filter': '_selector',
+                    'include_docs': 'true',
+                    'since': self.since,
+                    'timeout': self.longpoll_timeout},
+            data=json.dumps({'selector': {'type': 'customer'}}),
+            headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        changes = response.json()
+
+        for change in changes.get('results', []):
+            doc = change.get('doc') or {'_id': change['id'],
+                                        '_deleted': change.get('deleted')}
+            self.cache.apply_change(doc)
+        if changes.get('last_seq'):
+            self.since = changes['last_seq']
+        return len(changes.get('results', []))
+
+    def run(self):
+        delay = RETRY_DELAY
+        connected = False
+        while not self.stopped.is_set():
+            try:
+                if not connected:
+                    self.client.connect()
+                    connected = True
+                self.poll()
+                delay = RETRY_DELAY
+            except Exception:
+                LOG.exception("Cloudant _changes feed exception:")
+                self.client.disconnect()
+                connected = False
+                self.stopped.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        if connected:
+            self.client.disconnect()
+
+    def start(self):
+        """Follow the feed on a background thread."""
+        self.thread = threading.Thread(target=self.run,
+                                       name="cloudant-changes")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout)
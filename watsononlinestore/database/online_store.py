@@ -0,0 +1,165 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+
+from watsononlinestore.database import cart
+from watsononlinestore.database.write_behind import CartWriteBehind
+
+LOG = logging.getLogger(__name__)
+
+
+class OnlineStore(object):
+    """Interface for storing customers and their shopping carts.
+
+    Backends must implement init(), add_customer_obj(), find_customer(),
+    list_stored_cart() and apply_cart_ops(). The cart methods used by the
+    bot, and optional write-behind buffering of cart updates, are built
+    on top of those.
+
+    Customers are returned as dicts with at least 'email', 'first_name',
+    'last_name' and 'shopping_cart'.
+    """
+
+    write_behind = None
+    # Buffer retrying cart updates that failed, see update_shopping_cart.
+    retry_buffer = None
+    retry_lock = threading.Lock()
+
+    def init(self):
+        """Create the database if needed. Called once before use."""
+        raise NotImplementedError()
+
+    def add_customer_obj(self, customer):
+        """Adds a new customer unless they already exist.
+
+        :param OnlineStoreCustomer customer: the customer to add
+        """
+        raise NotImplementedError()
+
+    def find_customer(self, customer_str):
+        """Find a customer by email.
+
+        :param str customer_str: customer (email addr)
+        :returns: customer, or None when not found
+        :rtype: dict, None
+        """
+        raise NotImplementedError()
+
+    def list_stored_cart(self, customer_str):
+        """Get the shopping cart as stored, ignoring buffered updates.
+
+        :param str customer_str: customer (email addr)
+        :returns: cart items, or None when the customer is not found
+        :rtype: list, None
+        """
+        raise NotImplementedError()
+
+    def apply_cart_ops(self, customer_str, ops):
+        """Apply cart operations atomically.
+
+        :param str customer_str: customer (email addr)
+        :param list ops: operations, see cart.apply_ops()
+        :raise Exception: when the cart could not be read or saved
+        """
+        raise NotImplementedError()
+
+    def list_shopping_cart(self, customer_str):
+        """Get shopping cart info for a given customer.
+
+        :param str customer_str: customer (email addr)
+
+        :returns: shopping cart items (see database.cart)
+        :rtype: list
+        """
+        for buffer in (self.write_behind, self.retry_buffer):
+            if buffer is not None:
+                buffered = buffer.get_cart(customer_str)
+                if buffered is not None:
+                    return buffered
+        return self.list_stored_cart(customer_str)
+
+    def add_to_shopping_cart(self, customer_str, item):
+        """Adds item to shopping cart for customer.
+
+        Adding a product that is already in the cart increases its
+        quantity.
+
+        :param str customer_str: customer (email addr)
+        :param dict item: item to add, from cart.new_cart_item()
+        """
+        self.update_shopping_cart(customer_str, [cart.ADD, item])
+
+    def delete_item_shopping_cart(self, customer_str, item_id):
+        """Deletes item from shopping cart for customer.
+        :param str customer_str: The customer specified by the user
+        :param str item_id: product ID of the item to delete
+        """
+        self.update_shopping_cart(customer_str, [cart.DELETE, item_id])
+
+    def update_shopping_cart(self, customer_str, op):
+        """Apply a cart operation now, or buffer it in write-behind mode.
+
+        An operation that fails is not dropped: it goes to a retry buffer
+        writing it in the background, like write-behind mode, and so do
+        the customer's next operations until it is written.
+
+        :param str customer_str: customer (email addr)
+        :param list op: operation, see cart.apply_ops()
+        """
+        if self.write_behind is not None:
+            self.write_behind.record(customer_str, op)
+            return
+        retry_buffer = self.retry_buffer
+        if (retry_buffer is not None and
+                retry_buffer.get_cart(customer_str) is not None):
+            # Behind earlier operations still to be written.
+            retry_buffer.record(customer_str, op)
+            return
+        # The same ID if retried, a failed attempt may still be written.
+        op = cart.with_op_id(op)
+        try:
+            self.apply_cart_ops(customer_str, [op])
+        except Exception:
+            LOG.exception("Shopping cart update failed, retrying it in the "
+                          "background:")
+            self.start_retry_buffer().record(customer_str, op)
+
+    def start_retry_buffer(self):
+        """The buffer retrying failed cart updates, started on first use.
+
+        :rtype: CartWriteBehind
+        """
+        with self.retry_lock:
+            if self.retry_buffer is None:
+                retry_buffer = CartWriteBehind(self)
+                retry_buffer.start()
+                self.retry_buffer = retry_buffer
+            return self.retry_buffer
+
+    def enable_write_behind(self, flush_interval=None, journal_path=None):
+        """Buffer cart updates in memory and write them in the background.
+
+        See database.write_behind.CartWriteBehind.
+
+        :param float flush_interval: seconds between flushes
+        :param str journal_path: file journaling buffered updates
+        :returns: the started write-behind buffer
+        :rtype: CartWriteBehind
+        """
+        kwargs = {'journal_path': journal_path}
+        if flush_interval is not None:
+            kwargs['flush_interval'] = flush_interval
+        self.write_behind = CartWriteBehind(self, **kwargs)
+        self.write_behind.start()
+        return self.write_behind
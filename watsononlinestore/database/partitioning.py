@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Document layout for partitioned Cloudant databases.
+
+In a partitioned database every document ID has the form
+"<partition key>:<doc id>". Customers are partitioned by a hash of their
+email address, so a customer's docs live together and per-user reads only
+touch one partition.
+"""
+
+import hashlib
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Documents per _all_docs page and _bulk_docs request when migrating.
+MIGRATION_BATCH_SIZE = 500
+# Partition for documents that don't belong to a customer.
+OTHER_PARTITION = 'other'
+
+
+def partition_key(value):
+    """Hash a customer email (or other user key) into a partition key.
+
+    :param str value: email address or user ID
+    :rtype: str
+    """
+    return hashlib.sha256(value.strip().lower().encode('utf-8')).hexdigest()
+
+
+def customer_doc_id(email):
+    """ID of the customer doc in a partitioned database.
+
+    :param str email: customer email address
+    :rtype: str
+    """
+    return partition_key(email) + ':customer'
+
+
+def partitioned_doc_id(doc):
+    """ID a document gets when copied into a partitioned database.
+
+    :param dict doc: document from a non-partitioned database
+    :returns: new document ID, or None to skip the doc
+    :rtype: str
+    """
+    doc_id = doc['_id']
+    if doc_id.startswith('_design/'):
+        return None
+    if doc.get('type') == 'customer' and doc.get('email'):
+        return customer_doc_id(doc['email'])
+    if doc.get('type') == 'session' and doc_id.startswith('session:'):
+        return partition_key(doc_id[len('session:'):]) + ':session'
+    return OTHER_PARTITION + ':' + doc_id
+
+
+def migrate_to_partitioned(client, source_db_name, target_db_name,
+                           batch_size=MIGRATION_BATCH_SIZE):
+    """Copy all documents into a partitioned database.
+
+    The target database is created as partitioned if it doesn't exist.
+    Documents are read in _all_docs pages and written with one _bulk_docs
+    request per page, so memory use is bounded by batch_size. Documents
+    that already exist in the target are reported as conflicts and left
+    alone, so the migration can be re-run.
+
+    :param Cloudant client: instance of cloudant client to connect to
+    :param str source_db_name: existing database
+    :param str target_db_name: partitioned database to copy into
+    :param int batch_size: documents per page and per bulk write
+    :returns: counts of 'copied', 'skipped' and 'conflicts'
+    :rtype: dict
+    """
+    counts = {'copied': 0, 'skipped': 0, 'conflicts': 0}
+    try:
+        client.connect()
+        source = client[source_db_name]
+        if target_db_name not in client.all_dbs():
+            LOG.info('Creating partitioned database %s...' % target_db_name)
+            client.create_database(target_db_name, partitioned=True)
+        target = client[target_db_name]
+
+        last_id = None
+        while True:
+            params = {'include_docs': True, 'limit': batch_size}
+            if last_id is not None:
+                params.update({'startkey': last_id, 'skip': 1})
+            rows = source.all_docs(**params)['rows']
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+
+            batch = []
+            for row in rows:
+                doc = dict(row['doc'])
+                new_id = partitioned_doc_id(doc)
+                if new_id is None:
+                    counts['skipped'] += 1
+                    continue
+                doc.pop('_rev', None)
+                doc['_id'] = new_id
+                batch.append(doc)
+
+            if batch:
+                for result in target.bulk_docs(batch):
+                    if result.get('error') == 'conflict':
+                        counts['conflicts'] += 1
+                    elif 'error' in result:
+                        LOG.error('Failed to copy %s: %s' %
+                                  (result.get('id'), result))
+                    else:
+                        counts['copied'] += 1
+            LOG.info('Migrated %s' % counts)
+
+            if len(rows) < batch_size:
+                break
+    finally:
+        client.disconnect()
+    return counts
@@ -0,0 +1,179 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import sqlite3
+import threading
+
+from watsononlinestore.database import cart
+from watsononlinestore.database.online_store import OnlineStore
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to wait for another connection's write lock.
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS customers ('
+    ' id INTEGER PRIMARY KEY,'
+    ' email TEXT NOT NULL,'
+    ' first_name TEXT,'
+    ' last_name TEXT,'
+    " shopping_cart TEXT NOT NULL DEFAULT '[]',"
+    " applied_ops TEXT NOT NULL DEFAULT '[]')",
+    'CREATE UNIQUE INDEX IF NOT EXISTS customers_email '
+    'ON customers (email)',
+)
+
+
+class SQLiteOnlineStore(OnlineStore):
+
+    def __init__(self, path, timeout=BUSY_TIMEOUT):
+        """Online store in a local SQLite database.
+
+        Meant for single-node deployments and load tests, where a remote
+        Cloudant dominates latency. The database uses WAL mode, so reads
+        don't block on the writer. Each thread gets its own connection.
+
+        :param str path: database file, created if it doesn't exist
+        :param float timeout: seconds to wait for a locked database
+        """
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        """The calling thread's connection, opened on first use.
+
+        :rtype: sqlite3.Connection
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Transactions are started explicitly, see transaction().
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def transaction(self, func):
+        """Run func(conn) in a write transaction.
+
+        BEGIN IMMEDIATE takes the write lock up front, so a
+        read-modify-write can't lose an update made by another thread.
+
+        :returns: result of func
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(conn)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def close(self):
+        """Close the connections of all threads."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+    def init(self):
+        """Creates the tables and indexes.
+        """
+        LOG.info('Opening SQLite database {}...'.format(self.path))
+        conn = self.connection()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        columns = [row['name'] for row in
+                   conn.execute('PRAGMA table_info(customers)')]
+        if 'applied_ops' not in columns:
+            # Databases created before cart operations had IDs.
+            conn.execute("ALTER TABLE customers ADD COLUMN "
+                         "applied_ops TEXT NOT NULL DEFAULT '[]'")
+
+    # User
+
+    def add_customer_obj(self, customer):
+        """Adds a new customer to DB unless they already exist.
+
+        :param OnlineStoreCustomer customer: the customer to add
+        """
+        self.connection().execute(
+            'INSERT OR IGNORE INTO customers '
+            '(email, first_name, last_name, shopping_cart) '
+            'VALUES (?, ?, ?, ?)',
+            (customer.email, customer.first_name, customer.last_name,
+             json.dumps(customer.shopping_cart or [])))
+
+    def find_customer(self, customer_str):
+        """Finds the customer with an email address.
+
+        :param str customer_str: customer (email addr)
+
+        :returns: customer like a Cloudant customer doc, or None
+        :rtype: dict, None
+        """
+        row = self.connection().execute(
+            'SELECT * FROM customers WHERE email = ?',
+            (customer_str,)).fetchone()
+        if row is None:
+            return None
+        return {
+            '_id': str(row['id']),
+            'type': 'customer',
+            'email': row['email'],
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'shopping_cart': json.loads(row['shopping_cart']),
+        }
+
+    def list_stored_cart(self, customer_str):
+        doc = self.find_customer(customer_str)
+        if doc:
+            return cart.migrate_cart(doc['shopping_cart'])
+        return doc  # None
+
+    def apply_cart_ops(self, customer_str, ops):
+        def update(conn):
+            row = conn.execute(
+                'SELECT shopping_cart, applied_ops FROM customers '
+                'WHERE email = ?', (customer_str,)).fetchone()
+            if row is None:
+                LOG.warning("Customer %s not found." % customer_str)
+                return
+            items = cart.migrate_cart(json.loads(row['shopping_cart']))
+            applied = json.loads(row['applied_ops'])
+            new_ops = cart.unapplied_ops(ops, applied)
+            changed = cart.apply_ops(items, new_ops)
+            remembered = cart.remember_ops(applied, new_ops)
+            # Operations changing nothing need not be remembered.
+            if changed:
+                conn.execute(
+                    'UPDATE customers SET shopping_cart = ?, '
+                    'applied_ops = ? WHERE email = ?',
+                    (json.dumps(items), json.dumps(remembered),
+                     customer_str))
+
+        self.transaction(update)
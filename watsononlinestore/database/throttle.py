@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Client-side throttling of Cloudant requests.
+
+Cloudant plans allow a number of requests per second in each of three
+classes and answer 429 Too Many Requests above that:
+
+    lookup -- reading a document by ID
+    query  -- Mango queries, views and _all_docs
+    write  -- creating, updating and deleting documents
+
+Each class can get its own budget. Requests wait briefly for the budget
+of their class, and requests answered with a 429 are retried with
+backoff, so bursts slow down instead of failing.
+"""
+
+import collections
+import logging
+import random
+import threading
+import time
+
+from watsononlinestore.ratelimit import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+LOOKUP = 'lookup'
+QUERY = 'query'
+WRITE = 'write'
+REQUEST_CLASSES = (LOOKUP, QUERY, WRITE)
+
+# Longest a request waits for its budget before going out anyway.
+MAX_WAIT = 1.0
+# Retries of a request answered with 429.
+RATE_LIMIT_RETRIES = 5
+# First delay after a 429 in seconds. Doubled for every retry, with jitter.
+RATE_LIMIT_BACKOFF = 0.25
+
+
+def parse_budgets(text):
+    """Parse budgets like "lookup=20,query=5,write=10".
+
+    :param str text: comma separated class=requests per second
+    :returns: requests per second by request class
+    :rtype: dict
+    :raise ValueError: for unknown classes or bad numbers
+    """
+    budgets = {}
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, rate = part.partition('=')
+        name = name.strip()
+        if name not in REQUEST_CLASSES:
+            raise ValueError("Unknown Cloudant request class: %s" % name)
+        budgets[name] = float(rate)
+    return budgets
+
+
+def is_rate_limited(exc):
+    """Whether an exception is a 429 response from Cloudant.
+
+    :rtype: bool
+    """
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'status_code', None) == 429
+
+
+class CloudantThrottle(object):
+
+    def __init__(self, budgets=None, max_wait=MAX_WAIT,
+                 retries=RATE_LIMIT_RETRIES, backoff=RATE_LIMIT_BACKOFF,
+                 clock=time.time, sleep=time.sleep):
+        """Per request class budgets, 429 retries and usage counters.
+
+        Shared by everything using the same Cloudant account, so that the
+        budgets hold for the whole process.
+
+        :param dict budgets: requests per second by request class. Classes
+                             without a budget are not limited locally.
+        :param float max_wait: seconds a request waits for its budget
+        :param int retries: retries of a request answered with 429
+        :param float backoff: first delay after a 429 in seconds
+        :param clock: function returning the current time in seconds
+        :param sleep: sleep function, for testing
+        """
+        self.buckets = dict(
+            (name, TokenBucket(rate, max(rate, 1), clock=clock))
+            for name, rate in (budgets or {}).items())
+        self.max_wait = max_wait
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = dict(
+            (name, collections.Counter()) for name in REQUEST_CLASSES)
+
+    def count(self, request_class, counter, value=1):
+        with self.lock:
+            self.counters[request_class][counter] += value
+
+    def acquire(self, request_class, deadline=None):
+        """Wait for the budget of a request class.
+
+        Waits at most max_wait, and never past the deadline. The request
+        then goes out anyway and is retried if Cloudant answers 429.
+
+        :param str request_class: LOOKUP, QUERY or WRITE
+        :param Deadline deadline: deadline of the turn, if any
+        """
+        bucket = self.buckets.get(request_class)
+        if bucket is None:
+            return
+        waited = 0.0
+        while not bucket.try_acquire():
+            wait = bucket.wait_time()
+            limit = self.max_wait - waited
+            if deadline is not None:
+                limit = min(limit, deadline.remaining())
+            if wait > limit:
+                self.count(request_class, 'over_budget')
+                break
+            self.sleep(wait)
+            waited += wait
+        if waited:
+            self.count(request_class, 'throttled')
+            self.count(request_class, 'wait_time', waited)
+
+    def call(self, request_classes, func, *args, **kwargs):
+        """Make Cloudant requests within budget, retrying 429s.
+
+        :param request_classes: class of the request, or a tuple of the
+                                classes of all the requests func makes
+        :param func: function making the requests
+        :param Deadline deadline: keyword only, deadline of the turn.
+                                  Retries stop when it would pass.
+        :returns: result of func
+        """
+        deadline = kwargs.pop('deadline', None)
+        if not isinstance(request_classes, tuple):
+            request_classes = (request_classes,)
+
+        attempt = 0
+        while True:
+            for request_class in request_classes:
+                self.acquire(request_class, deadline)
+                self.count(request_class, 'requests')
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                for request_class in request_classes:
+                    self.count(request_class, 'rate_limited')
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5,
+                                                                       1.5)
+                if attempt >= self.retries or (
+                        deadline is not None and
+                        delay >= deadline.remaining()):
+                    raise
+                LOG.warning("Cloudant rate limit hit (%s), retrying in "
+                            "%.2f seconds." % ('/'.join(request_classes),
+                                               delay))
+                self.sleep(delay)
+                attempt += 1
+
+    def metrics(self):
+        """Counters by request class.
+
+        requests     -- requests made, including retries
+        throttled    -- requests that waited for their budget
+        wait_time    -- seconds spent waiting for budgets
+        over_budget  -- requests sent without waiting for their budget
+        rate_limited -- 429 responses
+
+        :rtype: dict
+        """
+        with self.lock:
+            metrics = {}
+            for name, counter in self.counters.items():
+                metrics[name] = dict(counter)
+                for key in ('requests', 'throttled', 'wait_time',
+                            'over_budget', 'rate_limited'):
+                    metrics[name].setdefault(key, 0)
+            return metrics
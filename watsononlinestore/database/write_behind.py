@@ -0,0 +1,187 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+import json
+import logging
+import os
+import threading
+
+from watsononlinestore.database import cart
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between flushes of buffered cart updates.
+FLUSH_INTERVAL = 0.5
+
+
+class CartWriteBehind(object):
+
+    def __init__(self, store, flush_interval=FLUSH_INTERVAL,
+                 journal_path=None):
+        """Write-behind buffer for shopping cart updates.
+
+        Cart operations are applied to an in-memory copy of the cart right
+        away and queued. A background thread merges each customer's queued
+        operations into a single read-modify-write of their doc every
+        flush_interval seconds. While a customer has buffered operations,
+        the in-memory cart is what list_shopping_cart returns.
+
+        With a journal_path, each operation is appended and fsync'ed to a
+        local journal before record() returns. Operations still in the
+        journal are flushed when the buffer starts, so they survive a
+        crash. The journal is rewritten after every flush to hold only
+        what hasn't been written yet. Each operation gets an ID, which the
+        store keeps with the cart, so operations written just before a
+        crash and replayed from the journal are only applied once.
+
+        A store raising from apply_cart_ops() keeps the operations
+        buffered and journaled, to be written with the next flush.
+
+        :param CloudantOnlineStore store: store doing the actual writes
+        :param float flush_interval: seconds between flushes
+        :param str journal_path: file journaling buffered operations
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # email -> list of ops not yet written
+        self.pending = {}
+        # email -> cart including every op not yet written
+        self.carts = {}
+        self.journal = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Replay the journal, then flush in the background."""
+        if self.journal_path:
+            self.replay_journal()
+            self.journal = open(self.journal_path, 'a')
+        self.flush()
+        self.thread = threading.Thread(target=self.run,
+                                       name="cart-write-behind")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and write everything buffered."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        count = 0
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash may have cut the last line short.
+                    LOG.warning("Skipping bad cart journal line: %r" % line)
+                    continue
+                self.pending.setdefault(entry['email'], []).append(
+                    entry['op'])
+                count += 1
+        if count:
+            LOG.info("Replaying %d buffered cart updates." % count)
+
+    def record(self, email, op):
+        """Buffer a cart operation.
+
+        :param str email: customer email
+        :param list op: operation, see cart.apply_ops()
+        """
+        op = cart.with_op_id(op)
+        with self.lock:
+            known = email in self.carts
+        if not known:
+            # Start from the stored cart. Read outside of the lock.
+            base = self.store.list_stored_cart(email) or []
+        with self.lock:
+            if email not in self.carts:
+                self.carts[email] = base
+            cart.apply_ops(self.carts[email], [op])
+            self.pending.setdefault(email, []).append(op)
+            if self.journal:
+                self.journal.write(json.dumps({'email': email, 'op': op},
+                                              separators=(',', ':')) + '\n')
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+
+    def get_cart(self, email):
+        """The buffered cart, or None if nothing is buffered for email.
+
+        :rtype: list, None
+        """
+        with self.lock:
+            buffered = self.carts.get(email)
+            return copy.deepcopy(buffered) if buffered is not None else None
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered operations of every customer.
+
+        Failed writes stay buffered and are retried with the next flush.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+            if not batch:
+                return
+
+            failed = {}
+            for email, ops in batch.items():
+                try:
+                    self.store.apply_cart_ops(email, ops)
+                except Exception:
+                    LOG.exception("Cart write-behind flush failed:")
+                    failed[email] = ops
+
+            with self.lock:
+                for email, ops in failed.items():
+                    self.pending[email] = ops + self.pending.get(email, [])
+                for email in batch:
+                    if email not in self.pending:
+                        # Everything is written. Read from the store again.
+                        self.carts.pop(email, None)
+                if self.journal:
+                    self.rewrite_journal()
+
+    def rewrite_journal(self):
+        """Replace the journal with the ops still pending.
+
+        Must be called holding the lock.
+        """
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            for email, ops in self.pending.items():
+                for op in ops:
+                    journal.write(json.dumps({'email': email, 'op': op},
+                                             separators=(',', ':')) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal.close()
+        os.rename(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fair scheduling of bot turns between users.
+
+Turns are queued per user and taken round-robin, one user at a time, so a
+user sending many messages waits behind their own messages rather than
+in front of everybody else's. Each user also has a token bucket charged
+with the cost of the turns they take, weighted by the work the turn did:
+a Discovery search costs more than listing the cart. A user in debt is
+skipped until their bucket refills. Queues are bounded, and a user whose
+queue is full is told to slow down and send the message again later.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from watsononlinestore.ratelimit import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+# Tokens a user's bucket refills per second, and holds at most.
+USER_RATE = 0.5
+USER_BURST = 20
+# Turns queued per user, and for all users.
+USER_QUEUE_SIZE = 10
+QUEUE_SIZE = 200
+# Cost of each Conversation call of a turn. A turn makes one, plus one
+# after each handle_* branch.
+CONVERSATION_COST = 1
+# Extra cost of the handle_* branches, by the Discovery and database calls
+# they make. Paging through results already fetched is free.
+BRANCH_COSTS = {
+    'handle_DiscoveryQuery': 4,
+    'handle_similar_products': 1,
+    'handle_more_results': 0,
+    'handle_list_shopping_cart': 1,
+    'handle_add_to_cart': 1,
+    'handle_delete_from_cart': 1,
+}
+OVERFLOW_REPLY = ("You're sending messages faster than I can answer, so "
+                  "I skipped some. Please wait for my answers, then send "
+                  "them again.")
+
+
+def turn_cost(branches):
+    """Tokens a turn costs.
+
+    :param list branches: handle_* branches the turn took
+    :rtype: float
+    """
+    return (CONVERSATION_COST * (1 + len(branches)) +
+            sum(BRANCH_COSTS.get(branch, 0) for branch in branches))
+
+
+class FairScheduler(object):
+
+    def __init__(self, take_turn, reply, rate=USER_RATE, burst=USER_BURST,
+                 user_queue_size=USER_QUEUE_SIZE, queue_size=QUEUE_SIZE,
+                 clock=time.time):
+        """Takes queued turns on a thread, fairly between users.
+
+        :param take_turn: function taking a turn on a Slack batch and
+                          returning its cost, see turn_cost()
+        :param reply: function(channel, text) telling a user their
+                      message was not queued
+        :param float rate: tokens per second refilled per user
+        :param float burst: tokens a user's bucket holds
+        :param int user_queue_size: turns queued per user
+        :param int queue_size: turns queued for all users
+        :param clock: function returning the current time in seconds
+        """
+        self.take_turn = take_turn
+        self.reply = reply
+        self.rate = rate
+        self.burst = burst
+        self.user_queue_size = user_queue_size
+        self.queue_size = queue_size
+        self.clock = clock
+        self.condition = threading.Condition()
+        # Queued turns by user, in the order users are served.
+        self.queues = collections.OrderedDict()
+        self.buckets = {}
+        self.queued = 0
+        self.running = None
+        # Users told to slow down, until their queue empties.
+        self.warned = set()
+        self.thread = None
+
+    def start(self):
+        """Start the thread taking turns."""
+        self.thread = threading.Thread(target=self._run,
+                                       name='fair-scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, user, channel, slack_output):
+        """Queue a turn of a user.
+
+        :param str user: Slack user ID
+        :param str channel: where to answer if the turn is not queued
+        :param list slack_output: Slack events of the turn
+        :returns: False when the user's queue or the whole queue was full
+        :rtype: bool
+        """
+        with self.condition:
+            turns = self.queues.get(user)
+            if turns is None:
+                turns = self.queues[user] = collections.deque()
+            full = (len(turns) >= self.user_queue_size or
+                    self.queued >= self.queue_size)
+            if not full:
+                turns.append(slack_output)
+                self.queued += 1
+                self.condition.notify()
+                return True
+            warn = user not in self.warned
+            if turns:
+                # Not again until their queue empties.
+                self.warned.add(user)
+            else:
+                del self.queues[user]
+        LOG.warning("Turn queue of %s is full, dropped a message.", user)
+        if warn:
+            try:
+                self.reply(channel, OVERFLOW_REPLY)
+            except Exception:
+                LOG.exception("Overflow reply failed:")
+        return False
+
+    def bucket(self, user):
+        bucket = self.buckets.get(user)
+        if bucket is None:
+            bucket = self.buckets[user] = TokenBucket(self.rate, self.burst,
+                                                      clock=self.clock)
+        return bucket
+
+    def next_turn(self, timeout=None):
+        """Wait for the next turn due, taken from the next user in turn.
+
+        Users are served round-robin. A user whose bucket is in debt waits
+        until it refills, without holding up the others.
+
+        :param float timeout: seconds to wait, None for ever
+        :returns: user and Slack events of the turn, or None on timeout
+        :rtype: tuple
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.condition:
+            while True:
+                wait = None
+                for user in list(self.queues):
+                    if not self.queues[user]:
+                        continue
+                    # Only a bucket in debt holds a user back. Turns are
+                    # charged their actual cost once taken.
+                    delay = self.bucket(user).wait_time(0)
+                    if delay <= 0:
+                        # To the back of the round.
+                        turns = self.queues.pop(user)
+                        self.queues[user] = turns
+                        self.queued -= 1
+                        self.running = user
+                        return user, turns.popleft()
+                    wait = delay if wait is None else min(wait, delay)
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+
+    def finish(self, user, cost):
+        """Charge a user for a turn taken.
+
+        :param str user: Slack user ID
+        :param float cost: see turn_cost()
+        """
+        with self.condition:
+            self.bucket(user).charge(cost)
+            self.running = None
+            if not self.queues.get(user):
+                self.queues.pop(user, None)
+                self.warned.discard(user)
+                if self.buckets[user].wait_time(self.burst) <= 0:
+                    # A full bucket is the same as no bucket.
+                    del self.buckets[user]
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            user, slack_output = self.next_turn()
+            cost = CONVERSATION_COST
+            try:
+                cost = self.take_turn(slack_output) or cost
+            except Exception:
+                LOG.exception("Slack event handling exception:")
+            finally:
+                self.finish(user, cost)
+
+    def join(self, timeout=None):
+        """Wait until the queued turns are taken.
+
+        :param float timeout: seconds to wait, None for ever
+        :returns: whether all turns were taken
+        :rtype: bool
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.condition:
+            while self.queued or self.running is not None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+        return True
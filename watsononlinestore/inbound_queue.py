@@ -0,0 +1,225 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Durable queue of the Slack messages the bot has yet to answer.
+
+A message read from Slack otherwise only lives on the call stack until its
+turn is over, so a crash or a deploy loses it. The bot writes the messages
+of each batch to a local SQLite file in one transaction, so that a burst
+costs one sync rather than one per message, and acknowledges each message
+once its turn is over. Messages not acknowledged when the bot stopped are
+replayed when it starts again.
+
+A message is keyed by its channel and Slack ts, which Slack keeps when it
+delivers a message again. Acknowledged keys are kept for RETENTION
+seconds, so a redelivered message is not answered twice.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Seconds acknowledged messages are kept to recognize redeliveries.
+RETENTION = 3600.0
+# Times a message is taken, counting replays, before it is given up in
+# case it is what made the bot crash.
+MAX_ATTEMPTS = 3
+# Acknowledgements between deletions of expired messages.
+PRUNE_EVERY = 1000
+# Seconds to wait for another connection's write lock.
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS inbound ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' key TEXT NOT NULL UNIQUE,'
+    ' event TEXT NOT NULL,'
+    ' received REAL NOT NULL,'
+    ' attempts INTEGER NOT NULL DEFAULT 1,'
+    ' acked REAL)',
+    'CREATE INDEX IF NOT EXISTS inbound_acked ON inbound (acked)',
+)
+
+
+def event_key(event):
+    """Idempotency key of a Slack message: its channel and ts.
+
+    :param dict event: Slack event
+    :returns: the key, or None for events without a ts
+    :rtype: str
+    """
+    ts = event.get('ts')
+    if not ts:
+        return None
+    return '%s:%s' % (event.get('channel', ''), ts)
+
+
+class InboundQueue(object):
+
+    def __init__(self, path, retention=RETENTION, max_attempts=MAX_ATTEMPTS,
+                 timeout=BUSY_TIMEOUT, clock=time.time):
+        """Durable queue of Slack messages, in a SQLite database.
+
+        The messages are in WAL mode with full sync, so a message is on
+        disk once append() returns. Events without a ts, which Slack
+        messages always have, pass through without being stored.
+
+        :param str path: database file, created if it doesn't exist
+        :param float retention: seconds acknowledged messages are kept
+        :param int max_attempts: times a message is taken before it is
+                                 given up
+        :param float timeout: seconds to wait for a locked database
+        :param clock: function returning the current time in seconds
+        """
+        self.path = path
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.clock = clock
+        # One connection shared by the threads taking turns. Writes are
+        # serialized by SQLite anyway.
+        self.lock = threading.Lock()
+        self.conn = None
+        self.acks = 0
+
+    def transaction(self, func):
+        """Run func(conn) in a write transaction, opening the database.
+
+        :returns: result of func
+        """
+        with self.lock:
+            if self.conn is None:
+                # Transactions are started explicitly.
+                self.conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                            isolation_level=None,
+                                            check_same_thread=False)
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=FULL')
+                for statement in SCHEMA:
+                    self.conn.execute(statement)
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(self.conn)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def open(self):
+        """Open the queue and take the messages left from the last run.
+
+        Each replay counts as an attempt, like taking the message when it
+        came in. Messages that already had max_attempts are acknowledged
+        and dropped.
+
+        :returns: Slack events to replay, oldest first
+        :rtype: list
+        """
+        now = self.clock()
+
+        def replay(conn):
+            self._prune(conn, now)
+            rows = conn.execute(
+                'SELECT id, key, event, attempts FROM inbound '
+                'WHERE acked IS NULL ORDER BY id').fetchall()
+            events = []
+            for row_id, key, event, attempts in rows:
+                if attempts >= self.max_attempts:
+                    LOG.error("Giving up Slack message %s after %d "
+                              "attempts.", key, attempts)
+                    conn.execute('UPDATE inbound SET acked = ? '
+                                 'WHERE id = ?', (now, row_id))
+                    continue
+                conn.execute('UPDATE inbound SET attempts = attempts + 1 '
+                             'WHERE id = ?', (row_id,))
+                events.append(json.loads(event))
+            return events
+
+        events = self.transaction(replay)
+        if events:
+            LOG.info("Replaying %d unanswered Slack messages.", len(events))
+        return events
+
+    def append(self, events):
+        """Store the messages of a batch before their turns are taken.
+
+        :param list events: Slack events
+        :returns: the events that weren't already queued, in order
+        :rtype: list
+        """
+        if not events:
+            return []
+        now = self.clock()
+
+        def insert(conn):
+            new = []
+            for event in events:
+                key = event_key(event)
+                if key is not None:
+                    cursor = conn.execute(
+                        'INSERT OR IGNORE INTO inbound '
+                        '(key, event, received) VALUES (?, ?, ?)',
+                        (key, json.dumps(event), now))
+                    if cursor.rowcount != 1:
+                        LOG.debug("Dropping redelivered Slack message %s",
+                                  key)
+                        continue
+                new.append(event)
+            return new
+
+        return self.transaction(insert)
+
+    def ack(self, events):
+        """Mark messages as answered, so they aren't replayed.
+
+        :param list events: Slack events
+        """
+        now = self.clock()
+        keys = [(now, key) for key in map(event_key, events or [])
+                if key is not None]
+        if not keys:
+            return
+
+        def update(conn):
+            conn.executemany(
+                'UPDATE inbound SET acked = ? WHERE key = ? '
+                'AND acked IS NULL', keys)
+            self.acks += len(keys)
+            if self.acks >= PRUNE_EVERY:
+                self.acks = 0
+                self._prune(conn, now)
+
+        self.transaction(update)
+
+    def _prune(self, conn, now):
+        conn.execute('DELETE FROM inbound WHERE acked < ?',
+                     (now - self.retention,))
+
+    def pending(self):
+        """Number of messages not acknowledged yet.
+
+        :rtype: int
+        """
+        return self.transaction(lambda conn: conn.execute(
+            'SELECT COUNT(*) FROM inbound WHERE acked IS NULL').fetchone()[0])
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
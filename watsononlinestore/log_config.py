@@ -0,0 +1,211 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Logging configuration of the bot.
+
+Library modules only create loggers. The application calls configure()
+once, which installs a handler on the root logger that hands records to a
+bounded queue, so that a slow stream never holds up a turn. A background
+listener writes them out. When the queue is full, records are dropped and
+counted rather than waited for.
+
+Payloads like Slack batches, Watson responses and contexts are logged
+wrapped in Payload:
+
+    LOG.debug("watson_response:\\n%s", Payload(watson_response))
+
+Nothing is formatted unless the record is emitted, and then at most
+Payload.limit characters are built, whatever the size of the payload.
+Records with payloads can be sampled, keeping one in LOG_PAYLOAD_SAMPLE of
+each message.
+"""
+
+import collections
+import logging
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    import reprlib
+except ImportError:  # Python 2
+    import repr as reprlib
+
+LOG = logging.getLogger(__name__)
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# Defaults of the LOG_* settings, see configure().
+LEVEL = 'INFO'
+PAYLOAD_LIMIT = 2000
+PAYLOAD_SAMPLE = 1
+QUEUE_SIZE = 10000
+
+
+class Payload(object):
+
+    # Characters of a payload written to the log.
+    limit = PAYLOAD_LIMIT
+
+    def __init__(self, value):
+        """Value formatted for the log only when a record is emitted.
+
+        :param value: e.g. a Watson response or a Slack batch
+        """
+        self.value = value
+
+    def __str__(self):
+        limit = self.limit
+        if isinstance(self.value, str):
+            text = self.value[:limit + 1]
+        else:
+            # Stops walking containers and strings near the limit, so the
+            # cost doesn't grow with the payload.
+            shortened = reprlib.Repr()
+            shortened.maxlevel = 4
+            shortened.maxdict = shortened.maxlist = shortened.maxtuple = 50
+            shortened.maxstring = shortened.maxother = limit
+            text = shortened.repr(self.value)
+        if len(text) > limit:
+            text = text[:limit] + '...(truncated)'
+        return text
+
+
+class PayloadSampler(logging.Filter):
+
+    def __init__(self, every=PAYLOAD_SAMPLE):
+        """Keeps one in every records with a Payload, per message.
+
+        The first record of each message is always kept. Records without
+        payloads pass.
+
+        :param int every: 1 keeps all
+        """
+        super(PayloadSampler, self).__init__()
+        self.every = every
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def filter(self, record):
+        if self.every <= 1 or not isinstance(record.args, tuple):
+            return True
+        if not any(isinstance(arg, Payload) for arg in record.args):
+            return True
+        with self.lock:
+            count = self.counts[record.msg]
+            self.counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class DroppingQueueHandler(logging.Handler):
+
+    def __init__(self, record_queue):
+        """Puts records on a bounded queue without ever blocking.
+
+        Messages are formatted here, like logging.handlers.QueueHandler
+        does, so that payloads are read before the caller changes them.
+
+        :param queue.Queue record_queue: queue a QueueListener reads
+        """
+        super(DroppingQueueHandler, self).__init__()
+        self.queue = record_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+
+    def __init__(self, record_queue, handler):
+        """Writes queued records with a handler, from a daemon thread.
+
+        :param queue.Queue record_queue: queue of log records
+        :param logging.Handler handler: e.g. a StreamHandler
+        """
+        super(QueueListener, self).__init__(name='log-writer')
+        self.daemon = True
+        self.queue = record_queue
+        self.handler = handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        """Write the queued records and stop."""
+        self.queue.put(None)
+        self.join()
+        self.handler.flush()
+
+
+def configure(environ, stream=None):
+    """Configure the root logger from LOG_* environment variables.
+
+    LOG_LEVEL (default INFO, also used when it is not a level name) is
+    the root level, LOG_PAYLOAD_LIMIT the
+    characters logged per payload, LOG_PAYLOAD_SAMPLE keeps one in N
+    records with payloads and LOG_QUEUE_SIZE bounds the records waiting
+    to be written.
+
+    :param environ: runtime environment variables
+    :param stream: where to write, default stderr
+    :returns: the started listener, to stop() on exit
+    :rtype: QueueListener
+    """
+    def number(name, default):
+        try:
+            return int(environ.get(name, default))
+        except ValueError:
+            LOG.error("%s must be a number. Using default value of %s",
+                      name, default)
+            return default
+
+    Payload.limit = number('LOG_PAYLOAD_LIMIT', PAYLOAD_LIMIT)
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+    listener = QueueListener(
+        queue.Queue(number('LOG_QUEUE_SIZE', QUEUE_SIZE)), stream_handler)
+    handler = DroppingQueueHandler(listener.queue)
+    handler.addFilter(PayloadSampler(
+        number('LOG_PAYLOAD_SAMPLE', PAYLOAD_SAMPLE)))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    level = environ.get('LOG_LEVEL', LEVEL).upper()
+    try:
+        root.setLevel(level)
+    except ValueError:
+        root.setLevel(LEVEL)
+        LOG.warning("LOG_LEVEL %s is not a level name. Using %s.",
+                    level, LEVEL)
+    listener.start()
+    return listener
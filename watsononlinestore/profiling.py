@@ -0,0 +1,321 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Opt-in profiling of live bot turns.
+
+Two kinds of profiles are written, both named after the turn and the
+handle_* branches it took:
+
+    turn-<pid>-<n>-<branches>-<ms>ms.pstats     every Nth turn, with
+                                                 cProfile
+    turn-<pid>-<n>-<branches>-<ms>ms.collapsed  turns slower than a
+                                                 threshold (and every Nth
+                                                 turn), from a stack sampler
+
+Collapsed stacks ("root;caller;callee count" lines) feed flame graph
+tools. pstats files open with python -m pstats. Slow turns can only be
+known at their end, so when a threshold is set every turn is sampled,
+which costs a few stack walks per turn instead of cProfile's per-call
+overhead. The helper threads making the turn's calls, see resilience,
+are sampled along with it. At most `keep` files are kept in the
+directory, the oldest being deleted first, so profiling is safe to leave
+on.
+"""
+
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between stack samples of a turn.
+SAMPLE_INTERVAL = 0.005
+# Profile files kept in the directory.
+KEEP = 50
+FILE_PREFIX = 'turn-'
+# Defaults of the PROFILE_* settings, see from_environ().
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                 'watson-online-store-profiles')
+DEFAULT_EVERY = 100
+DEFAULT_SLOW_TURN = 2.0
+TAG_RE = re.compile(r'[^A-Za-z0-9_+-]')
+
+_local = threading.local()
+
+
+def collapse_stack(frame):
+    """Collapsed form of a stack, outermost frame first.
+
+    :param frame: innermost frame
+    :rtype: str
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                   code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def current_turn():
+    """The turn being sampled on this thread, for sampled_as().
+
+    :returns: the sampler and the turn's samples, or None
+    :rtype: tuple
+    """
+    return getattr(_local, 'turn', None)
+
+
+@contextlib.contextmanager
+def sampled_as(turn):
+    """Sample this thread's stacks with those of a turn.
+
+    Used by the helper threads a turn starts, so that the time spent
+    waiting on them shows where it went.
+
+    :param tuple turn: current_turn() of the thread starting this one
+    """
+    if turn is None:
+        yield
+        return
+    sampler, samples = turn
+    thread_id = threading.current_thread().ident
+    previous = current_turn()
+    # Also for the helper threads this one starts.
+    _local.turn = turn
+    sampler.register(thread_id, samples)
+    try:
+        yield
+    finally:
+        sampler.unregister(thread_id)
+        _local.turn = previous
+
+
+def from_environ(environ):
+    """TurnProfiler configured by PROFILE_* environment variables.
+
+    PROFILE_TURNS=true starts with profiling on. Otherwise it stays off
+    until toggled, e.g. by SIGUSR2 in run.py. PROFILE_DIR, PROFILE_EVERY
+    (0 for none), PROFILE_SLOW_TURN (seconds, 0 for none) and PROFILE_KEEP
+    tune it. Bad numbers are logged and replaced by defaults.
+
+    :param environ: runtime environment variables
+    :rtype: TurnProfiler
+    """
+    def number(name, convert, default):
+        try:
+            return convert(environ.get(name, default))
+        except ValueError:
+            LOG.error("%s must be a number. Using default value of %s" %
+                      (name, default))
+            return default
+
+    slow_threshold = number('PROFILE_SLOW_TURN', float, DEFAULT_SLOW_TURN)
+    return TurnProfiler(
+        environ.get('PROFILE_DIR', DEFAULT_DIRECTORY),
+        every=number('PROFILE_EVERY', int, DEFAULT_EVERY),
+        slow_threshold=slow_threshold if slow_threshold > 0 else None,
+        keep=number('PROFILE_KEEP', int, KEEP),
+        enabled=environ.get('PROFILE_TURNS', 'false').lower() == 'true')
+
+
+class StackSampler(object):
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """Samples the stacks of registered threads from a daemon thread.
+
+        :param float interval: seconds between samples
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def register(self, thread_id, samples=None):
+        """Start sampling a thread.
+
+        :param int thread_id: e.g. threading.current_thread().ident
+        :param collections.Counter samples: where to count the samples,
+                                            shared by the threads of a turn
+        :returns: the samples
+        :rtype: collections.Counter
+        """
+        if samples is None:
+            samples = collections.Counter()
+        with self.lock:
+            self.active[thread_id] = samples
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='stack-sampler')
+                self.thread.daemon = True
+                self.thread.start()
+        self.wake.set()
+        return samples
+
+    def unregister(self, thread_id):
+        """Stop sampling a thread.
+
+        :returns: number of samples by collapsed stack
+        :rtype: collections.Counter
+        """
+        with self.lock:
+            return self.active.pop(thread_id, collections.Counter())
+
+    def sample(self):
+        """Take one sample of every registered thread."""
+        frames = sys._current_frames()
+        with self.lock:
+            for thread_id, samples in self.active.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[collapse_stack(frame)] += 1
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if not self.active:
+                    self.wake.clear()
+                    continue
+            time.sleep(self.interval)
+            self.sample()
+
+
+class TurnProfiler(object):
+
+    def __init__(self, directory, every=0, slow_threshold=None, keep=KEEP,
+                 enabled=True, sampler=None, clock=time.time):
+        """Profiles every Nth turn and turns slower than a threshold.
+
+        :param str directory: where profiles are written, created on the
+                              first write
+        :param int every: profile every Nth turn with cProfile, 0 for none
+        :param float slow_threshold: seconds above which a turn's sampled
+                                     stacks are written, None for none
+        :param int keep: profile files kept in the directory
+        :param bool enabled: profile until toggle() is called
+        :param StackSampler sampler: stack sampler, for testing
+        :param clock: function returning the current time in seconds
+        """
+        self.directory = directory
+        self.every = every
+        self.slow_threshold = slow_threshold
+        self.keep = keep
+        self.enabled = enabled
+        self.sampler = sampler or StackSampler()
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.files = None
+
+    def open_directory(self):
+        """Create the directory and list the profiles already in it."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Files of earlier runs count towards the bound.
+        existing = [os.path.join(self.directory, name)
+                    for name in os.listdir(self.directory)
+                    if name.startswith(FILE_PREFIX)]
+        self.files = collections.deque(sorted(existing, key=os.path.getmtime))
+
+    def toggle(self, *args):
+        """Switch profiling on or off. Usable as a signal handler."""
+        self.enabled = not self.enabled
+        LOG.warning("Turn profiling %s." %
+                    ('enabled' if self.enabled else 'disabled'))
+
+    @contextlib.contextmanager
+    def turn(self, branches):
+        """Profile a turn if it is due or turns out slow.
+
+        :param list branches: names of the handle_* branches taken, filled
+                              in by the bot during the turn
+        """
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            self.turns += 1
+            number = self.turns
+        profile = None
+        if self.every and number % self.every == 0:
+            profile = cProfile.Profile()
+        thread_id = threading.current_thread().ident
+        sampling = profile is not None or self.slow_threshold is not None
+        previous = current_turn()
+        if sampling:
+            _local.turn = (self.sampler, self.sampler.register(thread_id))
+        start = self.clock()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            elapsed = self.clock() - start
+            samples = None
+            if sampling:
+                samples = self.sampler.unregister(thread_id)
+                _local.turn = previous
+            slow = (self.slow_threshold is not None and
+                    elapsed >= self.slow_threshold)
+            if profile is not None or slow:
+                try:
+                    self.write(number, branches, elapsed, profile, samples)
+                except Exception:
+                    LOG.exception("Writing the turn profile failed:")
+
+    def write(self, number, branches, elapsed, profile, samples):
+        """Write the profiles of a turn and drop the oldest files.
+
+        :param int number: turn number
+        :param list branches: handle_* branches taken
+        :param float elapsed: seconds the turn took
+        :param cProfile.Profile profile: deterministic profile, if any
+        :param collections.Counter samples: sampled stacks, if any
+        """
+        with self.lock:
+            if self.files is None:
+                self.open_directory()
+        tag = '+'.join(collections.OrderedDict.fromkeys(branches)) or \
+            'handle_message'
+        stem = os.path.join(self.directory, '%s%d-%d-%s-%dms' % (
+            FILE_PREFIX, os.getpid(), number, TAG_RE.sub('_', tag),
+            elapsed * 1000))
+        written = []
+        if profile is not None:
+            profile.dump_stats(stem + '.pstats')
+            written.append(stem + '.pstats')
+        if samples:
+            with open(stem + '.collapsed', 'w') as collapsed:
+                for stack, count in samples.most_common():
+                    collapsed.write('%s %d\n' % (stack, count))
+            written.append(stem + '.collapsed')
+        with self.lock:
+            self.files.extend(written)
+            while len(self.files) > self.keep:
+                try:
+                    os.remove(self.files.popleft())
+                except OSError:
+                    pass
+        LOG.info("Profiled turn %d (%s) in %.3f seconds: %s" %
+                 (number, tag, elapsed, ', '.join(written)))
@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity, clock=time.time):
+        """Thread-safe token bucket.
+
+        Tokens are added continuously at `rate` per second, up to
+        `capacity`. The bucket starts full, so short bursts are allowed.
+
+        :param float rate: tokens added per second
+        :param float capacity: maximum number of tokens held
+        :param clock: function returning the current time in seconds
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if they are available now.
+
+        :param float tokens: number of tokens to take
+        :returns: True if the tokens were taken
+        :rtype: bool
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """Seconds until the given number of tokens will be available.
+
+        :param float tokens: number of tokens wanted
+        :rtype: float
+        """
+        with self.lock:
+            self._refill()
+            missing = tokens - self.tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate
+
+    def charge(self, tokens):
+        """Take tokens, going into debt if there are not enough.
+
+        For costs known only after the fact. wait_time() counts the debt.
+
+        :param float tokens: number of tokens to take
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
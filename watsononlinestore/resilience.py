@@ -0,0 +1,377 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import logging
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from watsononlinestore import profiling
+
+LOG = logging.getLogger(__name__)
+
+# Longest we wait for any single external call.
+DEFAULT_CALL_TIMEOUT = 10.0
+# Consecutive failures that open a circuit breaker.
+FAILURE_THRESHOLD = 5
+# Seconds an open breaker waits before letting a trial call through.
+RESET_TIMEOUT = 30.0
+# First retry delay in seconds. Doubled for every retry, with jitter.
+RETRY_BACKOFF = 0.1
+# Helper threads of call_with_timeout() running at once per dependency,
+# counting calls that timed out and still run in the background.
+MAX_CALLS_IN_FLIGHT = 32
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call could not complete within the time left."""
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+
+class Deadline(object):
+
+    def __init__(self, budget, clock=time.time):
+        """Time budget shared by all the calls made during one turn.
+
+        :param float budget: seconds available from now
+        :param clock: function returning the current time in seconds
+        """
+        self.clock = clock
+        self.end = clock() + budget
+
+    def remaining(self):
+        """Seconds left, never negative.
+
+        :rtype: float
+        """
+        return max(0.0, self.end - self.clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline):
+    """Make a deadline apply to the guarded calls of this thread.
+
+    :param Deadline deadline: deadline for the enclosed block
+    """
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def current_deadline():
+    """The deadline set by deadline_scope() on this thread, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+class _CallSlots(object):
+    """Counts the helper threads of call_with_timeout(), up to a limit."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """Wait up to timeout seconds for a free slot.
+
+        :returns: whether a slot was taken
+        """
+        end = time.time() + timeout
+        with self.condition:
+            while self.in_flight >= self.limit:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT,
+                 max_calls_in_flight=MAX_CALLS_IN_FLIGHT, clock=time.time):
+        """Stop calling a dependency after repeated failures.
+
+        After failure_threshold consecutive failures the breaker opens and
+        calls fail immediately. Once reset_timeout has passed, one trial
+        call is let through: success closes the breaker, failure opens it
+        again.
+
+        The breaker also holds the helper threads of the dependency's
+        calls, see guarded_call(), so a dependency that hangs can't take
+        the threads of the others.
+
+        :param str name: name of the dependency, for logging
+        :param int failure_threshold: failures that open the breaker
+        :param float reset_timeout: seconds before a trial call
+        :param int max_calls_in_flight: helper threads running at once
+        :param clock: function returning the current time in seconds
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.call_slots = _CallSlots(max_calls_in_flight)
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """Whether a call may go through now.
+
+        :rtype: bool
+        """
+        with self.lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                LOG.info("Circuit breaker %s closed." % self.name)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    LOG.warning("Circuit breaker %s opened." % self.name)
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# Helper threads of the calls made without a breaker.
+_call_slots = _CallSlots(MAX_CALLS_IN_FLIGHT)
+
+
+def calls_in_flight(breaker=None):
+    """Helper threads of call_with_timeout() still running.
+
+    :param CircuitBreaker breaker: count those of this dependency, instead
+                                   of those of calls without a breaker
+    :rtype: int
+    """
+    if breaker is not None:
+        return breaker.call_slots.in_flight
+    return _call_slots.in_flight
+
+
+def get_breaker(name):
+    """Get the process wide circuit breaker of a dependency.
+
+    :param str name: dependency name, e.g. "discovery"
+    :rtype: CircuitBreaker
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+        return breaker
+
+
+def call_with_timeout(timeout, func, *args, **kwargs):
+    """Call func, giving up after timeout seconds.
+
+    The SDK clients have no timeout settings of their own, so the call is
+    made on a helper thread. A call that times out is left to finish in
+    the background and its result is discarded. At most
+    MAX_CALLS_IN_FLIGHT helper threads run at once, so calls to a backend
+    that stopped answering can't pile up threads without limit. A helper
+    thread is sampled with the turn that started it, see profiling.
+
+    :param float timeout: seconds to wait
+    :raise DeadlineExceeded: when the call did not finish in time, or no
+                             helper thread was free in time
+    """
+    return _call_in_slot(_call_slots, timeout, func, args, kwargs)
+
+
+def _call_in_slot(call_slots, timeout, func, args, kwargs):
+    start = time.time()
+    if not call_slots.acquire(timeout):
+        raise DeadlineExceeded("%d calls in flight, none finished in %.2f "
+                               "seconds" % (call_slots.limit, timeout))
+    timeout -= time.time() - start
+    results = queue.Queue(maxsize=1)
+    turn = profiling.current_turn()
+
+    def target():
+        try:
+            with profiling.sampled_as(turn):
+                results.put((True, func(*args, **kwargs)))
+        except Exception as e:
+            results.put((False, e))
+        finally:
+            call_slots.release()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    try:
+        ok, value = results.get(timeout=timeout)
+    except queue.Empty:
+        raise DeadlineExceeded("Call timed out after %.2f seconds" % timeout)
+    if ok:
+        return value
+    raise value
+
+
+def guarded_call(breaker, func, *args, **kwargs):
+    """Call a dependency with its breaker, the turn deadline and retries.
+
+    Keyword arguments starting with "guard_" configure the call and are
+    not passed on to func:
+
+    guard_timeout -- seconds allowed per attempt (DEFAULT_CALL_TIMEOUT),
+                     further limited by the current deadline
+    guard_retries -- extra attempts after a failure. Only use for
+                     idempotent reads.
+    guard_answered -- function telling exceptions that are answers of a
+                      working dependency, like a 429, from failures. They
+                      are raised without retries or counting as failures.
+    guard_sleep   -- sleep function, for testing
+
+    :param CircuitBreaker breaker: breaker of the dependency
+    :param func: the call to make
+    :raise CircuitOpenError: when the breaker is open
+    :raise DeadlineExceeded: when the deadline ran out
+    """
+    timeout = kwargs.pop('guard_timeout', DEFAULT_CALL_TIMEOUT)
+    retries = kwargs.pop('guard_retries', 0)
+    answered = kwargs.pop('guard_answered', lambda e: False)
+    sleep = kwargs.pop('guard_sleep', time.sleep)
+    deadline = current_deadline()
+
+    attempt = 0
+    while True:
+        attempt_timeout = timeout
+        if deadline is not None:
+            attempt_timeout = min(timeout, deadline.remaining())
+        # Before allow(), which takes the trial call of a half open breaker
+        # that only record_success() or record_failure() gives back.
+        if attempt_timeout <= 0:
+            raise DeadlineExceeded("No time left to call %s" % breaker.name)
+        if not breaker.allow():
+            raise CircuitOpenError("%s is unavailable" % breaker.name)
+
+        try:
+            # In the dependency's own helper threads.
+            result = _call_in_slot(breaker.call_slots, attempt_timeout,
+                                   func, args, kwargs)
+        except Exception as e:
+            if answered(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+            delay = RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if deadline is not None and delay >= deadline.remaining():
+                raise
+            LOG.warning("Call to %s failed, retrying in %.2f seconds." %
+                        (breaker.name, delay))
+            sleep(delay)
+            attempt += 1
+        else:
+            breaker.record_success()
+            return result
+
+
+def call_parallel(calls):
+    """Make calls concurrently, each within the current deadline.
+
+    Every call runs on its own thread, so the time taken is that of the
+    slowest call rather than the sum. A single call is made directly. The
+    threads are sampled with the current turn, see profiling.
+
+    :param list calls: (func, args) pairs
+    :returns: (True, result) or (False, exception) for each call, in order
+    :rtype: list
+    """
+    deadline = current_deadline()
+    turn = profiling.current_turn()
+    outcomes = [None] * len(calls)
+
+    def run(index, func, args):
+        with deadline_scope(deadline), profiling.sampled_as(turn):
+            try:
+                outcomes[index] = (True, func(*args))
+            except Exception as e:
+                outcomes[index] = (False, e)
+
+    if len(calls) == 1:
+        run(0, *calls[0])
+        return outcomes
+
+    threads = [threading.Thread(target=run, args=(index, func, args))
+               for index, (func, args) in enumerate(calls)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
@@ -0,0 +1,136 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+
+
+class SessionConflict(Exception):
+    """Raised when a session was saved by someone else since it was loaded.
+    """
+
+
+class Session(object):
+
+    def __init__(self, session_id, context=None, customer=None,
+                 response_tuple=None, results_shown=0, paging=False,
+                 version=0, rev=None):
+        """Per-user conversation state kept between bot turns.
+
+        :param str session_id: key of the session (Slack user ID)
+        :param dict context: Watson Conversation context
+        :param dict customer: email, first_name and last_name
+        :param list response_tuple: last formatted Discovery results
+        :param int results_shown: number of those results shown so far
+        :param bool paging: whether the last turn listed those results
+        :param int version: number of times the session has been saved
+        :param str rev: backend specific revision (e.g. Cloudant _rev)
+        """
+        self.session_id = session_id
+        self.context = context or {}
+        self.customer = customer
+        self.response_tuple = response_tuple
+        self.results_shown = results_shown
+        self.paging = paging
+        self.version = version
+        self.rev = rev
+
+    def dumps(self):
+        """Serialize the session data compactly.
+
+        Keys are sorted so that the output can also be compared to tell
+        whether anything changed during a turn.
+
+        :returns: JSON without insignificant whitespace
+        :rtype: str
+        """
+        return json.dumps({'context': self.context,
+                           'customer': self.customer,
+                           'paging': self.paging,
+                           'response_tuple': self.response_tuple,
+                           'results_shown': self.results_shown},
+                          separators=(',', ':'), sort_keys=True)
+
+    @classmethod
+    def loads(cls, session_id, data, version=0, rev=None):
+        """Create a session from data returned by dumps().
+
+        :param str session_id: key of the session
+        :param str data: serialized session data
+        :param int version: stored version of the session
+        :param str rev: backend specific revision
+        :returns: the session
+        :rtype: Session
+        """
+        fields = json.loads(data)
+        return cls(session_id,
+                   context=fields.get('context'),
+                   customer=fields.get('customer'),
+                   response_tuple=fields.get('response_tuple'),
+                   results_shown=fields.get('results_shown', 0),
+                   paging=fields.get('paging', False),
+                   version=version,
+                   rev=rev)
+
+
+class SessionStore(object):
+    """Interface for storing sessions outside of the bot process.
+
+    Backends must implement load() and save(). Saves are versioned: a
+    save of a session whose version is older than the stored one raises
+    SessionConflict instead of silently overwriting a newer turn.
+    """
+
+    def load(self, session_id):
+        """Load a session, or return a new empty one.
+
+        :param str session_id: key of the session
+        :rtype: Session
+        """
+        raise NotImplementedError()
+
+    def save(self, session):
+        """Save a session and bump its version.
+
+        :param Session session: session previously returned by load()
+        :raise SessionConflict: when the stored version has moved on
+        """
+        raise NotImplementedError()
+
+
+class InMemorySessionStore(SessionStore):
+
+    def __init__(self):
+        """Session store local to this process.
+
+        Sessions are kept serialized, so callers never share mutable
+        state with the store.
+        """
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def load(self, session_id):
+        with self.lock:
+            stored = self.sessions.get(session_id)
+        if stored is None:
+            return Session(session_id)
+        version, data = stored
+        return Session.loads(session_id, data, version=version)
+
+    def save(self, session):
+        data = session.dumps()
+        with self.lock:
+            version, _ = self.sessions.get(session.session_id, (0, None))
+            if version != session.version:
+                raise SessionConflict(session.session_id)
+            session.version += 1
+            self.sessions[session.session_id] = (session.version, data)
@@ -0,0 +1,240 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Precomputed "similar products" table.
+
+An offline build step (tools/build_similar_products.py) reads the product
+HTML that is loaded into Discovery, computes TF-IDF vectors of the product
+text and their cosine similarities with NumPy, and keeps the top k
+neighbors of every product. The table is stored as:
+
+    <prefix>.json           products: id, name, url and image
+    <prefix>.neighbors.npy  int32 [products, k] neighbor indexes
+    <prefix>.scores.npy     float32 [products, k] cosine similarities
+
+At runtime the arrays are memory mapped, so a lookup is O(k) and the
+table costs no memory until it is used. NumPy is only needed, and only
+imported, when the table is built or loaded.
+"""
+
+import collections
+import io
+import json
+import logging
+import math
+import os
+import re
+
+from watsononlinestore.database import cart
+
+LOG = logging.getLogger(__name__)
+
+# Neighbors kept per product.
+TOP_K = 5
+# Terms that appear in more than this fraction of products say nothing
+# about similarity (page chrome, navigation, ...).
+MAX_DOC_FREQ = 0.5
+
+TOKEN_RE = re.compile(r'[a-z][a-z0-9]{2,}')
+SCRIPT_RE = re.compile(r'<(script|style)\b.*?</\1>', re.I | re.S)
+TAG_RE = re.compile(r'<[^>]*>')
+TITLE_RE = re.compile(r'<title>(.*?)</title>', re.I | re.S)
+
+
+def import_numpy():
+    """Import NumPy, which is slow to import and only used by the table.
+
+    :returns: the numpy module
+    :raise RuntimeError: when NumPy is not installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("NumPy is needed for similar products.")
+    return numpy
+
+
+def html_text(html):
+    """Visible text of an HTML page.
+
+    :param str html: page
+    :rtype: str
+    """
+    return TAG_RE.sub(' ', SCRIPT_RE.sub(' ', html))
+
+
+def tokenize(text):
+    """Lowercase word tokens of at least three characters.
+
+    :param str text: product text
+    :rtype: list
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def load_products(html_dir, data_source):
+    """Read the products of a data source from its HTML corpus.
+
+    Products are formatted exactly like Discovery results, with
+    WatsonOnlineStore.format_discovery_response, so their IDs match the
+    items added to carts.
+
+    :param str html_dir: directory of product pages, e.g. data/amazon_data_html
+    :param str data_source: "ibm_store" or "amazon"
+    :returns: products with 'id', 'name', 'url', 'image', 'text' and
+              'html', the whole page
+    :rtype: list
+    """
+    # Imported here to keep the runtime lookup free of the bot module.
+    from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+    def page_number(name):
+        stem = os.path.splitext(name)[0]
+        return (0, int(stem)) if stem.isdigit() else (1, stem)
+
+    products = []
+    for name in sorted(os.listdir(html_dir), key=page_number):
+        if not name.endswith('.html'):
+            continue
+        with io.open(os.path.join(html_dir, name), encoding='utf-8',
+                     errors='replace') as page:
+            html = page.read()
+        text = html_text(html)
+        entry = {'html': html, 'text': text}
+        title = TITLE_RE.search(html)
+        if title:
+            entry['extracted_metadata'] = {'title': title.group(1).strip()}
+        formatted = WatsonOnlineStore.format_discovery_response(
+            {'results': [entry]}, data_source)[0]
+        if not formatted['name']:
+            LOG.warning("No product name in %s, skipping." % name)
+            continue
+        products.append({
+            'id': cart.product_id(formatted['url'], formatted['name']),
+            'name': formatted['name'],
+            'url': formatted['url'],
+            'image': formatted['image'],
+            'text': text,
+            'html': html,
+        })
+    return products
+
+
+def tfidf_matrix(texts):
+    """L2 normalized TF-IDF vectors of texts.
+
+    Term frequencies are sublinear (1 + log tf) and terms in more than
+    MAX_DOC_FREQ of the texts are dropped.
+
+    :param list texts: product texts
+    :returns: float32 [texts, terms] matrix
+    :rtype: numpy.ndarray
+    """
+    numpy = import_numpy()
+    counts = [collections.Counter(tokenize(text)) for text in texts]
+    doc_freq = collections.Counter()
+    for counter in counts:
+        doc_freq.update(counter.keys())
+    max_df = max(1, int(MAX_DOC_FREQ * len(texts)))
+    terms = sorted(term for term, df in doc_freq.items() if df <= max_df)
+    columns = dict((term, index) for index, term in enumerate(terms))
+
+    matrix = numpy.zeros((len(texts), len(terms)), dtype=numpy.float32)
+    for row, counter in enumerate(counts):
+        for term, count in counter.items():
+            column = columns.get(term)
+            if column is not None:
+                matrix[row, column] = 1 + math.log(count)
+    df = numpy.array([doc_freq[term] for term in terms], dtype=numpy.float32)
+    matrix *= numpy.log((1.0 + len(texts)) / (1.0 + df)) + 1.0
+    norms = numpy.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    return matrix / norms[:, numpy.newaxis]
+
+
+def top_neighbors(matrix, k=TOP_K):
+    """Most similar rows of every row by cosine similarity.
+
+    :param numpy.ndarray matrix: L2 normalized row vectors
+    :param int k: neighbors per row
+    :returns: int32 neighbor indexes and float32 similarities, both
+              [rows, k] and most similar first
+    :rtype: tuple
+    """
+    numpy = import_numpy()
+    similarity = matrix.dot(matrix.T)
+    numpy.fill_diagonal(similarity, -numpy.inf)
+    k = min(k, max(0, len(matrix) - 1))
+    if k == 0:
+        empty = numpy.zeros((len(matrix), 0))
+        return empty.astype(numpy.int32), empty.astype(numpy.float32)
+    # Only sort the k best of each row.
+    best = numpy.argpartition(-similarity, k - 1, axis=1)[:, :k]
+    best_scores = numpy.take_along_axis(similarity, best, axis=1)
+    order = numpy.argsort(-best_scores, axis=1, kind='stable')
+    neighbors = numpy.take_along_axis(best, order, axis=1)
+    scores = numpy.take_along_axis(best_scores, order, axis=1)
+    return neighbors.astype(numpy.int32), scores.astype(numpy.float32)
+
+
+def build(products, prefix, k=TOP_K):
+    """Compute and save the similar products table.
+
+    :param list products: products from load_products()
+    :param str prefix: path of the table files without extension
+    :param int k: neighbors per product
+    :raise RuntimeError: when NumPy is not installed
+    """
+    numpy = import_numpy()
+    neighbors, scores = top_neighbors(
+        tfidf_matrix([product['text'] for product in products]), k)
+    numpy.save(prefix + '.neighbors.npy', neighbors)
+    numpy.save(prefix + '.scores.npy', scores)
+    with open(prefix + '.json', 'w') as products_file:
+        json.dump([dict((key, product[key])
+                        for key in ('id', 'name', 'url', 'image'))
+                   for product in products], products_file)
+
+
+class SimilarProducts(object):
+
+    def __init__(self, prefix):
+        """Similar products table written by build().
+
+        :param str prefix: path of the table files without extension
+        :raise RuntimeError: when NumPy is not installed
+        """
+        numpy = import_numpy()
+        with open(prefix + '.json') as products_file:
+            self.products = json.load(products_file)
+        self.neighbors = numpy.load(prefix + '.neighbors.npy', mmap_mode='r')
+        self.scores = numpy.load(prefix + '.scores.npy', mmap_mode='r')
+        self.index_by_id = dict(
+            (product['id'], index)
+            for index, product in enumerate(self.products))
+
+    def similar(self, product_id, count=TOP_K):
+        """Products most similar to a product.
+
+        :param str product_id: ID of the product, see cart.product_id()
+        :param int count: maximum number of products
+        :returns: products with 'id', 'name', 'url' and 'image', most
+                  similar first. Empty for unknown products.
+        :rtype: list
+        """
+        index = self.index_by_id.get(product_id)
+        if index is None:
+            return []
+        return [self.products[neighbor]
+                for neighbor, score in zip(self.neighbors[index][:count],
+                                           self.scores[index][:count])
+                if score > 0]
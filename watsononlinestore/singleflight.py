@@ -0,0 +1,81 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        """Share one in-flight call between concurrent callers.
+
+        The first caller for a key runs the function. Callers arriving
+        with the same key while it runs wait for it and get the same
+        result (or exception) instead of making their own call. Nothing
+        is cached once the call has completed.
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = collections.Counter()
+
+    def do(self, key, func, *args, **kwargs):
+        """Run func for key, or join the call already running for key.
+
+        :param key: hashable key identifying identical calls
+        :param func: function to call
+        :returns: result of func
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.stats['calls'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def metrics(self):
+        """Counters of calls made and calls coalesced.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {'calls': self.stats['calls'],
+                    'coalesced': self.stats['coalesced']}
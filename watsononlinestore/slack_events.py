@@ -0,0 +1,304 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import contextlib
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+# Slack rejects requests older than this to prevent replay attacks.
+SIGNATURE_MAX_AGE = 60 * 5
+# How many recent event IDs we remember to drop Slack's retried deliveries.
+SEEN_EVENT_IDS = 1000
+
+
+def compute_slack_signature(signing_secret, timestamp, body):
+    """Compute the Slack request signature for a request body.
+
+    :param str signing_secret: Slack app signing secret
+    :param str timestamp: value of the X-Slack-Request-Timestamp header
+    :param bytes body: raw request body
+    :returns: signature in the form sent by Slack ("v0=<hex>")
+    :rtype: str
+    """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    base = b'v0:' + str(timestamp).encode('utf-8') + b':' + body
+    digest = hmac.new(signing_secret.encode('utf-8'), base,
+                      hashlib.sha256).hexdigest()
+    return 'v0=' + digest
+
+
+def verify_slack_signature(signing_secret, timestamp, body, signature,
+                           now=None):
+    """Verify that a request was signed by Slack.
+
+    :param str signing_secret: Slack app signing secret
+    :param str timestamp: value of the X-Slack-Request-Timestamp header
+    :param bytes body: raw request body
+    :param str signature: value of the X-Slack-Signature header
+    :param float now: current time, for testing
+    :returns: True if the signature is valid and recent
+    :rtype: bool
+    """
+    if not (timestamp and signature):
+        return False
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return False
+    if age > SIGNATURE_MAX_AGE:
+        return False
+    expected = compute_slack_signature(signing_secret, timestamp, body)
+    return hmac.compare_digest(expected, str(signature))
+
+
+def turn_key(events):
+    """Whose turns the events are, which must not interleave.
+
+    :param list events: Slack events
+    :returns: Slack user ID, else channel ID, or None
+    :rtype: str
+    """
+    for event in events or []:
+        if event.get('user') or event.get('channel'):
+            return event.get('user') or event.get('channel')
+    return None
+
+
+class _KeyedLocks(object):
+    """One lock per key, kept only while it is held or waited for."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self.lock:
+            lock, users = self.locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.locks[key]
+                if users == 1:
+                    del self.locks[key]
+                else:
+                    self.locks[key] = (lock, users - 1)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SlackEventsHandler(BaseHTTPRequestHandler):
+    """Request handler for Slack Events API callbacks.
+
+    Only verifies, acknowledges and enqueues. Bot turns run on the
+    worker threads of the owning SlackEventsServer.
+    """
+
+    def do_POST(self):
+        events_server = self.server.events_server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if not verify_slack_signature(
+                events_server.signing_secret,
+                self.headers.get('X-Slack-Request-Timestamp'),
+                body,
+                self.headers.get('X-Slack-Signature')):
+            LOG.warning("Rejected Slack event with invalid signature.")
+            self._reply(401)
+            return
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self._reply(400)
+            return
+
+        if payload.get('type') == 'url_verification':
+            self._reply(200, payload.get('challenge', ''), 'text/plain')
+            return
+
+        if payload.get('type') == 'event_callback':
+            try:
+                submitted = events_server.submit(payload)
+            except Exception:
+                LOG.exception("Storing the Slack event failed:")
+                submitted = False
+            if not submitted:
+                # Let Slack retry later instead of dropping the event.
+                self._reply(503)
+                return
+
+        self._reply(200)
+
+    def _reply(self, status, body='', content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("slack events %s - %s" % (self.address_string(),
+                                            format % args))
+
+
+class SlackEventsServer(object):
+
+    def __init__(self, watson_online_store, signing_secret,
+                 host='', port=3000, workers=1, queue_size=100):
+        """HTTP receiver for the Slack Events API.
+
+        Slack requires an answer within 3 seconds, so each request is
+        verified, stored by WatsonOnlineStore.accept_slack_output (on disk
+        with an inbound queue) and acknowledged right away, and the event
+        is handed to a bounded queue. Worker threads feed the queued
+        events through WatsonOnlineStore.handle_accepted_output, the same
+        path used by the RTM run loop. The turns of different users run
+        on the workers at the same time, those of one user one after the
+        other. Since no socket is held open to Slack, any number of
+        replicas can sit behind a load balancer.
+
+        :param WatsonOnlineStore watson_online_store: bot handling turns
+        :param str signing_secret: Slack app signing secret
+        :param str host: interface to listen on
+        :param int port: port to listen on (0 picks a free port)
+        :param int workers: number of worker threads running bot turns
+        :param int queue_size: events waiting before we answer 503
+        """
+        self.watson_online_store = watson_online_store
+        self.signing_secret = signing_secret
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.httpd = _ThreadingHTTPServer((host, port), SlackEventsHandler)
+        self.httpd.events_server = self
+        self.port = self.httpd.server_address[1]
+
+        # The turns of one user load and save the same session, so they
+        # must not interleave.
+        self.turn_locks = _KeyedLocks()
+        self.seen_lock = threading.Lock()
+        self.seen_event_ids = collections.deque(maxlen=SEEN_EVENT_IDS)
+        # Event IDs being stored, and how many, see submit().
+        self.storing_event_ids = set()
+        self.storing = 0
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name="slack-events-worker-%d" % i)
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def submit(self, payload):
+        """Store and queue an event_callback payload for processing.
+
+        :param dict payload: Events API request body
+        :returns: False if the queue is full or the bot refused the event,
+                  and the event was not taken
+        :rtype: bool
+        :raise Exception: when the bot could not store the event
+        """
+        event_id = payload.get('event_id')
+        with self.seen_lock:
+            if event_id and event_id in self.seen_event_ids:
+                LOG.debug("Dropping retried Slack event %s" % event_id)
+                return True
+            if event_id in self.storing_event_ids:
+                # Slack retried while the event is stored. The retry is
+                # only dropped once that worked.
+                return False
+            # Only this method adds to the queue, so counting the events
+            # being stored leaves room for them.
+            if self.queue.qsize() + self.storing >= self.queue.maxsize:
+                LOG.warning("Slack event queue is full.")
+                return False
+            self.storing += 1
+            if event_id:
+                self.storing_event_ids.add(event_id)
+        try:
+            # Not under seen_lock: with an inbound queue, this waits for
+            # the disk.
+            events = self.watson_online_store.accept_slack_output(
+                [payload.get('event', {})])
+            if events is None:
+                # E.g. the supervisor is draining.
+                return False
+            with self.seen_lock:
+                self.queue.put_nowait(events)
+                if event_id:
+                    self.seen_event_ids.append(event_id)
+            return True
+        finally:
+            with self.seen_lock:
+                self.storing -= 1
+                self.storing_event_ids.discard(event_id)
+
+    def _work(self):
+        while True:
+            events = self.queue.get()
+            try:
+                with self.turn_locks.hold(turn_key(events)):
+                    self.watson_online_store.handle_accepted_output(events)
+            except Exception:
+                LOG.exception("Slack event handling exception:")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        """Start the workers and serve HTTP on a background thread."""
+        for worker in self.workers:
+            worker.start()
+        server_thread = threading.Thread(target=self.httpd.serve_forever,
+                                         name="slack-events-http")
+        server_thread.daemon = True
+        server_thread.start()
+
+    def serve_forever(self):
+        """Main loop of the application in Events API mode."""
+        # make sure DB exists
+        self.watson_online_store.init_store()
+
+        for worker in self.workers:
+            worker.start()
+        LOG.info("Watson Online Store is listening for Slack events "
+                 "on port %d" % self.port)
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop accepting requests."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
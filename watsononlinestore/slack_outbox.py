@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import threading
+import time
+
+from watsononlinestore.ratelimit import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+# Slack allows about one message per second per channel, with short bursts.
+CHANNEL_RATE = 1.0
+CHANNEL_BURST = 3
+# Messages to the same channel queued within this window are sent together.
+COALESCE_WINDOW = 0.1
+# Don't coalesce into posts longer than this.
+MAX_POST_LENGTH = 4000
+# Seconds to wait before posting again after a failed post, or a
+# "ratelimited" answer without Retry-After, doubled for each consecutive
+# failure of the channel up to RETRY_MAX_DELAY.
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Failed posts of a message before it is given up. "ratelimited" answers
+# don't count.
+MAX_ATTEMPTS = 5
+
+
+class SlackOutbox(object):
+
+    def __init__(self, slack_client, rate=CHANNEL_RATE, burst=CHANNEL_BURST,
+                 coalesce_window=COALESCE_WINDOW,
+                 max_post_length=MAX_POST_LENGTH):
+        """Rate limited, coalescing queue for outgoing Slack messages.
+
+        send() only queues the message, so bot turns never wait for Slack.
+        A single dispatcher thread, shared by every worker, posts queued
+        messages while keeping each channel within its token bucket.
+        Consecutive messages for a channel that arrive within the coalesce
+        window are joined into one chat.postMessage call. When Slack
+        answers "ratelimited", the channel is paused for Retry-After
+        seconds and the messages are posted afterwards. Failed posts are
+        retried with backoff, up to MAX_ATTEMPTS times.
+
+        :param SlackClient slack_client: client used to post messages
+        :param float rate: posts per second allowed per channel
+        :param int burst: posts allowed back to back per channel
+        :param float coalesce_window: seconds to wait for more messages
+        :param int max_post_length: longest text built by coalescing
+        """
+        self.slack_client = slack_client
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self.max_post_length = max_post_length
+
+        self.condition = threading.Condition()
+        # channel -> deque of (queued time, text)
+        self.pending = collections.OrderedDict()
+        self.buckets = {}
+        self.paused_until = {}
+        # channel -> consecutive failed posts and "ratelimited" answers
+        self.failures = {}
+        self.throttles = {}
+        self.in_flight = 0
+        self.stats = collections.Counter()
+
+        self.thread = threading.Thread(target=self._dispatch,
+                                       name="slack-outbox")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, channel, text):
+        """Queue a message for a channel.
+
+        :param str channel: Slack channel
+        :param str text: message text
+        """
+        with self.condition:
+            self.pending.setdefault(channel, collections.deque()).append(
+                (time.time(), text))
+            self.stats['queued'] += 1
+            self.condition.notify()
+
+    def metrics(self):
+        """Counters for queued, sent, posts, coalesced, throttled, retried
+        and failed.
+
+        "sent" counts messages and "posts" counts API calls, so
+        sent - posts is the number of calls saved by coalescing.
+
+        :rtype: dict
+        """
+        with self.condition:
+            metrics = dict(self.stats)
+            metrics['pending'] = sum(len(q) for q in self.pending.values())
+        for key in ('queued', 'sent', 'posts', 'coalesced', 'throttled',
+                    'retried', 'failed'):
+            metrics.setdefault(key, 0)
+        return metrics
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been posted.
+
+        :param float timeout: seconds to wait at most
+        :returns: True if the queue was emptied
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.in_flight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+        return True
+
+    def _bucket(self, channel):
+        bucket = self.buckets.get(channel)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[channel] = bucket
+        return bucket
+
+    def _next_ready(self):
+        """Pick a channel that can be posted to now.
+
+        Must be called holding the condition.
+
+        :returns: (channel, None) or (None, seconds to wait)
+        """
+        now = time.time()
+        wait = None
+        for channel, messages in self.pending.items():
+            delay = max(
+                messages[0][0] + self.coalesce_window - now,
+                self.paused_until.get(channel, 0) - now,
+                self._bucket(channel).wait_time())
+            if delay <= 0:
+                return channel, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _take(self, channel):
+        """Remove and join the messages for one post.
+
+        Must be called holding the condition.
+        """
+        messages = self.pending[channel]
+        count = 0
+        text = ''
+        while messages:
+            next_text = messages[0][1]
+            if text and not text.endswith('\n'):
+                next_text = '\n' + next_text
+            if text and len(text) + len(next_text) > self.max_post_length:
+                break
+            text += next_text
+            messages.popleft()
+            count += 1
+        if not messages:
+            del self.pending[channel]
+        return text, count
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                channel, wait = self._next_ready()
+                while channel is None:
+                    self.condition.wait(wait)
+                    channel, wait = self._next_ready()
+                self._bucket(channel).try_acquire()
+                text, count = self._take(channel)
+                self.in_flight += 1
+
+            sent, throttled, retry_after = False, False, None
+            try:
+                sent, throttled, retry_after = self._post(channel, text)
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    self._done(channel, text, count, sent, throttled,
+                               retry_after)
+                    self.condition.notify_all()
+
+    def _done(self, channel, text, count, sent, throttled, retry_after):
+        """Count a post, or queue its text again after a delay.
+
+        Must be called holding the condition.
+        """
+        if sent:
+            self.stats['sent'] += count
+            self.stats['posts'] += 1
+            self.stats['coalesced'] += count - 1
+            self.failures.pop(channel, None)
+            self.throttles.pop(channel, None)
+            return
+        counts = self.throttles if throttled else self.failures
+        counts[channel] = counts.get(channel, 0) + 1
+        if throttled:
+            self.stats['throttled'] += 1
+        elif self.failures[channel] >= MAX_ATTEMPTS:
+            LOG.error("Giving up posting %d messages to channel %s after "
+                      "%d attempts.", count, channel, MAX_ATTEMPTS)
+            self.stats['failed'] += count
+            del self.failures[channel]
+            return
+        else:
+            self.stats['retried'] += 1
+        if retry_after is None:
+            retry_after = min(RETRY_DELAY * 2 ** (counts[channel] - 1),
+                              RETRY_MAX_DELAY)
+        self.paused_until[channel] = time.time() + retry_after
+        # Back to the front, to keep the message order.
+        self.pending.setdefault(channel, collections.deque()).appendleft(
+            (0, text))
+
+    def _post(self, channel, text):
+        """Post a message to Slack.
+
+        :returns: whether it was posted, whether Slack rate limited it,
+                  and the seconds Slack asked to wait, if it did
+        :rtype: tuple
+        """
+        try:
+            result = self.slack_client.api_call("chat.postMessage",
+                                                channel=channel,
+                                                text=text,
+                                                as_user=True)
+        except Exception:
+            LOG.exception("Slack client call exception:")
+            return False, False, None
+
+        if not isinstance(result, dict) or result.get('ok'):
+            return True, False, None
+        if result.get('error') != 'ratelimited':
+            LOG.warning("Posting to channel %s failed: %s",
+                        channel, result.get('error'))
+            return False, False, None
+        # Clients exposing the response headers, or the parsed value.
+        retry_after = result.get('retry_after')
+        if retry_after is None:
+            retry_after = (result.get('headers') or {}).get('Retry-After')
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = None
+        LOG.warning("Slack rate limited channel %s, retrying in %s "
+                    "seconds.", channel, retry_after or 'a few')
+        return False, True, retry_after
@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Timing and concurrent probes of the bot's startup.
+
+The network calls a new instance makes before answering (the Slack bot ID
+lookup, the Conversation workspace lookup and the database check) don't
+depend on each other, so run_probes() makes them at once and startup
+waits for the slowest rather than the sum. StartupTimer collects how long
+each phase took, for the report run.py prints.
+"""
+
+import collections
+import contextlib
+import time
+
+from watsononlinestore import resilience
+
+
+class StartupTimer(object):
+
+    def __init__(self, started=None, clock=time.time):
+        """Seconds spent per startup phase.
+
+        :param float started: when the process started, default now
+        :param clock: function returning the current time in seconds
+        """
+        self.clock = clock
+        self.started = self.last = clock() if started is None else started
+        self.phases = collections.OrderedDict()
+
+    def record(self, name, seconds):
+        """Add seconds to a phase. Phases can be timed in several parts.
+
+        :param str name: e.g. "import" or "probe.store"
+        :param float seconds: time taken
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def lap(self, name):
+        """Record the time since the previous lap, or the start, as a phase.
+
+        :param str name: e.g. "env"
+        """
+        now = self.clock()
+        self.record(name, now - self.last)
+        self.last = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block as (part of) a phase."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def report(self):
+        """One line report, like "import=0.412s env=0.002s total=1.204s".
+
+        :rtype: str
+        """
+        parts = ['%s=%.3fs' % item for item in self.phases.items()]
+        parts.append('total=%.3fs' % (self.clock() - self.started))
+        return ' '.join(parts)
+
+
+def run_probes(timer, probes):
+    """Make startup probes concurrently.
+
+    Each probe is timed as "probe.<name>".
+
+    :param StartupTimer timer: where the timings go
+    :param collections.OrderedDict probes: functions without arguments
+                                           by name
+    :returns: result of each probe by name
+    :rtype: dict
+    :raise Exception: the first failure, once all probes have finished
+    """
+    def timed(name, func):
+        with timer.phase('probe.' + name):
+            return func()
+
+    names = list(probes)
+    outcomes = resilience.call_parallel(
+        [(timed, (name, probes[name])) for name in names])
+    results = {}
+    for name, (ok, value) in zip(names, outcomes):
+        if not ok:
+            raise value
+        results[name] = value
+    return results
@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Periodic INFO log of the counters kept by the bot's components.
+
+Components like CloudantThrottle, CustomerCache, SlackOutbox and
+SingleFlight count what they do in a metrics() dict. A StatsLogger logs
+one line per component with those counters, as JSON, every interval:
+
+    stats slack_outbox {"coalesced": 3, "failed": 0, ...}
+"""
+
+import collections
+import json
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between two rounds of stats lines.
+STATS_INTERVAL = 60
+
+
+class StatsLogger(object):
+
+    def __init__(self, interval=STATS_INTERVAL):
+        """Log the metrics of components on a background thread.
+
+        :param float interval: seconds between two rounds of stats lines
+        """
+        self.interval = interval
+        self.sources = collections.OrderedDict()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, name, metrics):
+        """Log the counters returned by metrics under name.
+
+        :param str name: name of the component in the stats lines
+        :param metrics: function returning a dict of counters
+        """
+        self.sources[name] = metrics
+
+    def log(self):
+        """Log one stats line per component."""
+        for name, metrics in self.sources.items():
+            try:
+                counters = metrics()
+            except Exception:
+                LOG.exception("Stats of %s failed:" % name)
+                continue
+            LOG.info("stats %s %s" % (name, json.dumps(
+                counters, sort_keys=True, separators=(',', ':'))))
+
+    def start(self):
+        """Log the stats every interval, in the background."""
+        self.thread = threading.Thread(target=self.run, name="stats-logger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread, logging the stats a last time."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.log()
+        self.log()
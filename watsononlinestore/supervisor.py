@@ -0,0 +1,421 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run bot turns in several worker processes.
+
+A bot takes one turn at a time and Python runs one thread at a time, so a
+single process uses one core. The Supervisor forks worker processes, each
+with its own bot, and routes every Slack event to a worker by consistent
+hash of its user (or channel). A user always lands on the same worker,
+whose in-memory session store keeps their conversation, so no shared
+session store is needed. Sessions of a worker that crashed are lost,
+like those of a restarted single process.
+
+The supervisor stands in for the bot where events come in: it has the
+handle_slack_output(), accept_slack_output(), handle_accepted_output()
+and init_store() of WatsonOnlineStore, so SlackEventsServer can feed it
+directly, and run_rtm() reads the RTM websocket like
+WatsonOnlineStore.run().
+
+With an inbound queue, the supervisor stores the events before they are
+routed and the workers acknowledge them once answered. Events lost with
+a crashed worker, or not taken before a drain, are routed again when the
+supervisor starts next.
+
+A monitor thread restarts workers that died or stopped sending
+heartbeats. drain() lets workers finish the turns queued to them, then
+stops them. No events are accepted while draining.
+"""
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from watsononlinestore import log_config
+from watsononlinestore.inbound_queue import InboundQueue
+from watsononlinestore.watson_online_store import parse_slack_event
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+# Points per worker on the hash ring. More points spread users more evenly.
+REPLICAS = 100
+# Seconds between health checks, and between heartbeats of idle workers.
+CHECK_INTERVAL = 1.0
+# Seconds without a heartbeat after which a worker is considered hung.
+# Longer than a turn may take (TURN_DEADLINE) plus its startup.
+STALE_AFTER = 60.0
+# Seconds to wait before restarting a worker that keeps crashing, doubled
+# for every crash within RESTART_WINDOW, up to RESTART_MAX_DELAY.
+RESTART_DELAY = 1.0
+RESTART_MAX_DELAY = 60.0
+RESTART_WINDOW = 60.0
+# Event batches waiting per worker.
+QUEUE_SIZE = 1000
+# Seconds drain() waits for workers to finish their queued turns.
+DRAIN_TIMEOUT = 30.0
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        """Consistent hash ring.
+
+        Adding or removing a node only moves the keys of that node.
+
+        :param list nodes: node names, e.g. worker indexes
+        :param int replicas: points per node
+        """
+        self.points = sorted(
+            (_hash('%s-%d' % (node, replica)), node)
+            for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def node_for(self, key):
+        """Node owning a key.
+
+        :param str key: e.g. a Slack user ID
+        """
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+def routing_key(event):
+    """Key routing an event to a worker: its user, or else its channel.
+
+    :param dict event: Slack event
+    :rtype: str
+    """
+    return event.get('user') or event.get('channel') or ''
+
+
+def is_turn(event, bot_id):
+    """Whether an event can start a bot turn, like parse_slack_output().
+
+    :param dict event: Slack event
+    :param str bot_id: Slack user ID of the bot
+    :rtype: bool
+    """
+    return parse_slack_event(event, bot_id)[2] is not None
+
+
+def worker_main(index, make_bot, inbox, heartbeat, inbound_path=None):
+    """Main function of a worker process.
+
+    Takes turns on the batches of its inbox until it gets None. SIGTERM
+    and SIGINT are ignored, so that a signal to the whole process group
+    doesn't cut turns short. The supervisor drains and stops workers.
+
+    :param int index: worker index
+    :param make_bot: function returning a WatsonOnlineStore, or None when
+                     it is misconfigured
+    :param multiprocessing.Queue inbox: event batches
+    :param multiprocessing.Value heartbeat: time of the last sign of life
+    :param str inbound_path: inbound queue of the supervisor, where the
+                             worker acknowledges the events it answered
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The log writer thread of the parent doesn't survive the fork.
+    log_config.configure(os.environ)
+    heartbeat.value = time.time()
+    bot = make_bot()
+    if bot is None:
+        LOG.error("Worker %d could not create the bot.", index)
+        return
+    bot.init_store()
+    if inbound_path:
+        # Only to acknowledge. The supervisor stores and replays events.
+        bot.inbound_queue = InboundQueue(inbound_path)
+    # kill -USR2 <worker pid> switches its turn profiling on or off.
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, bot.profiler.toggle)
+    LOG.info("Worker %d (pid %d) is ready.", index, os.getpid())
+    while True:
+        heartbeat.value = time.time()
+        try:
+            batch = inbox.get(timeout=CHECK_INTERVAL)
+        except queue.Empty:
+            continue
+        if batch is None:
+            break
+        try:
+            bot.handle_accepted_output(batch)
+        except Exception:
+            LOG.exception("Slack event handling exception:")
+    # With fair scheduling, turns may still be queued in the bot.
+    bot.finish_turns(DRAIN_TIMEOUT)
+    LOG.info("Worker %d drained.", index)
+
+
+class Supervisor(object):
+
+    def __init__(self, make_bot, bot_id, workers=2, replicas=REPLICAS,
+                 check_interval=CHECK_INTERVAL, stale_after=STALE_AFTER,
+                 queue_size=QUEUE_SIZE, context=None, inbound_queue=None):
+        """Routes Slack events to worker processes running bots.
+
+        :param make_bot: function returning a WatsonOnlineStore, called in
+                         each worker. Must be picklable where processes
+                         are spawned rather than forked.
+        :param str bot_id: Slack user ID of the bot, to pick the events
+                           for it
+        :param int workers: worker processes
+        :param int replicas: points per worker on the hash ring
+        :param float check_interval: seconds between health checks
+        :param float stale_after: seconds without a heartbeat before a
+                                  worker is restarted
+        :param int queue_size: event batches waiting per worker
+        :param context: multiprocessing context, default multiprocessing
+        :param InboundQueue inbound_queue: keeps events until a worker
+                                           answered them, see
+                                           inbound_queue
+        """
+        self.make_bot = make_bot
+        self.bot_id = bot_id
+        self.check_interval = check_interval
+        self.stale_after = stale_after
+        self.context = context or multiprocessing
+        self.ring = HashRing(range(workers), replicas)
+        self.queue_size = queue_size
+        self.inbound_queue = inbound_queue
+        self.inboxes = [None] * workers
+        self.heartbeats = [self.context.Value('d', 0.0)
+                           for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = [[] for _ in range(workers)]
+        self.not_before = [0.0] * workers
+        self.lock = threading.Lock()
+        self.draining = False
+        self.stopping = threading.Event()
+        self.monitor = None
+
+    def start(self):
+        """Start the workers and the monitor thread.
+
+        Events of the inbound queue that were not answered before the
+        last stop are routed first.
+        """
+        for index in range(len(self.processes)):
+            self.spawn(index)
+        self.monitor = threading.Thread(target=self._monitor,
+                                        name='supervisor-monitor')
+        self.monitor.daemon = True
+        self.monitor.start()
+        if self.inbound_queue is not None:
+            self.handle_accepted_output(self.inbound_queue.open())
+
+    def spawn(self, index):
+        """Start the process of a worker."""
+        # A new inbox, since a killed worker may hold the lock of its old
+        # one. Turns queued to a crashed worker are lost with it, or with
+        # an inbound queue, routed again on the next start.
+        self.inboxes[index] = self.context.Queue(self.queue_size)
+        self.heartbeats[index].value = time.time()
+        inbound_path = None
+        if self.inbound_queue is not None:
+            inbound_path = self.inbound_queue.path
+        process = self.context.Process(
+            target=worker_main, name='wos-worker-%d' % index,
+            args=(index, self.make_bot, self.inboxes[index],
+                  self.heartbeats[index], inbound_path))
+        process.start()
+        self.processes[index] = process
+        LOG.info("Started worker %d (pid %d).", index, process.pid)
+
+    def route(self, event):
+        """Index of the worker taking the turns of an event's user.
+
+        :param dict event: Slack event
+        :rtype: int
+        """
+        return self.ring.node_for(routing_key(event))
+
+    def handle_slack_output(self, slack_output):
+        """Queue the events of a batch to their workers.
+
+        :param list slack_output: Slack events (RTM read or Events API)
+        """
+        events = self.accept_slack_output(slack_output)
+        if events is None:
+            LOG.warning("Draining, ignored %d Slack events.",
+                        len(slack_output or []))
+            return
+        self.handle_accepted_output(events)
+
+    def accept_slack_output(self, slack_output):
+        """Store the events of a batch that can start a turn.
+
+        Other events are dropped here rather than sent to a worker.
+
+        :param list slack_output: Slack events (RTM read or Events API)
+        :returns: the events to route, without redelivered messages, or
+                  None while draining, for Slack to send them again
+        :rtype: list
+        :raise Exception: when the events could not be stored
+        """
+        if self.draining:
+            return None
+        events = [event for event in slack_output or []
+                  if is_turn(event, self.bot_id)]
+        if self.inbound_queue is not None:
+            events = self.inbound_queue.append(events)
+        return events
+
+    def handle_accepted_output(self, slack_output):
+        """Queue events from accept_slack_output() to their workers.
+
+        Each worker gets its events as one batch. Events that can't be
+        queued stay in the inbound queue, if any, until the next start.
+
+        :param list slack_output: events from accept_slack_output()
+        """
+        batches = {}
+        for event in slack_output or []:
+            batches.setdefault(self.route(event), []).append(event)
+        dropped = 'dropped'
+        if self.inbound_queue is not None:
+            dropped = 'kept for the next start'
+        if batches and self.draining:
+            LOG.warning("Draining, %s %d Slack events.", dropped,
+                        sum(len(batch) for batch in batches.values()))
+            return
+        for index, batch in batches.items():
+            try:
+                self.inboxes[index].put_nowait(batch)
+            except queue.Full:
+                LOG.warning("Worker %d is backed up, %s %d Slack events.",
+                            index, dropped, len(batch))
+
+    def init_store(self):
+        """Nothing to do, every worker makes sure the DB exists."""
+
+    def check(self, now=None):
+        """Restart workers that died or hung.
+
+        :param float now: current time, for testing
+        :returns: indexes of the restarted workers
+        :rtype: list
+        """
+        now = now or time.time()
+        restarted = []
+        with self.lock:
+            if self.draining:
+                return restarted
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    age = now - self.heartbeats[index].value
+                    if age < self.stale_after:
+                        continue
+                    LOG.error("Worker %d (pid %d) sent no heartbeat for "
+                              "%.0f seconds, killing it.",
+                              index, process.pid, age)
+                    self._kill(process)
+                if now < self.not_before[index]:
+                    continue
+                LOG.error("Worker %d (pid %s) exited with code %s, "
+                          "restarting it.", index, process.pid,
+                          process.exitcode)
+                recent = [at for at in self.restarts[index]
+                          if now - at < RESTART_WINDOW]
+                self.restarts[index] = recent + [now]
+                # Back off from workers crashing over and over.
+                self.not_before[index] = now + min(
+                    RESTART_DELAY * 2 ** len(recent), RESTART_MAX_DELAY)
+                self.spawn(index)
+                restarted.append(index)
+        return restarted
+
+    def status(self):
+        """Health of the workers.
+
+        :returns: 'index', 'pid', 'alive', 'heartbeat_age' (seconds) and
+                  'restarts' of each worker
+        :rtype: list
+        """
+        now = time.time()
+        return [{'index': index,
+                 'pid': process.pid,
+                 'alive': process.is_alive(),
+                 'heartbeat_age': round(now - self.heartbeats[index].value,
+                                        3),
+                 'restarts': len(self.restarts[index])}
+                for index, process in enumerate(self.processes)]
+
+    def _monitor(self):
+        while not self.stopping.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("Worker health check failed:")
+
+    @staticmethod
+    def _kill(process):
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.join()
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Let workers finish their queued turns, then stop them.
+
+        New events are refused from now on, see accept_slack_output().
+        Workers still busy after the timeout are killed.
+
+        :param float timeout: seconds to wait for all workers
+        :returns: whether every worker finished in time
+        :rtype: bool
+        """
+        with self.lock:
+            self.draining = True
+        self.stopping.set()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.time() + timeout
+        drained = True
+        for index, process in enumerate(self.processes):
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                LOG.error("Worker %d did not drain in time, killing it.",
+                          index)
+                self._kill(process)
+                drained = False
+        return drained
+
+    def run_rtm(self, slack_client, delay=0.5):
+        """Read the RTM websocket and route events, until drained.
+
+        :param slack_client: SlackClient of the bot
+        :param float delay: seconds between reads
+        """
+        if not slack_client.rtm_connect():
+            LOG.warning("Connection failed. Invalid Slack token or bot ID?")
+            return
+        LOG.info("Watson Online Store supervisor is connected with %d "
+                 "workers.", len(self.processes))
+        while not self.draining:
+            self.handle_slack_output(slack_client.rtm_read())
+            time.sleep(delay)
@@ -0,0 +1,257 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Micro-benchmarks of the functions on the bot's hot paths.
+
+Every benchmark is a generator registered with @benchmark that prepares
+its data, yields the call to time and then cleans up. run() times each call
+like timeit, keeping the best of a few repeats, and compare() checks the
+results against a stored baseline (benchmark_baseline.json), so that
+slowdowns show up in review.
+
+Timings depend on the machine. Refresh the baseline on the machine that
+compares against it, with tools/benchmark.py --save.
+"""
+
+import collections
+import json
+import os
+import timeit
+
+import mock
+
+from watsononlinestore.database import cart
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import OnlineStoreCustomer
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+BASELINE_PATH = os.path.join(os.path.dirname(__file__),
+                             'benchmark_baseline.json')
+# A benchmark regresses when it is this much slower than its baseline.
+REGRESSION_THRESHOLD = 0.25
+# Timing repeats. The fastest one is kept, as the least disturbed.
+REPEAT = 5
+# Minimum seconds per repeat. Calls are looped until it is reached.
+MIN_TIME = 0.05
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(func):
+    """Register a benchmark.
+
+    The generator function prepares the benchmark and yields a function
+    without arguments doing the work to time. Code after the yield runs
+    once the timing is done.
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def make_bot(online_store=None):
+    return WatsonOnlineStore('UBENCH',
+                             fakes.FakeSlackClient(),
+                             fakes.FakeConversation(),
+                             None,
+                             online_store or fakes.FakeOnlineStore())
+
+
+def discovery_results(data_source):
+    html_dir = {'amazon': 'amazon_data_html',
+                'ibm_store': 'ibm_store_html'}[data_source]
+    discovery = fakes.FakeDiscovery(os.path.join(DATA_DIR, html_dir),
+                                    data_source)
+    return {'results': [entry for entry, _, _ in discovery.pages]}
+
+
+@benchmark
+def format_discovery_response_amazon():
+    response = discovery_results('amazon')
+    count = len(response['results'])
+    yield lambda: WatsonOnlineStore.format_discovery_response(
+        response, 'amazon', keep_count=count)
+
+
+@benchmark
+def format_discovery_response_ibm_store():
+    response = discovery_results('ibm_store')
+    count = len(response['results'])
+    yield lambda: WatsonOnlineStore.format_discovery_response(
+        response, 'ibm_store', keep_count=count)
+
+
+@benchmark
+def parse_slack_output_batch():
+    bot = make_bot()
+    # A busy RTM read: channel chatter and profile changes, with the
+    # message for the bot last.
+    events = [{'type': 'message', 'text': 'chatter %d' % i,
+               'channel': 'C%d' % i, 'user': 'U%d' % i} for i in range(1000)]
+    events += [{'type': 'user_change', 'user_profile': {}, 'text': '',
+                'user': 'U1', 'channel': 'C1'}] * 200
+    events.append({'type': 'message', 'text': '%s show me hats' % bot.at_bot,
+                   'channel': 'C1', 'user': 'U1'})
+    yield lambda: bot.parse_slack_output(events)
+
+
+@benchmark
+def context_merge_growing():
+    bot = make_bot()
+    context = dict(('key%d' % i, 'value %d' % i) for i in range(500))
+    update = {'discovery_result': 'x' * 2000, 'cart_item': '3'}
+    yield lambda: bot.context_merge(context, update)
+
+
+@benchmark
+def list_shopping_cart_render():
+    store = fakes.FakeOnlineStore()
+    items = [cart.new_cart_item('Product %d' % i,
+                                'http://p/ProductDetail.aspx?pid=%06d' % i,
+                                added=0) for i in range(200)]
+    store.add_customer_obj(OnlineStoreCustomer(
+        email='e@mail', first_name='First', last_name='Last',
+        shopping_cart=items))
+    bot = make_bot(store)
+    bot.customer = OnlineStoreCustomer(email='e@mail')
+    bot.recommendations = []
+
+    def render():
+        bot.context = {}
+        bot.handle_list_shopping_cart()
+    yield render
+
+
+def cloudant_store(cart_size):
+    """CloudantOnlineStore on a fake database of 50 customers.
+
+    The first customer has cart_size items in their cart. Document and
+    Query are patched until the generator is closed.
+    """
+    patchers = [mock.patch.object(cloudant_online_store, 'Document',
+                                  fakes.FakeDocument),
+                mock.patch.object(cloudant_online_store, 'Query',
+                                  fakes.fake_query)]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        store = cloudant_online_store.CloudantOnlineStore(
+            fakes.FakeCloudantClient(), 'bench')
+        store.init()
+        for i in range(50):
+            items = []
+            if i == 0:
+                items = [cart.new_cart_item('Product %d' % n,
+                                            'http://p/%d' % n, added=0)
+                         for n in range(cart_size)]
+            store.add_customer_obj(OnlineStoreCustomer(
+                email='c%d@mail' % i, first_name='First', last_name='Last',
+                shopping_cart=items))
+        yield store
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+
+
+@benchmark
+def cloudant_find_customer():
+    for store in cloudant_store(20):
+        yield lambda: store.find_customer('c0@mail')
+
+
+@benchmark
+def cloudant_add_to_cart():
+    item = cart.new_cart_item('Product 0', 'http://p/0', added=0)
+    for store in cloudant_store(20):
+        yield lambda: store.add_to_shopping_cart('c0@mail', item)
+
+
+def time_call(func, repeat=REPEAT, min_time=MIN_TIME):
+    """Best seconds per call of func.
+
+    :param func: function without arguments
+    :param int repeat: timing repeats
+    :param float min_time: minimum seconds per repeat
+    :returns: seconds per call and calls per repeat
+    :rtype: float, int
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        seconds = timer.timeit(number)
+        if seconds >= min_time:
+            break
+        number *= 2 if seconds > min_time / 10 else 10
+    best = min([seconds] + timer.repeat(repeat - 1, number))
+    return best / number, number
+
+
+def run(names=None, repeat=REPEAT, min_time=MIN_TIME):
+    """Run benchmarks.
+
+    :param list names: benchmarks to run, default all
+    :param int repeat: timing repeats
+    :param float min_time: minimum seconds per repeat
+    :returns: 'seconds' per call and 'number' of calls by benchmark
+    :rtype: dict
+    """
+    results = collections.OrderedDict()
+    for name in names or BENCHMARKS:
+        setup = BENCHMARKS[name]()
+        try:
+            seconds, number = time_call(next(setup), repeat, min_time)
+        finally:
+            setup.close()
+        results[name] = {'seconds': seconds, 'number': number}
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    """Stored results, or {} when there is no baseline yet.
+
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compare results with a baseline.
+
+    :param dict results: from run()
+    :param dict baseline: from load_baseline()
+    :param float threshold: fraction slower than the baseline that counts
+                            as a regression, e.g. 0.25 for 25%
+    :returns: 'seconds', 'baseline', 'ratio' and 'regressed' by benchmark.
+              Benchmarks without a baseline have ratio None.
+    :rtype: dict
+    """
+    comparison = collections.OrderedDict()
+    for name, result in results.items():
+        base = baseline.get(name, {}).get('seconds')
+        ratio = result['seconds'] / base if base else None
+        comparison[name] = {
+            'seconds': result['seconds'],
+            'baseline': base,
+            'ratio': ratio,
+            'regressed': ratio is not None and ratio > 1 + threshold,
+        }
+    return comparison
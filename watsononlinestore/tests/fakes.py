@@ -0,0 +1,322 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process fakes of Slack, Conversation, Discovery and Cloudant.
+
+The fakes answer like the real services closely enough to drive the bot
+through whole shopping sessions, and can sleep to simulate the latency of
+the network and the service.
+
+CloudantOnlineStore can run against FakeCloudantClient once its Document
+and Query classes are patched with FakeDocument and fake_query.
+"""
+
+import copy
+import io
+import os
+import random
+import re
+import threading
+import time
+
+from requests.exceptions import HTTPError
+
+from watsononlinestore import similar_products
+from watsononlinestore.database import cart
+from watsononlinestore.database.online_store import OnlineStore
+
+SEARCH_RE = re.compile(r'^(?:show me|search for|search|find) (.+)$')
+ADD_RE = re.compile(r'^add (\d+)$')
+DELETE_RE = re.compile(r'^(?:delete|remove) (\d+)$')
+LIST_REQUESTS = ('list', 'cart', 'show my cart')
+GREETINGS = ('hi', 'hello', 'hey')
+
+
+class Latency(object):
+
+    def __init__(self, mean=0.0, jitter=0.0, sleep=time.sleep):
+        """Simulated service latency.
+
+        :param float mean: average seconds per call
+        :param float jitter: calls take mean +/- jitter seconds, uniformly
+        :param sleep: sleep function, for testing
+        """
+        self.mean = mean
+        self.jitter = jitter
+        self.sleep = sleep
+
+    def __call__(self):
+        seconds = self.mean + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            self.sleep(seconds)
+
+
+NO_LATENCY = Latency()
+
+
+class FakeSlackClient(object):
+
+    def __init__(self, latency=NO_LATENCY):
+        """Slack client answering users.info and recording posts.
+
+        :param Latency latency: latency of every API call
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.posts = []
+
+    def api_call(self, method, **kwargs):
+        self.latency()
+        if method == 'users.info':
+            user = kwargs['user']
+            return {'ok': True, 'user': {'id': user, 'profile': {
+                'email': '%s@example.com' % user.lower(),
+                'first_name': 'First', 'last_name': user}}}
+        if method == 'chat.postMessage':
+            with self.lock:
+                self.posts.append((kwargs['channel'], kwargs['text']))
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown_method'}
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        return []
+
+
+class FakeConversation(object):
+
+    def __init__(self, latency=NO_LATENCY, workspace_id='fake-workspace'):
+        """Conversation client with a small scripted dialog.
+
+        Understands greetings, "show me <query>", "add <n>", "list" and
+        "delete <n>". Like the real workspace, it sets the context fields
+        the bot acts on, and reports the outcome when the bot calls back
+        without waiting for the user.
+
+        :param Latency latency: latency of every message call
+        :param str workspace_id: ID of the only workspace
+        """
+        self.latency = latency
+        self.workspace_id = workspace_id
+
+    def list_workspaces(self):
+        return {'workspaces': [{'workspace_id': self.workspace_id,
+                                'name': 'watson-online-store'}]}
+
+    def message(self, workspace_id, message_input, context=None):
+        self.latency()
+        context = dict(context or {})
+        text = ' '.join(message_input.get('text', '').lower().split())
+
+        if context.pop('pending', None):
+            # The bot handled the action and calls back for the reply.
+            output = context.get('discovery_result')
+            if context.get('shopping_cart') not in (None, 'list'):
+                # The formatted cart, or the customer's empty cart list.
+                output = context['shopping_cart'] or output
+            for key in ('discovery_string', 'discovery_result',
+                        'shopping_cart', 'cart_item'):
+                context[key] = ''
+            return self.reply(output or 'Done.', context)
+
+        search = SEARCH_RE.match(text)
+        add = ADD_RE.match(text)
+        delete = DELETE_RE.match(text)
+        if text in GREETINGS:
+            return self.reply('Hello! What are you shopping for?', context)
+        if search:
+            context.update(discovery_string=search.group(1), pending=True)
+            return self.reply('Let me look.', context)
+        if add:
+            context.update(shopping_cart='add', cart_item=add.group(1),
+                           pending=True)
+            return self.reply('Adding it.', context)
+        if delete:
+            context.update(shopping_cart='delete', cart_item=delete.group(1),
+                           pending=True)
+            return self.reply('Removing it.', context)
+        if text in LIST_REQUESTS:
+            context.update(shopping_cart='list', pending=True)
+            return self.reply('Your cart:', context)
+        return self.reply("Sorry, I didn't get that.", context)
+
+    @staticmethod
+    def reply(text, context):
+        return {'output': {'text': [text]}, 'context': context}
+
+
+class FakeDiscovery(object):
+
+    def __init__(self, html_dir, data_source, latency=NO_LATENCY):
+        """Discovery client searching product HTML in memory.
+
+        Results look like real Discovery results, with the page HTML and
+        text, so the bot formats them as it would in production.
+
+        :param str html_dir: directory of product pages, e.g.
+                             data/amazon_data_html
+        :param str data_source: "ibm_store" or "amazon"
+        :param Latency latency: latency of every query
+        """
+        self.latency = latency
+        self.data_source = data_source
+        self.pages = []
+        for name in sorted(os.listdir(html_dir)):
+            if not name.endswith('.html'):
+                continue
+            with io.open(os.path.join(html_dir, name), encoding='utf-8',
+                         errors='replace') as page:
+                html = page.read()
+            text = similar_products.html_text(html)
+            entry = {'id': name, 'html': html, 'text': text}
+            title = similar_products.TITLE_RE.search(html)
+            if title:
+                entry['extracted_metadata'] = {'title': title.group(1).strip()}
+            title_tokens = similar_products.tokenize(
+                entry.get('extracted_metadata', {}).get('title', '') or
+                text[:200])
+            self.pages.append((entry, frozenset(title_tokens),
+                               frozenset(similar_products.tokenize(text))))
+
+    def query(self, environment_id, collection_id, query_options):
+        self.latency()
+        words = set(similar_products.tokenize(query_options.get('query', '')))
+        results = []
+        for entry, title_tokens, tokens in self.pages:
+            # Matches in the title count twice as much as in the text.
+            matched = 2 * len(words & title_tokens) + len(words & tokens)
+            if matched:
+                results.append(dict(
+                    entry, score=matched / (3.0 * len(words))))
+        results.sort(key=lambda result: -result['score'])
+        return {'matching_results': len(results),
+                'results': results[:query_options.get('count', 10)]}
+
+
+class FakeOnlineStore(OnlineStore):
+
+    def __init__(self, latency=NO_LATENCY):
+        """Online store keeping customers in memory, like Cloudant.
+
+        :param Latency latency: latency of every request
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.customers = {}
+
+    def init(self):
+        self.latency()
+
+    def add_customer_obj(self, customer_obj):
+        self.latency()
+        with self.lock:
+            if customer_obj.email not in self.customers:
+                self.customers[customer_obj.email] = copy.deepcopy(
+                    customer_obj.get_customer_dict())
+
+    def find_customer(self, customer_str):
+        self.latency()
+        with self.lock:
+            return copy.deepcopy(self.customers.get(customer_str))
+
+    def list_stored_cart(self, customer_str):
+        customer = self.find_customer(customer_str)
+        if customer is None:
+            return None
+        return cart.migrate_cart(customer['shopping_cart'])
+
+    def apply_cart_ops(self, customer_str, ops):
+        # A read and a write, like a Cloudant document update.
+        self.latency()
+        self.latency()
+        with self.lock:
+            customer = self.customers.get(customer_str)
+            if customer is None:
+                return
+            items = cart.migrate_cart(customer['shopping_cart'])
+            if cart.apply_ops(items, ops):
+                customer['shopping_cart'] = copy.deepcopy(items)
+
+
+class FakeDatabase(dict):
+    """Cloudant database kept in a dict of doc ID to doc."""
+
+    def create_document(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault('_id', 'doc%d' % len(self))
+        doc['_rev'] = '1-a'
+        self[doc['_id']] = doc
+
+    def metadata(self):
+        return {'props': {}}
+
+
+class FakeCloudantClient(object):
+    """Cloudant client with a single FakeDatabase."""
+
+    def __init__(self):
+        self.db = FakeDatabase()
+        self.db_names = []
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def all_dbs(self):
+        return list(self.db_names)
+
+    def create_database(self, db_name, **kwargs):
+        self.db_names.append(db_name)
+        return self.db
+
+    def __getitem__(self, db_name):
+        return self.db
+
+
+class FakeDocument(dict):
+    """Replacement for cloudant.document.Document using a FakeDatabase."""
+
+    # Number of saves to answer with 429 Too Many Requests.
+    rate_limited = 0
+
+    def __init__(self, db, doc_id):
+        super(FakeDocument, self).__init__()
+        self.db = db
+        self.doc_id = doc_id
+
+    def fetch(self):
+        self.clear()
+        self.update(copy.deepcopy(self.db[self.doc_id]))
+
+    def save(self):
+        if FakeDocument.rate_limited:
+            FakeDocument.rate_limited -= 1
+            raise HTTPError(response=_RateLimited())
+        self.db[self.doc_id] = copy.deepcopy(dict(self))
+
+
+class _RateLimited(object):
+    status_code = 429
+
+
+def fake_query(db, selector, partition_key=None):
+    """Replacement for cloudant.query.Query using a FakeDatabase."""
+    def query():
+        docs = [copy.deepcopy(doc) for doc in db.values()
+                if all(doc.get(key) == value
+                       for key, value in selector.items() if key != '_id')]
+        return {'docs': docs}
+    return query
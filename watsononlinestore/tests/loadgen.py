@@ -0,0 +1,212 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Load generator driving scripted shopping sessions through the bot.
+
+Virtual users send the messages of a scenario one turn at a time, each
+turn going through WatsonOnlineStore.handle_slack_output, the code the
+RTM run loop and the Events API receiver call for every Slack batch.
+Slack, Conversation, Discovery and the online store are the in-process
+fakes of watsononlinestore.tests.fakes, with configurable latency.
+
+The report gives turns per second and turn latency percentiles for each
+scenario.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+
+from watsononlinestore.session_store import InMemorySessionStore
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+BOT_ID = 'ULOADBOT'
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+HTML_DIRS = {'amazon': 'amazon_data_html', 'ibm_store': 'ibm_store_html'}
+BACKENDS = ('slack', 'conversation', 'discovery', 'cloudant')
+
+# Messages each virtual user sends, by scenario name.
+SCENARIOS = {
+    'shopper': ['hi', 'show me running shoes', 'add 1', 'add 2', 'list',
+                'delete 1', 'list'],
+    'browser': ['hi', 'show me pants', 'more', 'show me shirts', 'add 3',
+                'list'],
+}
+PERCENTILES = (50, 95, 99)
+
+
+def parse_latencies(text):
+    """Parse latencies like "discovery=0.2,slack=0.05~0.02".
+
+    :param str text: comma separated backend=mean seconds, optionally
+                     followed by ~jitter seconds
+    :returns: Latency by backend
+    :rtype: dict
+    :raise ValueError: for unknown backends or bad numbers
+    """
+    latencies = {}
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, value = part.partition('=')
+        name = name.strip()
+        if name not in BACKENDS:
+            raise ValueError("Unknown backend: %s" % name)
+        mean, _, jitter = value.partition('~')
+        latencies[name] = fakes.Latency(float(mean), float(jitter or 0))
+    return latencies
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values.
+
+    :param list values: sorted values
+    :param float percent: 0 to 100
+    :rtype: float
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class LoadTest(object):
+
+    def __init__(self, latencies=None, data_source='amazon', bots=4):
+        """Bots wired to fake backends.
+
+        :param dict latencies: Latency by backend, see parse_latencies()
+        :param str data_source: catalog Discovery searches, "amazon" or
+                                "ibm_store"
+        :param int bots: bot instances taking turns concurrently, like
+                         processes sharing the session and online stores
+        """
+        latencies = latencies or {}
+        no_latency = fakes.NO_LATENCY
+        self.slack_client = fakes.FakeSlackClient(
+            latencies.get('slack', no_latency))
+        self.conversation_client = fakes.FakeConversation(
+            latencies.get('conversation', no_latency))
+        self.discovery_client = fakes.FakeDiscovery(
+            os.path.join(DATA_DIR, HTML_DIRS[data_source]), data_source,
+            latencies.get('discovery', no_latency))
+        self.online_store = fakes.FakeOnlineStore(
+            latencies.get('cloudant', no_latency))
+        self.session_store = InMemorySessionStore()
+        self.bots = queue.Queue()
+        for _ in range(bots):
+            bot = WatsonOnlineStore(BOT_ID,
+                                    self.slack_client,
+                                    self.conversation_client,
+                                    self.discovery_client,
+                                    self.online_store,
+                                    session_store=self.session_store)
+            bot.discovery_data_source = data_source
+            bot.discovery_environment_id = 'load-env'
+            bot.discovery_collection_id = 'load-' + data_source
+            bot.discovery_sources = []
+            bot.discovery_score_filter = 0
+            self.bots.put(bot)
+        self.online_store.init()
+
+    def turn(self, user, message):
+        """Take one turn on the next free bot.
+
+        :param str user: Slack user ID
+        :param str message: what the user says
+        :returns: seconds the turn took, including waiting for a bot, and
+                  whether it raised
+        :rtype: float, bool
+        """
+        event = {'type': 'message', 'text': message, 'user': user,
+                 'channel': 'D' + user}
+        start = time.time()
+        bot = self.bots.get()
+        try:
+            bot.handle_slack_output([event])
+            ok = True
+        except Exception:
+            LOG.exception("Turn of %s failed:" % user)
+            ok = False
+        finally:
+            self.bots.put(bot)
+        return time.time() - start, ok
+
+    def run_scenario(self, name, users, iterations=1):
+        """Run a scenario with concurrent virtual users.
+
+        :param str name: key of SCENARIOS
+        :param int users: virtual users running the scenario at once
+        :param int iterations: times each user runs the scenario
+        :returns: turns, errors, duration, turns_per_second and
+                  latency percentiles in seconds
+        :rtype: dict
+        """
+        messages = SCENARIOS[name]
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def user_session(user):
+            for _ in range(iterations):
+                for message in messages:
+                    seconds, ok = self.turn(user, message)
+                    with lock:
+                        latencies.append(seconds)
+                        if not ok:
+                            errors.append(message)
+
+        threads = [threading.Thread(target=user_session,
+                                    args=('U%s%04d' % (name.upper(), i),))
+                   for i in range(users)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+
+        latencies.sort()
+        report = {
+            'users': users,
+            'turns': len(latencies),
+            'errors': len(errors),
+            'duration': round(duration, 4),
+            'turns_per_second': round(
+                len(latencies) / duration if duration else 0.0, 2),
+            'latency': dict(('p%d' % p, round(percentile(latencies, p), 4))
+                            for p in PERCENTILES),
+        }
+        report['latency']['max'] = round(latencies[-1] if latencies else 0, 4)
+        return report
+
+    def run(self, scenarios, users, iterations=1):
+        """Run scenarios one after the other.
+
+        :param list scenarios: keys of SCENARIOS
+        :param int users: virtual users per scenario
+        :param int iterations: times each user runs its scenario
+        :returns: report of each scenario by name
+        :rtype: dict
+        """
+        return dict((name, self.run_scenario(name, users, iterations))
+                    for name in scenarios)
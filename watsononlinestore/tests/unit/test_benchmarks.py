@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.tests import benchmarks
+from watsononlinestore.tests import fakes
+
+
+class BenchmarksTestCase(unittest.TestCase):
+
+    def test_compare(self):
+        results = {'fast': {'seconds': 0.9}, 'slow': {'seconds': 1.5},
+                   'new': {'seconds': 1.0}}
+        baseline = {'fast': {'seconds': 1.0}, 'slow': {'seconds': 1.0}}
+
+        comparison = benchmarks.compare(results, baseline, threshold=0.25)
+
+        self.assertFalse(comparison['fast']['regressed'])
+        self.assertTrue(comparison['slow']['regressed'])
+        self.assertEqual(1.5, comparison['slow']['ratio'])
+        self.assertIsNone(comparison['new']['ratio'])
+        self.assertFalse(comparison['new']['regressed'])
+        self.assertFalse(benchmarks.compare(
+            results, baseline, threshold=0.6)['slow']['regressed'])
+
+    def test_every_benchmark_runs(self):
+        results = benchmarks.run(repeat=1, min_time=0)
+
+        self.assertEqual(list(benchmarks.BENCHMARKS), list(results))
+        for result in results.values():
+            self.assertGreater(result['seconds'], 0)
+        # Patches of the Cloudant benchmarks are undone.
+        self.assertIsNot(fakes.FakeDocument, cloudant_online_store.Document)
+
+    def test_baseline_round_trip(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'baseline.json')
+        results = {'context_merge_growing': {'seconds': 1e-6, 'number': 10}}
+
+        self.assertEqual({}, benchmarks.load_baseline(path))
+        benchmarks.save_baseline(results, path)
+
+        self.assertEqual(results, benchmarks.load_baseline(path))
+
+    def test_stored_baseline_covers_every_benchmark(self):
+        self.assertEqual(sorted(benchmarks.BENCHMARKS),
+                         sorted(benchmarks.load_baseline()))
@@ -0,0 +1,138 @@
+import json
+import threading
+import unittest
+
+import mock
+
+from watsononlinestore.database import bulk
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.database import partitioning
+from watsononlinestore.database import throttle
+
+
+class FakeDatabase(dict):
+    """Database answering paged Mango queries and _bulk_docs."""
+
+    def __init__(self):
+        super(FakeDatabase, self).__init__()
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.bulk_requests = 0
+
+    def page(self, selector, limit, bookmark=None):
+        self.pages += 1
+        ids = sorted(doc_id for doc_id, doc in self.items()
+                     if doc.get('type') == selector['type'])
+        if bookmark:
+            ids = [doc_id for doc_id in ids if doc_id > bookmark]
+        ids = ids[:limit]
+        return {'docs': [self[doc_id] for doc_id in ids],
+                'bookmark': ids[-1] if ids else bookmark}
+
+    def bulk_docs(self, docs):
+        results = []
+        with self.lock:
+            self.bulk_requests += 1
+            for doc in docs:
+                if doc['_id'] in self:
+                    results.append({'id': doc['_id'], 'error': 'conflict'})
+                else:
+                    self[doc['_id']] = dict(doc, _rev='1-a')
+                    results.append({'id': doc['_id'], 'rev': '1-a'})
+        return results
+
+
+def fake_query(db, selector):
+    return lambda limit, bookmark=None: db.page(selector, limit, bookmark)
+
+
+class Output(list):
+    """File-like object keeping written lines."""
+
+    def write(self, text):
+        self.append(text)
+
+
+def customer(i):
+    return {'_id': 'c%03d' % i, '_rev': '1-a', 'type': 'customer',
+            'email': 'e%d@mail' % i, 'first_name': 'F', 'last_name': 'L',
+            'shopping_cart': []}
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        patcher = mock.patch.object(bulk, 'Query', fake_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store(self, partitioned=False):
+        client = mock.MagicMock()
+        client.__getitem__.return_value = self.db
+        return cloudant_online_store.CloudantOnlineStore(
+            client, 'db', partitioned=partitioned,
+            cloudant_throttle=throttle.CloudantThrottle(
+                sleep=lambda seconds: None))
+
+    def test_export_pages(self):
+        for i in range(7):
+            self.db['c%03d' % i] = customer(i)
+        self.db['session:U1'] = {'_id': 'session:U1', 'type': 'session'}
+        lines = Output()
+
+        self.assertEqual(7, bulk.export_customers(self.store(), lines,
+                                                  page_size=3))
+
+        self.assertEqual(['c%03d' % i for i in range(7)],
+                         [json.loads(line)['_id'] for line in lines])
+        self.assertNotIn('_rev', json.loads(lines[0]))
+        self.assertEqual(3, self.db.pages)
+
+    def test_import_batches(self):
+        lines = [json.dumps(customer(i)) for i in range(10)]
+        lines += ['', json.dumps({'_id': 'x', 'type': 'session'})]
+
+        counts = bulk.import_customers(self.store(), iter(lines),
+                                       batch_size=3, concurrency=2)
+
+        self.assertEqual({'imported': 10, 'skipped': 2, 'conflicts': 0,
+                          'failed': 0}, counts)
+        self.assertEqual(4, self.db.bulk_requests)
+        self.assertEqual('1-a', self.db['c009']['_rev'])
+
+    def test_import_rerun_reports_conflicts(self):
+        lines = [json.dumps(customer(i)) for i in range(3)]
+        bulk.import_customers(self.store(), lines)
+
+        counts = bulk.import_customers(self.store(), lines)
+
+        self.assertEqual(3, counts['conflicts'])
+        self.assertEqual(0, counts['imported'])
+
+    def test_import_into_partitioned_store(self):
+        bulk.import_customers(self.store(partitioned=True),
+                              [json.dumps(customer(1))])
+
+        self.assertEqual([partitioning.customer_doc_id('e1@mail')],
+                         list(self.db))
+
+    def test_import_counts_failed_batches(self):
+        self.db.bulk_docs = mock.Mock(side_effect=Exception('down'))
+
+        counts = bulk.import_customers(
+            self.store(), [json.dumps(customer(i)) for i in range(3)])
+
+        self.assertEqual(3, counts['failed'])
+
+    def test_round_trip(self):
+        for i in range(5):
+            self.db['c%03d' % i] = customer(i)
+        exported = Output()
+        bulk.export_customers(self.store(), exported)
+        self.db.clear()
+
+        bulk.import_customers(self.store(), exported)
+
+        self.assertEqual(sorted('c%03d' % i for i in range(5)),
+                         sorted(self.db))
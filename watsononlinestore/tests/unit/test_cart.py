@@ -0,0 +1,98 @@
+import unittest
+
+import mock
+
+from watsononlinestore.database import cart
+from watsononlinestore.database import cloudant_online_store
+
+CAP_URL = 'http://www.logostore-globalid.us/ProductDetail.aspx?pid=131628'
+MUG_URL = 'http://www.logostore-globalid.us/ProductDetail.aspx?pid=132254'
+
+
+class CartTestCase(unittest.TestCase):
+
+    def test_product_id(self):
+        self.assertEqual('131628', cart.product_id(CAP_URL))
+        self.assertEqual('https://amazon.com/x', cart.product_id(
+            'https://amazon.com/x', 'X'))
+        self.assertEqual('X', cart.product_id('', 'X'))
+
+    def test_migrate_strings(self):
+        old = ['Eye-Bee-M Cap: ' + CAP_URL + '\n',
+               'THINK Mug: ' + MUG_URL + '\n',
+               'Eye-Bee-M Cap: ' + CAP_URL + '\n']
+
+        items = cart.migrate_cart(old)
+
+        self.assertEqual(
+            [('131628', 'Eye-Bee-M Cap', CAP_URL, 2),
+             ('132254', 'THINK Mug', MUG_URL, 1)],
+            [(i['id'], i['name'], i['url'], i['qty']) for i in items])
+
+    def test_migrate_keeps_items(self):
+        item = cart.new_cart_item('THINK Mug', MUG_URL, added=5)
+
+        self.assertEqual([item], cart.migrate_cart([item]))
+        self.assertEqual([], cart.migrate_cart(None))
+
+    def test_add_same_product(self):
+        items = []
+
+        cart.add_item(items, cart.new_cart_item('Cap', CAP_URL))
+        cart.add_item(items, cart.new_cart_item('Cap', CAP_URL))
+
+        self.assertEqual(1, len(items))
+        self.assertEqual(2, items[0]['qty'])
+        self.assertEqual('Cap: ' + CAP_URL + ' (x2)',
+                         cart.format_item(items[0]))
+
+    def test_remove(self):
+        items = [cart.new_cart_item('Cap', CAP_URL),
+                 cart.new_cart_item('Mug', MUG_URL)]
+
+        self.assertTrue(cart.remove_item(items, '131628'))
+        self.assertFalse(cart.remove_item(items, '131628'))
+        self.assertEqual(['132254'], [i['id'] for i in items])
+
+
+class CloudantCartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.doc = {'_id': 'doc1', 'type': 'customer', 'email': 'e@mail',
+                    'shopping_cart': ['Cap: ' + CAP_URL + '\n']}
+        self.db_doc = mock.MagicMock()
+        self.db_doc.__getitem__.side_effect = self.doc.__getitem__
+        self.db_doc.__setitem__.side_effect = self.doc.__setitem__
+        document = mock.patch.object(cloudant_online_store, 'Document')
+        document.start().return_value = self.db_doc
+        self.addCleanup(document.stop)
+        query = mock.patch.object(cloudant_online_store, 'Query')
+        query.start().return_value.return_value = {'docs': [self.doc]}
+        self.addCleanup(query.stop)
+        self.store = cloudant_online_store.CloudantOnlineStore(
+            self.client, 'db')
+
+    def test_list_migrates_without_writing(self):
+        items = self.store.list_shopping_cart('e@mail')
+
+        self.assertEqual(['131628'], [i['id'] for i in items])
+        self.db_doc.save.assert_not_called()
+
+    def test_add_existing_product(self):
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.db_doc.save.assert_called_once_with()
+        self.assertEqual(2, self.doc['shopping_cart'][0]['qty'])
+
+    def test_delete_by_id(self):
+        self.store.delete_item_shopping_cart('e@mail', '131628')
+
+        self.db_doc.save.assert_called_once_with()
+        self.assertEqual([], self.doc['shopping_cart'])
+
+    def test_delete_missing_id(self):
+        self.store.delete_item_shopping_cart('e@mail', 'nope')
+
+        self.db_doc.save.assert_not_called()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from watsononlinestore import cassette
+from watsononlinestore.database import cart
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+
+class CassetteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'session.jsonl.gz')
+        self.writer = cassette.CassetteWriter(self.path)
+
+    def test_record_calls_and_errors(self):
+        client = mock.Mock()
+        client.query.return_value = {'results': [{'html': '<p>x</p>'}]}
+        client.message.side_effect = HTTPError(
+            'Too many', response=mock.Mock(status_code=429))
+        client.rtm_read.return_value = []
+        discovery = cassette.Recorder(client, cassette.DISCOVERY, self.writer)
+        conversation = cassette.Recorder(client, cassette.CONVERSATION,
+                                         self.writer)
+        slack = cassette.Recorder(client, cassette.SLACK, self.writer)
+
+        self.assertEqual(client.query.return_value,
+                         discovery.query(collection_id='c', query_options={}))
+        self.assertRaises(HTTPError, conversation.message, 'hi')
+        self.assertEqual([], slack.rtm_read())
+        self.writer.close()
+
+        entries = cassette.read_cassette(self.path)
+        self.assertEqual(2, len(entries))
+        self.assertEqual(
+            ('discovery', 'query', {'collection_id': 'c', 'query_options': {}},
+             client.query.return_value),
+            (entries[0]['service'], entries[0]['method'],
+             entries[0]['kwargs'], entries[0]['response']))
+        self.assertEqual(['hi'], entries[1]['args'])
+        self.assertEqual(429, entries[1]['error']['status_code'])
+
+    def test_truncated_cassette(self):
+        self.writer.write({'service': 'slack', 'method': 'api_call',
+                           'args': [], 'kwargs': {}, 'response': 1})
+        self.writer.close()
+        with open(self.path, 'rb') as cassette_file:
+            data = cassette_file.read()
+        with open(self.path, 'wb') as cassette_file:
+            cassette_file.write(data[:-8])
+
+        # Reads what it can instead of failing.
+        self.assertTrue(len(cassette.read_cassette(self.path)) <= 1)
+
+    def test_replay_matches_arguments_then_order(self):
+        sleeps = []
+        replayer = cassette.Replayer([
+            {'service': 'discovery', 'method': 'query', 'args': ['a'],
+             'kwargs': {}, 'response': 'A', 'elapsed': 0.2},
+            {'service': 'discovery', 'method': 'query', 'args': ['b'],
+             'kwargs': {}, 'response': 'B', 'elapsed': 0.4},
+            {'service': 'discovery', 'method': 'query', 'args': ['c'],
+             'kwargs': {}, 'error': {'type': 'HTTPError', 'message': 'Busy',
+                                     'status_code': 429}},
+        ], latency_scale=0.5, sleep=sleeps.append)
+        client = replayer.client(cassette.DISCOVERY)
+
+        self.assertEqual('B', client.query('b'))
+        self.assertEqual('A', client.query('x'))
+        with self.assertRaises(cassette.ReplayedError) as raised:
+            client.query('c')
+        self.assertEqual(429, raised.exception.response.status_code)
+        self.assertRaises(cassette.CassetteMiss, client.query, 'a')
+        self.assertEqual([0.2, 0.1], sleeps)
+        self.assertEqual({'matched': 2, 'in_order': 1, 'missed': 1},
+                         dict(replayer.counters))
+
+    def test_strict_replay(self):
+        replayer = cassette.Replayer([
+            {'service': 'slack', 'method': 'api_call', 'args': ['users.info'],
+             'kwargs': {'user': 'U1'}, 'response': {'ok': True}}],
+            strict=True)
+        slack = replayer.client(cassette.SLACK)
+
+        self.assertRaises(cassette.CassetteMiss, slack.api_call,
+                          'users.info', user='U2')
+        self.assertEqual({'ok': True},
+                         slack.api_call('users.info', user='U1'))
+        self.assertEqual([], slack.rtm_read())
+
+    def test_replay_recorded_session(self):
+        # Cart items are stamped with the time they were added, which must
+        # not change between recording and replay.
+        clock = mock.patch.object(cart, 'time',
+                                  mock.Mock(time=lambda: 1508330000))
+        clock.start()
+        self.addCleanup(clock.stop)
+        slack = fakes.FakeSlackClient()
+        store = fakes.FakeOnlineStore()
+        discovery = fakes.FakeDiscovery(
+            os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                         'data', 'amazon_data_html'), 'amazon')
+        self.writer.write_info(bot_id='UBOT')
+
+        def make_bot(slack, conversation, discovery, store):
+            bot = WatsonOnlineStore('UBOT', slack, conversation, discovery,
+                                    store)
+            bot.discovery_data_source = 'amazon'
+            bot.discovery_sources = []
+            return bot
+
+        bot = cassette.Recorder(make_bot(
+            cassette.Recorder(slack, cassette.SLACK, self.writer),
+            cassette.Recorder(fakes.FakeConversation(),
+                              cassette.CONVERSATION, self.writer),
+            cassette.Recorder(discovery, cassette.DISCOVERY, self.writer),
+            cassette.Recorder(store, cassette.STORE, self.writer)),
+            cassette.BOT, self.writer)
+        for text in ('hi', 'show me pants', 'add 2', 'list'):
+            bot.handle_slack_output([{'type': 'message', 'text': text,
+                                      'user': 'U1', 'channel': 'DU1'}])
+        self.writer.close()
+
+        replayer = cassette.Replayer.load(self.path, latency_scale=0)
+        self.assertEqual('UBOT', replayer.info()['bot_id'])
+        replayed = make_bot(*(replayer.client(service) for service in (
+            cassette.SLACK, cassette.CONVERSATION, cassette.DISCOVERY,
+            cassette.STORE)))
+        batches = replayer.event_batches()
+        for batch in batches:
+            replayed.handle_slack_output(batch)
+
+        self.assertEqual(4, len(batches))
+        self.assertEqual(0, replayer.counters['missed'])
+        self.assertEqual(0, replayer.counters['in_order'])
+        self.assertEqual(bot.context, replayed.context)
+        self.assertEqual(bot.response_tuple, replayed.response_tuple)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore import category_index
+from watsononlinestore import similar_products
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'data')
+
+
+def product(name, text='', crumbs=()):
+    html = ('<div id="wayfinding-breadcrumbs_feature_div"><ul>' +
+            ''.join('<li><a href="/b">\n  %s\n</a></li>' % crumb
+                    for crumb in crumbs) + '</ul></div>')
+    return {'id': name, 'name': name, 'url': 'http://p/' + name,
+            'image': '', 'text': text, 'html': html}
+
+
+class CategoryIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'categories.json')
+
+    def test_product_categories(self):
+        self.assertEqual(['cap', 'caps', 'hat', 'hats'],
+                         category_index.product_categories(
+                             product('Cap', 'Product:Cap\n'
+                                            'Category:cap/caps/hat/hats\n'),
+                             'ibm_store'))
+        self.assertEqual(['shoe', 'shoes', 'sneaker', 'sneakers'],
+                         category_index.product_categories(
+                             product('Nike Air Max', crumbs=(
+                                 'Clothing, Shoes &amp; Jewelry', 'Men',
+                                 'Shoes', 'Fashion Sneakers')), 'amazon'))
+        # Product names are not categories.
+        self.assertEqual(['book', 'books'], category_index.product_categories(
+            product('The Year Without Pants', crumbs=('Books', 'Business')),
+            'amazon'))
+
+    def test_category_token(self):
+        self.assertEqual('hats', category_index.category_token(
+            'Show me some hats!'))
+        self.assertEqual('mug', category_index.category_token('mug'))
+        self.assertIsNone(category_index.category_token('blue cotton hats'))
+        self.assertIsNone(category_index.category_token('show me'))
+
+    def test_build_and_lookup(self):
+        category_index.build([
+            ('ibm_store', [product('Cap', 'Category:cap/caps/hat/hats'),
+                           product('Mug', 'Category:mug/mugs/cup/cups'),
+                           product('Think Cap', 'Category:cap/caps')]),
+            ('amazon', [product('Straw Hat', crumbs=('Hats',)),
+                        product('Running Shoes', crumbs=('Shoes',))]),
+        ], self.path)
+        index = category_index.CategoryIndex(self.path)
+
+        self.assertEqual(['Cap', 'Think Cap'],
+                         [p['name'] for p in index.lookup(
+                             'caps', ['ibm_store', 'amazon'])])
+        self.assertEqual(['Running Shoes'],
+                         [p['name'] for p in index.lookup(
+                             'show me shoes', ['amazon', 'ibm_store'])])
+        # "Hats" is not one of the amazon categories.
+        self.assertEqual(['Cap'], [p['name'] for p in index.lookup(
+            'hats', ['amazon', 'ibm_store'])])
+        self.assertEqual(['Cap'], [p['name'] for p in index.lookup(
+            'hat', ['ibm_store'])])
+        self.assertIsNone(index.lookup('shoes', ['ibm_store']))
+        self.assertIsNone(index.lookup('blue hats', ['ibm_store']))
+
+    def test_bundled_ibm_store_markers(self):
+        products = similar_products.load_products(
+            os.path.join(DATA_DIR, 'ibm_store_html'), 'ibm_store')
+        category_index.build([('ibm_store', products)], self.path)
+        index = category_index.CategoryIndex(self.path)
+
+        caps = index.lookup('hats', ['ibm_store'])
+        self.assertEqual(5, len(caps))
+        self.assertTrue(all('Cap' in p['name'] for p in caps))
+        self.assertEqual(5, len(index.lookup('cups', ['ibm_store'])))
+
+    def test_bundled_amazon_breadcrumbs(self):
+        products = similar_products.load_products(
+            os.path.join(DATA_DIR, 'amazon_data_html'), 'amazon')
+        category_index.build([('amazon', products)], self.path)
+        index = category_index.CategoryIndex(self.path)
+
+        pants = index.lookup('pants', ['amazon'])
+        self.assertEqual(8, len(pants))
+        # Not the books with "Pants" in their titles.
+        self.assertFalse([p for p in pants
+                          if 'Books' in p['name'] or 'Kindle' in p['name']])
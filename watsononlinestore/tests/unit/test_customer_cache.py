@@ -0,0 +1,116 @@
+import unittest
+
+import mock
+
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.database import customer_cache
+
+
+def customer(rev, cart=None, email='e@mail'):
+    return {'_id': 'doc1', '_rev': rev, 'type': 'customer', 'email': email,
+            'shopping_cart': cart or []}
+
+
+class CustomerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = customer_cache.CustomerCache(
+            size=2, ttl=60, clock=lambda: self.now)
+
+    def test_get_returns_copies(self):
+        self.cache.put('e@mail', customer('1-a'))
+
+        self.cache.get('e@mail')['shopping_cart'].append('x')
+
+        self.assertEqual([], self.cache.get('e@mail')['shopping_cart'])
+
+    def test_lru_eviction(self):
+        self.cache.put('a', dict(customer('1'), _id='a'))
+        self.cache.put('b', dict(customer('1'), _id='b'))
+        self.cache.get('a')
+        self.cache.put('c', dict(customer('1'), _id='c'))
+
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_ttl(self):
+        self.cache.put('e@mail', customer('1-a'))
+        self.now += 61
+
+        self.assertIsNone(self.cache.get('e@mail'))
+
+    def test_change_refreshes_cached_doc(self):
+        self.cache.put('e@mail', customer('1-a'))
+
+        self.cache.apply_change(customer('2-b', ['item']))
+
+        self.assertEqual(['item'], self.cache.get('e@mail')['shopping_cart'])
+        self.assertEqual(1, self.cache.metrics()['refreshes'])
+
+    def test_change_to_uncached_doc_is_ignored(self):
+        self.cache.apply_change(customer('2-b'))
+
+        self.assertIsNone(self.cache.get('e@mail'))
+
+    def test_delete_invalidates(self):
+        self.cache.put('e@mail', customer('1-a'))
+
+        self.cache.apply_change({'_id': 'doc1', '_rev': '2-b',
+                                 '_deleted': True})
+
+        self.assertIsNone(self.cache.get('e@mail'))
+        self.assertEqual(1, self.cache.metrics()['invalidations'])
+
+
+class ChangesFollowerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.db = self.client.__getitem__.return_value
+        self.db.database_url = 'http://cloudant/db'
+        self.cache = customer_cache.CustomerCache()
+
+    def follower(self):
+        return customer_cache.ChangesFollower(self.client, 'db', self.cache)
+
+    def test_poll_refreshes_and_continues(self):
+        self.cache.put('e@mail', customer('1-a'))
+        self.db.r_session.post.return_value.json.return_value = {
+            'results': [{'id': 'doc1', 'doc': customer('2-b', ['item'])}],
+            'last_seq': '7-xyz'}
+        follower = self.follower()
+
+        self.assertEqual(1, follower.poll())
+
+        self.assertEqual(['item'], self.cache.get('e@mail')['shopping_cart'])
+        params = self.db.r_session.post.call_args[1]['params']
+        self.assertEqual('now', params['since'])
+        self.assertEqual('_selector', params['filter'])
+        follower.poll()
+        params = self.db.r_session.post.call_args[1]['params']
+        self.assertEqual('7-xyz', params['since'])
+
+    def test_restart_follows_from_now(self):
+        self.db.r_session.post.return_value.json.return_value = {
+            'results': [], 'last_seq': '7-xyz'}
+        self.follower().poll()
+
+        # The cache of a new process is empty, older changes don't matter.
+        self.assertEqual('now', self.follower().since)
+
+
+class CachedStoreTestCase(unittest.TestCase):
+
+    @mock.patch.object(cloudant_online_store, 'Query')
+    def test_find_customer_uses_cache(self, query):
+        query.return_value.return_value = {'docs': [customer('1-a')]}
+        cache = customer_cache.CustomerCache()
+        store = cloudant_online_store.CloudantOnlineStore(
+            mock.MagicMock(), 'db', cache=cache)
+
+        store.find_customer('e@mail')
+        store.find_customer('e@mail')
+
+        self.assertEqual(1, query.return_value.call_count)
+        self.assertEqual(1, cache.metrics()['hits'])
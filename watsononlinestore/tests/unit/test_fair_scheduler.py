@@ -0,0 +1,123 @@
+import unittest
+
+import mock
+
+from watsononlinestore import fair_scheduler
+from watsononlinestore.ratelimit import TokenBucket
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def message(user, text='hi'):
+    return [{'type': 'message', 'user': user, 'text': text,
+             'channel': 'D' + user}]
+
+
+class FairSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reply = mock.Mock()
+        self.scheduler = fair_scheduler.FairScheduler(
+            mock.Mock(return_value=1), self.reply, rate=1, burst=10,
+            user_queue_size=3, clock=self.clock)
+
+    def take(self, cost=1):
+        turn = self.scheduler.next_turn(timeout=0)
+        if turn is not None:
+            self.scheduler.finish(turn[0], cost)
+            return turn[1][0]['text']
+
+    def test_round_robin(self):
+        for i in range(3):
+            self.scheduler.submit('USPAM', 'DUSPAM', message('USPAM', i))
+        self.scheduler.submit('UNORMAL', 'DUNORMAL',
+                              message('UNORMAL', 'normal'))
+
+        self.assertEqual([0, 'normal', 1, 2, None],
+                         [self.take() for _ in range(5)])
+
+    def test_bounded_queue_and_overflow_reply(self):
+        results = [self.scheduler.submit('USPAM', 'DUSPAM', message('USPAM'))
+                   for _ in range(5)]
+
+        self.assertEqual([True] * 3 + [False] * 2, results)
+        self.reply.assert_called_once_with('DUSPAM',
+                                           fair_scheduler.OVERFLOW_REPLY)
+        # Warned again once their queue has emptied.
+        while self.take() is not None:
+            pass
+        self.scheduler.user_queue_size = 0
+        self.scheduler.submit('USPAM', 'DUSPAM', message('USPAM'))
+        self.assertEqual(2, self.reply.call_count)
+
+    def test_costly_turns_wait_for_tokens(self):
+        self.scheduler.submit('USPAM', 'DUSPAM', message('USPAM', 'search'))
+        self.scheduler.submit('USPAM', 'DUSPAM', message('USPAM', 'again'))
+        # A search beyond the user's burst puts them 5 tokens in debt.
+        self.assertEqual('search', self.take(cost=15))
+        self.scheduler.submit('UNORMAL', 'DUNORMAL', message('UNORMAL'))
+
+        self.assertEqual(['hi', None], [self.take(), self.take()])
+        self.clock.now += 5
+        self.assertEqual('again', self.take())
+
+    def test_idle_users_are_forgotten(self):
+        self.scheduler.submit('U1', 'DU1', message('U1'))
+        self.take(cost=0)
+        self.assertEqual({}, self.scheduler.buckets)
+        self.assertEqual(0, len(self.scheduler.queues))
+
+    def test_turn_cost(self):
+        search = fair_scheduler.turn_cost(['handle_DiscoveryQuery'])
+        listing = fair_scheduler.turn_cost(['handle_list_shopping_cart'])
+        self.assertEqual((6, 3, 1),
+                         (search, listing, fair_scheduler.turn_cost([])))
+
+    def test_charge_into_debt(self):
+        bucket = TokenBucket(2, 4, clock=self.clock)
+        bucket.charge(10)
+        self.assertEqual(3.0, bucket.wait_time(0))
+
+    def test_thread_takes_turns(self):
+        take_turn = mock.Mock(side_effect=[Exception('Boom'), 2])
+        scheduler = fair_scheduler.FairScheduler(take_turn, self.reply)
+        scheduler.start()
+        scheduler.submit('U1', 'DU1', message('U1'))
+        scheduler.submit('U2', 'DU2', message('U2'))
+
+        self.assertTrue(scheduler.join(timeout=5))
+        self.assertEqual(2, take_turn.call_count)
+
+
+class FairBotTestCase(unittest.TestCase):
+
+    def test_queued_turns(self):
+        slack_client = fakes.FakeSlackClient()
+        bot = WatsonOnlineStore('UBOT', slack_client,
+                                fakes.FakeConversation(), None,
+                                fakes.FakeOnlineStore())
+        # Turns are only queued until the scheduler thread starts.
+        with mock.patch.object(fair_scheduler.FairScheduler, 'start'):
+            bot.enable_fair_scheduling(user_queue_size=1)
+
+        bot.handle_slack_output(message('U1') + message('U2') +
+                                message('U1', 'list') +
+                                [{'type': 'presence_change', 'user': 'U3'}])
+        self.assertEqual([('DU1', fair_scheduler.OVERFLOW_REPLY)],
+                         slack_client.posts)
+        self.assertEqual(2, bot.scheduler.queued)
+
+        bot.scheduler.start()
+        self.assertTrue(bot.finish_turns(timeout=5))
+        channels = set(channel for channel, _ in slack_client.posts[1:])
+        self.assertEqual(set(['DU1', 'DU2']), channels)
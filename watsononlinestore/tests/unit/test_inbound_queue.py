@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from watsononlinestore import fair_scheduler
+from watsononlinestore import inbound_queue
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+
+def message(user, ts, text='hi'):
+    return {'type': 'message', 'user': user, 'text': text,
+            'channel': 'D' + user, 'ts': ts}
+
+
+class InboundQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'inbound.db')
+        self.now = 1000.0
+        self.queue = self.reopen()
+
+    def reopen(self):
+        queue = inbound_queue.InboundQueue(self.path, retention=60,
+                                           clock=lambda: self.now)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_append_drops_redeliveries(self):
+        first = message('U1', '1.1')
+        unkeyed = dict(message('U1', None))
+        self.assertEqual([first, unkeyed],
+                         self.queue.append([first, unkeyed]))
+        self.assertEqual([message('U2', '1.1'), unkeyed], self.queue.append(
+            [dict(first), message('U2', '1.1'), unkeyed]))
+        self.assertEqual(2, self.queue.pending())
+
+        self.queue.ack([first, unkeyed])
+        self.assertEqual([], self.queue.append([first]))
+        self.assertEqual(1, self.queue.pending())
+
+    def test_replay_after_restart(self):
+        events = [message('U1', '1.1'), message('U2', '1.2', 'list'),
+                  message('U1', '1.3')]
+        self.queue.append(events)
+        self.queue.ack(events[1:2])
+        self.queue.close()
+
+        self.now += 120
+        queue = self.reopen()
+        self.assertEqual([events[0], events[2]], queue.open())
+        # Acknowledged messages are forgotten after the retention time.
+        self.assertEqual([events[1]], queue.append([events[1]]))
+
+    def test_gives_up_after_max_attempts(self):
+        self.queue.append([message('U1', '1.1')])
+        self.assertEqual(1, len(self.reopen().open()))
+        self.assertEqual(1, len(self.reopen().open()))
+        self.assertEqual([], self.reopen().open())
+        self.assertEqual(0, self.queue.pending())
+
+
+class InboundQueueBotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'inbound.db')
+
+    def bot(self):
+        queue = inbound_queue.InboundQueue(self.path)
+        self.addCleanup(queue.close)
+        slack_client = fakes.FakeSlackClient()
+        bot = WatsonOnlineStore('UBOT', slack_client,
+                                fakes.FakeConversation(), None,
+                                fakes.FakeOnlineStore())
+        return bot, slack_client, queue
+
+    def test_answers_unfinished_messages_once(self):
+        # The last run took this message in but crashed before answering.
+        bot, slack_client, queue = self.bot()
+        queue.append([message('U1', '1.1')])
+        queue.close()
+
+        bot, slack_client, queue = self.bot()
+        self.assertEqual(1, bot.enable_inbound_queue(queue))
+        self.assertEqual(['DU1'], [post[0] for post in slack_client.posts])
+
+        # Slack delivering it again, with a new one.
+        bot.handle_slack_output([message('U1', '1.1'),
+                                 message('U2', '1.2'),
+                                 {'type': 'presence_change', 'user': 'U3'}])
+        self.assertEqual(['DU1', 'DU2'],
+                         [post[0] for post in slack_client.posts])
+        self.assertEqual(0, queue.pending())
+
+    def test_acknowledges_messages_not_for_the_bot(self):
+        bot, slack_client, queue = self.bot()
+        queue.append([dict(message('U1', '1.1'), channel='C1')])
+
+        bot.enable_inbound_queue(queue)
+
+        self.assertEqual([], slack_client.posts)
+        self.assertEqual(0, queue.pending())
+
+    def test_accepted_before_handled(self):
+        bot, slack_client, queue = self.bot()
+        bot.enable_inbound_queue(queue)
+
+        accepted = bot.accept_slack_output([message('U1', '1.1')])
+        self.assertEqual(1, queue.pending())
+        self.assertEqual([], bot.accept_slack_output([message('U1', '1.1')]))
+        bot.handle_accepted_output(accepted)
+
+        self.assertEqual(['DU1'], [post[0] for post in slack_client.posts])
+        self.assertEqual(0, queue.pending())
+
+    def test_rejected_messages_are_acknowledged(self):
+        bot, slack_client, queue = self.bot()
+        bot.enable_inbound_queue(queue)
+        with mock.patch.object(fair_scheduler.FairScheduler, 'start'):
+            bot.enable_fair_scheduling(user_queue_size=1)
+
+        bot.handle_slack_output([message('U1', '1.1'), message('U1', '1.2')])
+        self.assertEqual([('DU1', fair_scheduler.OVERFLOW_REPLY)],
+                         slack_client.posts)
+        # The user was asked to send the second one again.
+        self.assertEqual(1, queue.pending())
+        bot.scheduler.start()
+        self.assertTrue(bot.finish_turns(timeout=5))
+        self.assertEqual(0, queue.pending())
+        queue.close()
+
+        bot, slack_client, queue = self.bot()
+        self.assertEqual(0, bot.enable_inbound_queue(queue))
@@ -0,0 +1,41 @@
+import unittest
+
+from watsononlinestore.tests import loadgen
+
+
+class LoadGenTestCase(unittest.TestCase):
+
+    def test_parse_latencies(self):
+        latencies = loadgen.parse_latencies('discovery=0.2, slack=0.05~0.01')
+
+        self.assertEqual(['discovery', 'slack'], sorted(latencies))
+        self.assertEqual(0.2, latencies['discovery'].mean)
+        self.assertEqual(0.01, latencies['slack'].jitter)
+        self.assertEqual({}, loadgen.parse_latencies(''))
+        self.assertRaises(ValueError, loadgen.parse_latencies, 'db=1')
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+
+        self.assertEqual(50.0, loadgen.percentile(values, 50))
+        self.assertEqual(99.0, loadgen.percentile(values, 99))
+        self.assertEqual(100.0, loadgen.percentile(values, 100))
+        self.assertEqual(0.0, loadgen.percentile([], 95))
+
+    def test_shopping_sessions(self):
+        load_test = loadgen.LoadTest(bots=2)
+
+        report = load_test.run(['shopper'], users=3, iterations=1)
+
+        shopper = report['shopper']
+        self.assertEqual(3 * len(loadgen.SCENARIOS['shopper']),
+                         shopper['turns'])
+        self.assertEqual(0, shopper['errors'])
+        self.assertGreater(shopper['turns_per_second'], 0)
+        latency = shopper['latency']
+        self.assertTrue(latency['p50'] <= latency['p95'] <= latency['p99']
+                        <= latency['max'])
+        # Two items added and the first deleted leave one in every cart.
+        self.assertEqual(3, len(load_test.online_store.customers))
+        for customer in load_test.online_store.customers.values():
+            self.assertEqual(1, len(customer['shopping_cart']))
@@ -0,0 +1,107 @@
+import io
+import logging
+import unittest
+
+import mock
+
+from watsononlinestore import log_config
+from watsononlinestore.log_config import Payload
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class PayloadTestCase(unittest.TestCase):
+
+    def test_short_payload(self):
+        self.assertEqual("{'a': [1, 2]}", str(Payload({'a': [1, 2]})))
+        self.assertEqual('hello', str(Payload('hello')))
+
+    def test_truncated(self):
+        with mock.patch.object(Payload, 'limit', 20):
+            self.assertEqual('x' * 20 + '...(truncated)',
+                             str(Payload('x' * 50)))
+            text = str(Payload({'results': [{'html': 'y' * 10 ** 6}] * 1000}))
+        self.assertEqual(20 + len('...(truncated)'), len(text))
+
+    @mock.patch.object(Payload, '__str__')
+    def test_lazy(self, mock_str):
+        logger = logging.getLogger('test_log_config.lazy')
+        logger.setLevel(logging.INFO)
+        logger.debug("payload %s", Payload({'big': 'dict'}))
+        self.assertFalse(mock_str.called)
+
+
+class PayloadSamplerTestCase(unittest.TestCase):
+
+    def record(self, msg, *args):
+        return logging.LogRecord('x', logging.DEBUG, __file__, 1, msg, args,
+                                 None)
+
+    def test_sampling(self):
+        sampler = log_config.PayloadSampler(every=3)
+        kept = [sampler.filter(self.record('a %s', Payload(i)))
+                for i in range(7)]
+        self.assertEqual([True, False, False, True, False, False, True], kept)
+        # Counted per message, and records without payloads all pass.
+        self.assertTrue(sampler.filter(self.record('b %s', Payload(1))))
+        self.assertTrue(all(sampler.filter(self.record('a %s', 1))
+                            for _ in range(3)))
+
+
+class QueueHandlerTestCase(unittest.TestCase):
+
+    def test_formats_before_queueing(self):
+        record_queue = queue.Queue()
+        handler = log_config.DroppingQueueHandler(record_queue)
+        context = {'cart_item': '1'}
+        handler.handle(logging.LogRecord('x', logging.DEBUG, __file__, 1,
+                                         'context %s', (Payload(context),),
+                                         None))
+        context['cart_item'] = '2'
+        self.assertEqual("context {'cart_item': '1'}",
+                         record_queue.get_nowait().getMessage())
+
+    def test_drops_when_full(self):
+        handler = log_config.DroppingQueueHandler(queue.Queue(1))
+        for i in range(3):
+            handler.handle(logging.LogRecord('x', logging.INFO, __file__, 1,
+                                             'msg %d', (i,), None))
+        self.assertEqual(2, handler.dropped)
+
+    def configure(self, environ):
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        self.addCleanup(setattr, Payload, 'limit', Payload.limit)
+
+        def restore():
+            root.handlers[:] = saved[0]
+            root.setLevel(saved[1])
+        self.addCleanup(restore)
+
+        stream = io.StringIO() if str is not bytes else io.BytesIO()
+        return log_config.configure(environ, stream=stream), stream
+
+    def test_configure(self):
+        listener, stream = self.configure(
+            {'LOG_LEVEL': 'debug', 'LOG_PAYLOAD_LIMIT': '5',
+             'LOG_PAYLOAD_SAMPLE': 'x'})
+        logging.getLogger('test_log_config').debug(
+            'payload %s', Payload('abcdefgh'))
+        listener.stop()
+
+        root = logging.getLogger()
+        self.assertEqual(logging.DEBUG, root.level)
+        self.assertEqual(1, len(root.handlers))
+        self.assertIn('DEBUG test_log_config: payload abcde...(truncated)',
+                      stream.getvalue())
+
+    def test_unknown_level(self):
+        listener, stream = self.configure({'LOG_LEVEL': 'verbose'})
+        listener.stop()
+
+        self.assertEqual(logging.INFO, logging.getLogger().level)
+        self.assertIn('LOG_LEVEL VERBOSE is not a level name. Using INFO.',
+                      stream.getvalue())
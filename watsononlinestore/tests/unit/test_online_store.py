@@ -0,0 +1,242 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from watsononlinestore import resilience
+from watsononlinestore.database import cart
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.database import sqlite_online_store
+from watsononlinestore.database import throttle
+from watsononlinestore.tests.fakes import FakeCloudantClient
+from watsononlinestore.tests.fakes import FakeDocument
+from watsononlinestore.tests.fakes import fake_query
+from watsononlinestore.watson_online_store import OnlineStoreCustomer
+
+CAP_URL = 'http://www.ibmstore.com/ProductDetail.aspx?pid=131628'
+
+
+class OnlineStoreContract(object):
+    """Tests every OnlineStore backend must pass.
+
+    Subclasses set self.store in setUp().
+    """
+
+    def add_customer(self, email='e@mail', shopping_cart=None):
+        self.store.add_customer_obj(OnlineStoreCustomer(
+            email=email, first_name='First', last_name='Last',
+            shopping_cart=shopping_cart or []))
+
+    def test_find_missing_customer(self):
+        self.assertIsNone(self.store.find_customer('e@mail'))
+        self.assertIsNone(self.store.list_shopping_cart('e@mail'))
+
+    def test_add_and_find_customer(self):
+        self.add_customer()
+        self.add_customer('other@mail')
+
+        customer = self.store.find_customer('e@mail')
+
+        self.assertEqual('e@mail', customer['email'])
+        self.assertEqual('First', customer['first_name'])
+        self.assertEqual('Last', customer['last_name'])
+        self.assertEqual([], self.store.list_shopping_cart('e@mail'))
+
+    def test_add_existing_customer_keeps_cart(self):
+        self.add_customer()
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.add_customer()
+
+        self.assertEqual(1, len(self.store.list_shopping_cart('e@mail')))
+
+    def test_add_and_delete_items(self):
+        self.add_customer()
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Mug', 'http://mug'))
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        items = self.store.list_shopping_cart('e@mail')
+        self.assertEqual(['131628', 'http://mug'], [i['id'] for i in items])
+        self.assertEqual(2, items[0]['qty'])
+
+        self.store.delete_item_shopping_cart('e@mail', '131628')
+
+        items = self.store.list_shopping_cart('e@mail')
+        self.assertEqual(['http://mug'], [i['id'] for i in items])
+
+    def test_old_string_carts_are_migrated(self):
+        self.add_customer(shopping_cart=['Cap: ' + CAP_URL + '\n'])
+
+        items = self.store.list_shopping_cart('e@mail')
+
+        self.assertEqual(['131628'], [i['id'] for i in items])
+
+    def test_cart_update_of_missing_customer(self):
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.assertIsNone(self.store.list_shopping_cart('e@mail'))
+
+    def test_ops_with_ids_are_applied_once(self):
+        self.add_customer()
+        ops = [[cart.ADD, cart.new_cart_item('Cap', CAP_URL), 'op1']]
+
+        self.store.apply_cart_ops('e@mail', ops)
+        # Replayed from the write-behind journal after a crash.
+        self.store.apply_cart_ops('e@mail', ops + [[cart.DELETE, 'x', 'op2']])
+
+        self.assertEqual(1, self.store.list_stored_cart('e@mail')[0]['qty'])
+
+    def test_write_behind(self):
+        self.add_customer()
+        write_behind = self.store.enable_write_behind(flush_interval=60)
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.assertEqual(1, len(self.store.list_shopping_cart('e@mail')))
+        self.assertEqual([], self.store.list_stored_cart('e@mail'))
+
+        write_behind.stop()
+
+        self.assertEqual(1, len(self.store.list_stored_cart('e@mail')))
+
+
+class SQLiteOnlineStoreTestCase(OnlineStoreContract, unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'store.db')
+        self.store = sqlite_online_store.SQLiteOnlineStore(self.path)
+        self.addCleanup(self.store.close)
+        self.store.init()
+
+    def test_wal_and_email_index(self):
+        conn = self.store.connection()
+
+        self.assertEqual(
+            'wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+        plan = conn.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM customers WHERE email = ?',
+            ('e@mail',)).fetchall()
+        self.assertIn('customers_email', str([tuple(row) for row in plan]))
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(self.store.connection()))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(connections[0], self.store.connection())
+        self.assertIs(self.store.connection(), self.store.connection())
+
+    def test_concurrent_cart_updates(self):
+        self.add_customer()
+
+        def add():
+            for _ in range(10):
+                self.store.add_to_shopping_cart(
+                    'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(40, self.store.list_shopping_cart('e@mail')[0]['qty'])
+
+
+class CloudantOnlineStoreTestCase(OnlineStoreContract, unittest.TestCase):
+
+    def setUp(self):
+        breakers = mock.patch.dict(resilience._breakers, clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
+        client = FakeCloudantClient()
+        for name, fake in (('Document', FakeDocument), ('Query', fake_query)):
+            patcher = mock.patch.object(cloudant_online_store, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = cloudant_online_store.CloudantOnlineStore(
+            client, 'db', cloudant_throttle=throttle.CloudantThrottle(
+                sleep=lambda seconds: None))
+        self.store.init()
+
+    def test_failed_lookup_keeps_ops(self):
+        self.add_customer()
+        write_behind = self.store.enable_write_behind(flush_interval=60)
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        with mock.patch.object(cloudant_online_store, 'Query',
+                               side_effect=IOError('Cloudant down')):
+            write_behind.flush()
+        self.assertEqual(1, len(write_behind.pending['e@mail']))
+
+        write_behind.stop()
+        self.assertEqual(1, len(self.store.list_stored_cart('e@mail')))
+
+    def test_rate_limited_cart_write_is_retried(self):
+        self.add_customer()
+        FakeDocument.rate_limited = 2
+        self.addCleanup(setattr, FakeDocument, 'rate_limited', 0)
+
+        self.store.add_to_shopping_cart(
+            'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.assertEqual(1, len(self.store.list_shopping_cart('e@mail')))
+        metrics = self.store.throttle.metrics()
+        self.assertEqual(2, metrics[throttle.WRITE]['rate_limited'])
+        self.assertEqual(3, metrics[throttle.LOOKUP]['requests'])
+        # Cloudant answered, so the 429s are no breaker failures.
+        self.assertEqual(0, self.store.breaker.failures)
+
+    def test_failed_cart_write_is_retried(self):
+        self.add_customer()
+        with mock.patch.object(cloudant_online_store, 'Query',
+                               side_effect=IOError('Cloudant down')):
+            self.store.add_to_shopping_cart(
+                'e@mail', cart.new_cart_item('Cap', CAP_URL))
+            self.store.delete_item_shopping_cart('e@mail', 'x')
+        self.assertEqual(1, len(self.store.list_shopping_cart('e@mail')))
+        self.assertEqual(2, len(self.store.retry_buffer.pending['e@mail']))
+
+        # Cloudant is back.
+        self.store.breaker.record_success()
+        self.store.retry_buffer.stop()
+        self.assertEqual(1, len(self.store.list_stored_cart('e@mail')))
+
+    def test_late_cart_write_is_not_applied_twice(self):
+        self.add_customer()
+        apply_cart_ops = self.store.apply_cart_ops
+
+        def written_but_timed_out(customer_str, ops):
+            apply_cart_ops(customer_str, ops)
+            raise resilience.DeadlineExceeded('Cloudant too slow')
+
+        with mock.patch.object(self.store, 'apply_cart_ops',
+                               side_effect=written_but_timed_out):
+            self.store.add_to_shopping_cart(
+                'e@mail', cart.new_cart_item('Cap', CAP_URL))
+
+        self.store.retry_buffer.stop()
+        stored = self.store.list_stored_cart('e@mail')
+        self.assertEqual(1, stored[0]['qty'])
+
+    def test_connects_once(self):
+        with mock.patch.object(self.store.client, 'connect') as connect:
+            self.store.find_customer('e@mail')
+            self.store.find_customer('e@mail')
+        connect.assert_not_called()
+        self.assertTrue(any(client is self.store.client for client in
+                            cloudant_online_store._connected_clients))
@@ -0,0 +1,103 @@
+import unittest
+
+import mock
+
+from watsononlinestore.database import cloudant_online_store
+from watsononlinestore.database import partitioning
+from watsononlinestore.watson_online_store import OnlineStoreCustomer
+
+
+class PartitioningTestCase(unittest.TestCase):
+
+    def test_partition_key_ignores_case(self):
+        self.assertEqual(partitioning.partition_key('E@Mail '),
+                         partitioning.partition_key('e@mail'))
+        self.assertNotEqual(partitioning.partition_key('a@mail'),
+                            partitioning.partition_key('e@mail'))
+
+    def test_partitioned_doc_id(self):
+        key = partitioning.partition_key
+
+        self.assertEqual(key('e@mail') + ':customer',
+                         partitioning.partitioned_doc_id(
+                             {'_id': 'x', 'type': 'customer',
+                              'email': 'e@mail'}))
+        self.assertEqual(key('U1') + ':session',
+                         partitioning.partitioned_doc_id(
+                             {'_id': 'session:U1', 'type': 'session'}))
+        self.assertEqual('other:x',
+                         partitioning.partitioned_doc_id({'_id': 'x'}))
+        self.assertIsNone(partitioning.partitioned_doc_id(
+            {'_id': '_design/x'}))
+
+    def test_migrate_in_batches(self):
+        docs = [{'_id': 'c%d' % i, '_rev': '1-a', 'type': 'customer',
+                 'email': 'e%d@mail' % i} for i in range(5)]
+        docs.append({'_id': '_design/ddoc'})
+        source = mock.Mock()
+        target = mock.Mock()
+        target.bulk_docs.side_effect = lambda batch: [
+            {'id': d['_id'], 'rev': '1-b'} for d in batch]
+        client = mock.MagicMock()
+        client.all_dbs.return_value = ['source']
+        client.__getitem__.side_effect = {'source': source,
+                                          'target': target}.get
+
+        def all_docs(include_docs, limit, startkey=None, skip=0):
+            ids = sorted(d['_id'] for d in docs)
+            start = ids.index(startkey) + skip if startkey else 0
+            page = sorted(docs, key=lambda d: d['_id'])[start:start + limit]
+            return {'rows': [{'id': d['_id'], 'doc': d} for d in page]}
+        source.all_docs.side_effect = all_docs
+
+        counts = partitioning.migrate_to_partitioned(
+            client, 'source', 'target', batch_size=2)
+
+        client.create_database.assert_called_once_with('target',
+                                                       partitioned=True)
+        self.assertEqual({'copied': 5, 'skipped': 1, 'conflicts': 0}, counts)
+        self.assertEqual(4, source.all_docs.call_count)
+        copied = [d for c in target.bulk_docs.call_args_list for d in c[0][0]]
+        self.assertEqual(
+            sorted(partitioning.customer_doc_id(d['email'])
+                   for d in docs[:5]),
+            sorted(d['_id'] for d in copied))
+        self.assertFalse(any('_rev' in d for d in copied))
+
+
+class PartitionedStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.store = cloudant_online_store.CloudantOnlineStore(
+            self.client, 'db', partitioned=True)
+
+    def test_init_creates_partitioned_db(self):
+        self.client.all_dbs.return_value = []
+
+        self.store.init()
+
+        self.client.create_database.assert_called_once_with(
+            'db', partitioned=True)
+
+    @mock.patch.object(cloudant_online_store, 'Query')
+    def test_find_customer_in_partition(self, query):
+        query.return_value.return_value = {'docs': [{'email': 'e@mail'}]}
+
+        doc = self.store.find_customer('e@mail')
+
+        self.assertEqual({'email': 'e@mail'}, doc)
+        self.assertEqual(partitioning.partition_key('e@mail'),
+                         query.call_args[1]['partition_key'])
+
+    @mock.patch.object(cloudant_online_store, 'Query')
+    def test_add_customer_in_partition(self, query):
+        query.return_value.return_value = {'docs': []}
+        db = self.client.__getitem__.return_value
+
+        self.store.add_customer_obj(OnlineStoreCustomer(
+            email='e@mail', first_name='first', last_name='last',
+            shopping_cart=[]))
+
+        doc = db.create_document.call_args[0][0]
+        self.assertEqual(partitioning.customer_doc_id('e@mail'), doc['_id'])
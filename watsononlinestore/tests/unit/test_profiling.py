@@ -0,0 +1,167 @@
+import collections
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import mock
+
+from watsononlinestore import profiling
+from watsononlinestore import resilience
+from watsononlinestore.tests import fakes
+from watsononlinestore.watson_online_store import WatsonOnlineStore
+
+
+class FakeClock(object):
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class TurnProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.sampler = mock.Mock()
+        self.sampler.unregister.return_value = collections.Counter(
+            {'run.py:main:1;watson_online_store.py:handle_message:2': 3})
+
+    def profiler(self, step=0.01, **kwargs):
+        return profiling.TurnProfiler(self.directory, sampler=self.sampler,
+                                      clock=FakeClock(step), **kwargs)
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_every_nth_turn(self):
+        profiler = self.profiler(every=2)
+        for branches in (['handle_add_to_cart'], ['handle_DiscoveryQuery',
+                                                  'handle_DiscoveryQuery']):
+            with profiler.turn(branches):
+                sum(range(100))
+
+        stem = 'turn-%d-2-handle_DiscoveryQuery-10ms' % os.getpid()
+        self.assertEqual([stem + '.collapsed', stem + '.pstats'],
+                         self.profiles())
+        stats = pstats.Stats(os.path.join(self.directory, stem + '.pstats'))
+        self.assertTrue(stats.total_calls > 0)
+        with open(os.path.join(self.directory, stem + '.collapsed')) as f:
+            self.assertEqual(
+                'run.py:main:1;watson_online_store.py:handle_message:2 3\n',
+                f.read())
+
+    def test_slow_turns(self):
+        profiler = self.profiler(step=0.5, slow_threshold=1.0)
+        with profiler.turn(['handle_list_shopping_cart']):
+            pass
+        self.assertEqual([], self.profiles())
+
+        profiler.clock.step = 1.5
+        with profiler.turn([]):
+            pass
+        self.assertEqual(
+            ['turn-%d-2-handle_message-1500ms.collapsed' % os.getpid()],
+            self.profiles())
+        self.assertEqual(2, self.sampler.register.call_count)
+
+    def test_failed_turn_is_profiled(self):
+        profiler = self.profiler(every=1)
+        with self.assertRaises(ValueError):
+            with profiler.turn(['handle_add_to_cart']):
+                raise ValueError()
+        self.assertEqual(2, len(self.profiles()))
+
+    def test_bounded_ring(self):
+        old = os.path.join(self.directory, 'turn-1-1-old-5ms.pstats')
+        open(old, 'w').close()
+        profiler = self.profiler(every=1, keep=3)
+        for _ in range(3):
+            with profiler.turn([]):
+                pass
+
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(3, len(self.profiles()))
+        self.assertTrue(self.profiles()[-1].startswith(
+            'turn-%d-3-' % os.getpid()))
+
+    def test_disabled_and_toggle(self):
+        profiler = self.profiler(every=1, enabled=False)
+        with profiler.turn([]):
+            pass
+        self.assertEqual([], self.profiles())
+        self.assertFalse(self.sampler.register.called)
+
+        profiler.toggle()
+        with profiler.turn([]):
+            pass
+        self.assertEqual(2, len(self.profiles()))
+
+    def test_from_environ(self):
+        profiler = profiling.from_environ({
+            'PROFILE_DIR': self.directory, 'PROFILE_TURNS': 'true',
+            'PROFILE_EVERY': '10', 'PROFILE_SLOW_TURN': '0',
+            'PROFILE_KEEP': 'many'})
+        self.assertEqual((self.directory, True, 10, None, profiling.KEEP),
+                         (profiler.directory, profiler.enabled,
+                          profiler.every, profiler.slow_threshold,
+                          profiler.keep))
+        self.assertFalse(profiling.from_environ({}).enabled)
+
+    def test_sampler(self):
+        sampler = profiling.StackSampler()
+        thread_id = profiling.threading.current_thread().ident
+        sampler.active[thread_id] = collections.Counter()
+        sampler.sample()
+        stacks = list(sampler.unregister(thread_id))
+        self.assertEqual(1, len(stacks))
+        self.assertIn(':test_sampler:', stacks[0])
+        self.assertEqual(collections.Counter(), sampler.unregister(thread_id))
+
+    def test_helper_threads_are_sampled(self):
+        sampler = profiling.StackSampler(interval=0.001)
+        profiler = profiling.TurnProfiler(self.directory, slow_threshold=0,
+                                          sampler=sampler)
+
+        def slow_call():
+            # Until the sampler has seen this thread, at most 5 seconds.
+            for _ in range(5000):
+                if any(':slow_call:' in stack
+                       for stack in profiling.current_turn()[1]):
+                    return
+                time.sleep(0.001)
+
+        with profiler.turn(['handle_DiscoveryQuery']):
+            resilience.call_with_timeout(5, slow_call)
+            resilience.call_parallel([(slow_call, ()), (slow_call, ())])
+
+        with open(os.path.join(self.directory, self.profiles()[0])) as f:
+            stacks = f.read()
+        self.assertIn(':slow_call:', stacks)
+        self.assertIsNone(profiling.current_turn())
+        self.assertEqual({}, sampler.active)
+
+    def test_collapse_stack(self):
+        stack = profiling.collapse_stack(sys._getframe())
+        self.assertTrue(stack.endswith(
+            'test_profiling.py:test_collapse_stack:%d' %
+            self.test_collapse_stack.__code__.co_firstlineno))
+
+    def test_bot_turn_names_branch(self):
+        profiler = self.profiler(every=1)
+        bot = WatsonOnlineStore('UBOT', fakes.FakeSlackClient(),
+                                fakes.FakeConversation(), None,
+                                fakes.FakeOnlineStore(), profiler=profiler)
+        bot.handle_slack_output([{'type': 'message', 'text': 'list',
+                                  'user': 'U1', 'channel': 'DU1'}])
+
+        self.assertEqual(['handle_list_shopping_cart'], bot.turn_branches)
+        self.assertIn('-1-handle_list_shopping_cart-', self.profiles()[0])
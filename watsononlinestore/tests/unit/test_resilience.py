@@ -0,0 +1,245 @@
+import threading
+import unittest
+
+import mock
+
+from watsononlinestore import resilience
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeadlineTestCase(unittest.TestCase):
+
+    def test_remaining(self):
+        clock = FakeClock()
+        deadline = resilience.Deadline(2, clock=clock)
+
+        clock.now += 1.5
+        self.assertAlmostEqual(0.5, deadline.remaining())
+        self.assertFalse(deadline.expired())
+
+        clock.now += 1
+        self.assertEqual(0, deadline.remaining())
+        self.assertTrue(deadline.expired())
+
+    def test_scope(self):
+        deadline = resilience.Deadline(1)
+
+        self.assertIsNone(resilience.current_deadline())
+        with resilience.deadline_scope(deadline):
+            self.assertIs(deadline, resilience.current_deadline())
+        self.assertIsNone(resilience.current_deadline())
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = resilience.CircuitBreaker(
+            'test', failure_threshold=2, reset_timeout=10, clock=self.clock)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.CLOSED, self.breaker.state)
+
+    def test_half_open_allows_one_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now += 10
+
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.CLOSED, self.breaker.state)
+
+    def test_failed_trial_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now += 10
+        self.breaker.allow()
+
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.OPEN, self.breaker.state)
+
+
+class GuardedCallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = resilience.CircuitBreaker('test', failure_threshold=3)
+        self.sleep = mock.Mock()
+
+    def test_returns_result(self):
+        func = mock.Mock(return_value='ok')
+
+        actual = resilience.guarded_call(self.breaker, func, 1, b=2)
+
+        self.assertEqual('ok', actual)
+        func.assert_called_once_with(1, b=2)
+
+    def test_retries_with_backoff(self):
+        func = mock.Mock(side_effect=[IOError(), IOError(), 'ok'])
+
+        actual = resilience.guarded_call(self.breaker, func, guard_retries=2,
+                                         guard_sleep=self.sleep)
+
+        self.assertEqual('ok', actual)
+        self.assertEqual(3, func.call_count)
+        first, second = [c[0][0] for c in self.sleep.call_args_list]
+        self.assertTrue(0.05 <= first <= 0.15)
+        self.assertTrue(0.1 <= second <= 0.3)
+        self.assertEqual(self.breaker.CLOSED, self.breaker.state)
+
+    def test_gives_up_after_retries(self):
+        func = mock.Mock(side_effect=IOError())
+
+        self.assertRaises(IOError, resilience.guarded_call, self.breaker,
+                          func, guard_retries=1, guard_sleep=self.sleep)
+        self.assertEqual(2, func.call_count)
+
+    def test_answers_are_no_failures(self):
+        func = mock.Mock(side_effect=KeyError('busy'))
+
+        for _ in range(3):
+            self.assertRaises(KeyError, resilience.guarded_call,
+                              self.breaker, func, guard_retries=2,
+                              guard_answered=lambda e: True)
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(self.breaker.CLOSED, self.breaker.state)
+
+    def test_open_breaker_fails_fast(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        func = mock.Mock()
+
+        self.assertRaises(resilience.CircuitOpenError,
+                          resilience.guarded_call, self.breaker, func)
+        func.assert_not_called()
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        self.assertRaises(resilience.DeadlineExceeded,
+                          resilience.guarded_call, self.breaker,
+                          release.wait, guard_timeout=0.05)
+
+    def test_expired_deadline(self):
+        func = mock.Mock()
+
+        with resilience.deadline_scope(resilience.Deadline(0)):
+            self.assertRaises(resilience.DeadlineExceeded,
+                              resilience.guarded_call, self.breaker, func)
+        func.assert_not_called()
+
+    def test_expired_deadline_keeps_half_open_trial(self):
+        clock = FakeClock()
+        breaker = resilience.CircuitBreaker('test', failure_threshold=1,
+                                            reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now += 10
+
+        with resilience.deadline_scope(resilience.Deadline(0)):
+            self.assertRaises(resilience.DeadlineExceeded,
+                              resilience.guarded_call, breaker, mock.Mock())
+        self.assertEqual('ok', resilience.guarded_call(
+            breaker, mock.Mock(return_value='ok')))
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+    def test_limits_calls_in_flight(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slots = resilience._CallSlots(1)
+
+        with mock.patch.object(resilience, '_call_slots', slots):
+            self.assertRaises(resilience.DeadlineExceeded,
+                              resilience.call_with_timeout, 0.01,
+                              release.wait)
+            self.assertEqual(1, resilience.calls_in_flight())
+            # No helper thread is started while the first one hangs.
+            func = mock.Mock()
+            self.assertRaises(resilience.DeadlineExceeded,
+                              resilience.call_with_timeout, 0.01, func)
+            func.assert_not_called()
+
+            release.set()
+            self.assertEqual('ok', resilience.call_with_timeout(
+                1, lambda: 'ok'))
+
+    def test_hung_dependency_keeps_its_calls_in_flight(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        hung = resilience.CircuitBreaker('hung', max_calls_in_flight=1)
+
+        self.assertRaises(resilience.DeadlineExceeded,
+                          resilience.guarded_call, hung, release.wait,
+                          guard_timeout=0.01)
+        func = mock.Mock()
+        self.assertRaises(resilience.DeadlineExceeded,
+                          resilience.guarded_call, hung, func,
+                          guard_timeout=0.01)
+        func.assert_not_called()
+        self.assertEqual(1, resilience.calls_in_flight(hung))
+
+        # Other dependencies still have their helper threads.
+        self.assertEqual('ok', resilience.guarded_call(
+            self.breaker, lambda: 'ok'))
+
+    def test_no_retry_past_deadline(self):
+        func = mock.Mock(side_effect=IOError())
+
+        with resilience.deadline_scope(resilience.Deadline(0.01)):
+            self.assertRaises(IOError, resilience.guarded_call, self.breaker,
+                              func, guard_retries=5, guard_sleep=self.sleep)
+        self.assertEqual(1, func.call_count)
+
+
+class CallParallelTestCase(unittest.TestCase):
+
+    def test_calls_run_concurrently(self):
+        barrier = threading.Event()
+        arrived = []
+
+        def wait(name):
+            arrived.append(name)
+            if len(arrived) == 2:
+                barrier.set()
+            # Only returns True if the other call started meanwhile.
+            return barrier.wait(1)
+
+        outcomes = resilience.call_parallel([(wait, ('a',)), (wait, ('b',))])
+
+        self.assertEqual([(True, True), (True, True)], outcomes)
+
+    def test_errors_and_deadline(self):
+        deadline = resilience.Deadline(5)
+        error = IOError()
+
+        def fail():
+            raise error
+
+        with resilience.deadline_scope(deadline):
+            outcomes = resilience.call_parallel(
+                [(resilience.current_deadline, ()), (fail, ())])
+
+        self.assertEqual([(True, deadline), (False, error)], outcomes)
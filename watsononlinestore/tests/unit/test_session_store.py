@@ -0,0 +1,113 @@
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from watsononlinestore.database import cloudant_session_store
+from watsononlinestore import session_store
+
+
+class InMemorySessionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = session_store.InMemorySessionStore()
+
+    def test_load_new(self):
+        session = self.store.load('U1')
+
+        self.assertEqual('U1', session.session_id)
+        self.assertEqual({}, session.context)
+        self.assertEqual(0, session.version)
+
+    def test_save_and_load(self):
+        session = self.store.load('U1')
+        session.context = {'cart_item': '2'}
+        session.response_tuple = [{'cart_number': '1', 'name': 'cap'}]
+        session.results_shown = 1
+
+        self.store.save(session)
+        actual = self.store.load('U1')
+
+        self.assertEqual(1, actual.version)
+        self.assertEqual(session.context, actual.context)
+        self.assertEqual(session.response_tuple, actual.response_tuple)
+        self.assertEqual(1, actual.results_shown)
+
+    def test_loaded_session_is_a_copy(self):
+        session = self.store.load('U1')
+        session.context = {'a': 1}
+        self.store.save(session)
+
+        self.store.load('U1').context['a'] = 2
+
+        self.assertEqual({'a': 1}, self.store.load('U1').context)
+
+    def test_stale_save_conflicts(self):
+        first = self.store.load('U1')
+        second = self.store.load('U1')
+        self.store.save(first)
+
+        self.assertRaises(session_store.SessionConflict,
+                          self.store.save, second)
+
+    def test_dumps_is_compact(self):
+        session = session_store.Session('U1', context={'a': 1, 'b': [1, 2]})
+
+        self.assertNotIn(' ', session.dumps())
+
+
+class CloudantSessionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.db = self.client.__getitem__.return_value
+        self.store = cloudant_session_store.CloudantSessionStore(
+            self.client, 'db')
+
+    @mock.patch.object(cloudant_session_store, 'Document')
+    def test_load_missing(self, document):
+        not_found = HTTPError(response=mock.Mock(status_code=404))
+        document.return_value.fetch.side_effect = not_found
+
+        session = self.store.load('U1')
+
+        document.assert_called_once_with(self.db, 'session:U1')
+        self.assertEqual(0, session.version)
+        self.assertIsNone(session.rev)
+
+    @mock.patch.object(cloudant_session_store, 'Document')
+    def test_load_existing(self, document):
+        data = session_store.Session('U1', context={'a': 1}).dumps()
+        doc = mock.MagicMock()
+        doc.__getitem__.side_effect = {'_rev': '3-abc', 'data': data}.get
+        doc.get.return_value = 3
+        document.return_value = doc
+
+        session = self.store.load('U1')
+
+        doc.fetch.assert_called_once_with()
+        self.assertEqual({'a': 1}, session.context)
+        self.assertEqual(3, session.version)
+        self.assertEqual('3-abc', session.rev)
+
+    def test_save_uses_one_bulk_request(self):
+        self.db.bulk_docs.return_value = [{'id': 'session:U1',
+                                           'rev': '4-def'}]
+        session = session_store.Session('U1', version=3, rev='3-abc')
+
+        self.store.save(session)
+
+        self.db.bulk_docs.assert_called_once_with([{
+            '_id': 'session:U1', '_rev': '3-abc', 'type': 'session',
+            'version': 4, 'data': session.dumps()}])
+        self.assertEqual(4, session.version)
+        self.assertEqual('4-def', session.rev)
+
+    def test_save_conflict(self):
+        self.db.bulk_docs.return_value = [{'id': 'session:U1',
+                                           'error': 'conflict'}]
+        session = session_store.Session('U1', version=3, rev='3-abc')
+
+        self.assertRaises(session_store.SessionConflict,
+                          self.store.save, session)
+        self.assertEqual(3, session.version)
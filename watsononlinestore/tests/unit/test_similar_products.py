@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from watsononlinestore import similar_products
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'data')
+
+
+def product(pid, text):
+    return {'id': pid, 'name': 'Product ' + pid, 'url': 'http://p?pid=' + pid,
+            'image': '', 'text': text}
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class SimilarProductsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.prefix = os.path.join(self.tmp_dir, 'similar')
+
+    def test_tokenize(self):
+        self.assertEqual(['blue', 'cotton', 'mug'],
+                         similar_products.tokenize('Blue COTTON, a mug!'))
+
+    def test_top_neighbors(self):
+        matrix = similar_products.tfidf_matrix([
+            'blue cotton shirt sleeves',
+            'red cotton shirt collar',
+            'white ceramic coffee mug',
+            'black ceramic coffee mug handle',
+        ])
+
+        neighbors, scores = similar_products.top_neighbors(matrix, k=2)
+
+        self.assertEqual((4, 2), neighbors.shape)
+        self.assertEqual([1, 0, 3, 2], list(neighbors[:, 0]))
+        self.assertTrue((scores[:, 0] >= scores[:, 1]).all())
+
+    def test_build_and_lookup(self):
+        products = [product('1', 'blue cotton shirt'),
+                    product('2', 'red cotton shirt'),
+                    product('3', 'white ceramic mug'),
+                    product('4', 'black ceramic mug')]
+
+        similar_products.build(products, self.prefix, k=2)
+        table = similar_products.SimilarProducts(self.prefix)
+
+        self.assertEqual(['2'], [p['id'] for p in table.similar('1', 1)])
+        self.assertNotIn('text', table.similar('3')[0])
+        self.assertEqual([], table.similar('unknown'))
+
+    def test_load_ibm_store_products(self):
+        products = similar_products.load_products(
+            os.path.join(DATA_DIR, 'ibm_store_html'), 'ibm_store')
+
+        self.assertEqual(15, len(products))
+        self.assertEqual(('206347', 'Applique Crew Sweatshirt'),
+                         (products[0]['id'], products[0]['name']))
+        self.assertNotIn('<html', products[0]['text'])
@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+import mock
+
+from watsononlinestore import singleflight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = singleflight.SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def blocking(self, value):
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, key, value, followers=3):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do(key, self.blocking, value))
+            except Exception as e:
+                results.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        self.started.wait(5)
+        threads = [threading.Thread(target=call) for _ in range(followers)]
+        for thread in threads:
+            thread.start()
+        while self.flight.metrics()['coalesced'] < followers:
+            self.release.wait(0.01)
+        self.release.set()
+        for thread in [leader] + threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        results = self.run_concurrently('key', 'value')
+
+        self.assertEqual(['value'] * 4, results)
+        self.assertEqual({'calls': 1, 'coalesced': 3}, self.flight.metrics())
+
+    def test_concurrent_calls_share_error(self):
+        error = IOError("Boom")
+
+        results = self.run_concurrently('key', error)
+
+        self.assertEqual([error] * 4, results)
+
+    def test_sequential_calls_are_not_cached(self):
+        func = mock.Mock(return_value='value')
+
+        self.flight.do('key', func)
+        self.flight.do('key', func)
+
+        self.assertEqual(2, func.call_count)
+        self.assertEqual({'calls': 2, 'coalesced': 0}, self.flight.metrics())
+
+    def test_different_keys_are_separate(self):
+        func = mock.Mock(side_effect=['one', 'two'])
+
+        self.assertEqual('one', self.flight.do('a', func))
+        self.assertEqual('two', self.flight.do('b', func))
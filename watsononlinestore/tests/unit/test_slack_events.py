@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+import unittest
+
+import mock
+
+from watsononlinestore import singleflight
+from watsononlinestore import slack_events
+from watsononlinestore import watson_online_store
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from urllib2 import Request, urlopen, HTTPError
+
+SECRET = 'fake signing secret'
+
+
+class SlackEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.wos = mock.Mock()
+        self.wos.accept_slack_output.side_effect = lambda events: events
+        self.server = slack_events.SlackEventsServer(
+            self.wos, SECRET, host='127.0.0.1', port=0)
+        self.server.start()
+        self.addCleanup(lambda: self.server.shutdown())
+
+    def post(self, payload, secret=SECRET, timestamp=None):
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(timestamp or time.time()))
+        request = Request(
+            'http://127.0.0.1:%d/' % self.server.port, data=body,
+            headers={
+                'Content-Type': 'application/json',
+                'X-Slack-Request-Timestamp': timestamp,
+                'X-Slack-Signature': slack_events.compute_slack_signature(
+                    secret, timestamp, body)})
+        try:
+            response = urlopen(request)
+            return response.getcode(), response.read().decode('utf-8')
+        except HTTPError as e:
+            return e.code, None
+
+    def test_event_is_handled(self):
+        event = {'type': 'message', 'text': 'hi', 'channel': 'DXXX',
+                 'user': 'U'}
+
+        status, _ = self.post({'type': 'event_callback',
+                               'event_id': 'Ev1', 'event': event})
+        self.server.queue.join()
+
+        self.assertEqual(200, status)
+        self.wos.handle_accepted_output.assert_called_once_with([event])
+
+    def test_retried_event_is_handled_once(self):
+        payload = {'type': 'event_callback', 'event_id': 'Ev1',
+                   'event': {'type': 'message'}}
+
+        self.post(payload)
+        status, _ = self.post(payload)
+        self.server.queue.join()
+
+        self.assertEqual(200, status)
+        self.assertEqual(1, self.wos.handle_accepted_output.call_count)
+
+    def test_url_verification(self):
+        status, body = self.post({'type': 'url_verification',
+                                  'challenge': 'c4all3ng3'})
+
+        self.assertEqual(200, status)
+        self.assertEqual('c4all3ng3', body)
+
+    def test_bad_signature(self):
+        status, _ = self.post({'type': 'event_callback', 'event': {}},
+                              secret='wrong secret')
+        self.server.queue.join()
+
+        self.assertEqual(401, status)
+        self.wos.accept_slack_output.assert_not_called()
+
+    def test_stale_timestamp(self):
+        status, _ = self.post({'type': 'event_callback', 'event': {}},
+                              timestamp=time.time() - 3600)
+
+        self.assertEqual(401, status)
+        self.wos.accept_slack_output.assert_not_called()
+
+    def restart(self, **kwargs):
+        self.server.shutdown()
+        self.server = slack_events.SlackEventsServer(
+            self.wos, SECRET, host='127.0.0.1', port=0, **kwargs)
+        self.server.start()
+
+    def test_stored_before_ack(self):
+        self.restart(workers=0)
+        self.wos.accept_slack_output.side_effect = [IOError('Disk full'),
+                                                    []]
+        payload = {'type': 'event_callback', 'event_id': 'Ev3',
+                   'event': {'type': 'message'}}
+
+        self.assertEqual(503, self.post(payload)[0])
+        self.assertTrue(self.server.queue.empty())
+        # Slack retries it.
+        self.assertEqual(200, self.post(payload)[0])
+        self.assertEqual(2, self.wos.accept_slack_output.call_count)
+        self.assertEqual([], self.server.queue.get_nowait())
+
+    def test_refused_while_draining(self):
+        self.wos.accept_slack_output.side_effect = None
+        self.wos.accept_slack_output.return_value = None
+
+        status, _ = self.post({'type': 'event_callback', 'event_id': 'Ev4',
+                               'event': {'type': 'message'}})
+
+        self.assertEqual(503, status)
+        self.assertTrue(self.server.queue.empty())
+
+    def test_full_queue(self):
+        self.restart(workers=0, queue_size=1)
+        self.server.queue.put([])
+
+        status, _ = self.post({'type': 'event_callback', 'event_id': 'Ev2',
+                               'event': {}})
+
+        self.assertEqual(503, status)
+        self.wos.accept_slack_output.assert_not_called()
+
+    def test_turns_of_different_users_run_at_once(self):
+        self.restart(workers=2)
+        started = {'U1': threading.Event(), 'U2': threading.Event()}
+        overlapped = []
+
+        def handle(events):
+            user = events[0]['user']
+            started[user].set()
+            other = [event for key, event in started.items() if key != user]
+            overlapped.append(other[0].wait(5))
+        self.wos.handle_accepted_output.side_effect = handle
+
+        for user in ('U1', 'U2'):
+            self.server.submit({'type': 'event_callback', 'event': {
+                'type': 'message', 'user': user, 'text': 'hi'}})
+        self.server.queue.join()
+
+        self.assertEqual([True, True], overlapped)
+
+    def test_turns_of_one_user_do_not_interleave(self):
+        self.restart(workers=2)
+        running = []
+        overlapped = []
+
+        def handle(events):
+            overlapped.append(bool(running))
+            running.append(events)
+            time.sleep(0.05)
+            running.remove(events)
+        self.wos.handle_accepted_output.side_effect = handle
+
+        for text in ('hi', 'hats'):
+            self.server.submit({'type': 'event_callback', 'event': {
+                'type': 'message', 'user': 'U1', 'text': text}})
+        self.server.queue.join()
+
+        self.assertEqual([False, False], overlapped)
+
+    def test_events_are_stored_outside_of_the_lock(self):
+        self.restart(workers=0)
+        storing = threading.Event()
+        stored = threading.Event()
+
+        def accept(events):
+            if events[0]['user'] == 'U1':
+                storing.set()
+                stored.wait(5)
+            return events
+        self.wos.accept_slack_output.side_effect = accept
+        slow = threading.Thread(target=self.server.submit, args=(
+            {'type': 'event_callback', 'event_id': 'Ev5',
+             'event': {'type': 'message', 'user': 'U1'}},))
+        slow.start()
+        storing.wait(5)
+
+        # Slack's retry of the event being stored is refused for now.
+        self.assertFalse(self.server.submit(
+            {'type': 'event_callback', 'event_id': 'Ev5',
+             'event': {'type': 'message', 'user': 'U1'}}))
+        self.assertTrue(self.server.submit(
+            {'type': 'event_callback', 'event_id': 'Ev6',
+             'event': {'type': 'message', 'user': 'U2'}}))
+        stored.set()
+        slow.join()
+
+        self.assertEqual(2, self.server.queue.qsize())
+
+
+class ConcurrentTurnsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        breakers = mock.patch.dict(watson_online_store.resilience._breakers,
+                                   clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
+        self.flight = singleflight.SingleFlight()
+        patcher = mock.patch.object(watson_online_store.WatsonOnlineStore,
+                                    'discovery_flight', self.flight)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.conv_client = mock.Mock()
+        self.conv_client.message.side_effect = self.message
+        self.discovery_client = mock.Mock()
+        self.discovery_client.query.side_effect = self.query
+        self.bot = watson_online_store.WatsonOnlineStore(
+            'UBOT', mock.Mock(), self.conv_client, self.discovery_client,
+            mock.Mock(), workspace_id='workspace')
+        self.bot.discovery_data_source = 'amazon'
+        self.bot.init_customer = mock.Mock()
+        self.server = slack_events.SlackEventsServer(
+            self.bot, SECRET, host='127.0.0.1', port=0, workers=2)
+        self.server.start()
+        self.addCleanup(self.server.shutdown)
+
+    @staticmethod
+    def message(workspace_id, message_input, context):
+        if context.get('discovery_result'):
+            return {'context': {}, 'output': {'text': ['Anything else?']}}
+        return {'context': {'discovery_string': message_input['text']},
+                'output': {'text': ['Searching...']}}
+
+    def query(self, **kwargs):
+        # Wait for the other user's turn to ask for the same.
+        end = time.time() + 5
+        while self.flight.metrics()['coalesced'] < 1 and time.time() < end:
+            time.sleep(0.01)
+        return {'results': [{'score': 1.0,
+                             'extracted_metadata': {'title': 'Blue Hat'}}]}
+
+    def test_identical_searches_make_one_discovery_request(self):
+        for user in ('U1', 'U2'):
+            self.server.submit({'type': 'event_callback', 'event': {
+                'type': 'message', 'user': user, 'channel': 'D' + user,
+                'text': 'blue hats'}})
+        self.server.queue.join()
+
+        self.assertEqual(1, self.discovery_client.query.call_count)
+        self.assertEqual({'calls': 1, 'coalesced': 1},
+                         self.flight.metrics())
+        for user in ('U1', 'U2'):
+            session = self.bot.session_store.load(user)
+            self.assertEqual('Blue Hat', session.response_tuple[0]['name'])
@@ -0,0 +1,136 @@
+import unittest
+
+import mock
+
+from watsononlinestore import ratelimit
+from watsononlinestore import slack_outbox
+from watsononlinestore.watson_online_store import SlackSender
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.bucket = ratelimit.TokenBucket(2, 2, clock=lambda: self.now)
+
+    def test_burst_then_refill(self):
+        self.assertTrue(self.bucket.try_acquire())
+        self.assertTrue(self.bucket.try_acquire())
+        self.assertFalse(self.bucket.try_acquire())
+        self.assertAlmostEqual(0.5, self.bucket.wait_time())
+
+        self.now += 0.5
+
+        self.assertEqual(0, self.bucket.wait_time())
+        self.assertTrue(self.bucket.try_acquire())
+
+    def test_capacity_is_the_limit(self):
+        self.now += 1000
+
+        self.assertTrue(self.bucket.try_acquire(2))
+        self.assertFalse(self.bucket.try_acquire())
+
+
+class SlackOutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.slack_client = mock.Mock()
+        self.slack_client.api_call.return_value = {'ok': True}
+        self.outbox = slack_outbox.SlackOutbox(
+            self.slack_client, rate=100, burst=100, coalesce_window=0.05)
+
+    def posted(self):
+        return [(c[1]['channel'], c[1]['text'])
+                for c in self.slack_client.api_call.call_args_list]
+
+    def test_coalesces_messages_for_a_channel(self):
+        self.outbox.send('C1', 'one\n')
+        self.outbox.send('C1', 'two\n')
+        self.outbox.send('C2', 'other\n')
+
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual(sorted([('C1', 'one\ntwo\n'), ('C2', 'other\n')]),
+                         sorted(self.posted()))
+        metrics = self.outbox.metrics()
+        self.assertEqual(3, metrics['queued'])
+        self.assertEqual(3, metrics['sent'])
+        self.assertEqual(2, metrics['posts'])
+        self.assertEqual(1, metrics['coalesced'])
+
+    def test_keeps_long_posts_apart(self):
+        self.outbox.max_post_length = 5
+        self.outbox.send('C1', 'one\n')
+        self.outbox.send('C1', 'two\n')
+
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual([('C1', 'one\n'), ('C1', 'two\n')], self.posted())
+
+    def test_honors_retry_after(self):
+        self.slack_client.api_call.side_effect = [
+            {'ok': False, 'error': 'ratelimited',
+             'headers': {'Retry-After': '0.2'}},
+            {'ok': True},
+        ]
+
+        self.outbox.send('C1', 'one\n')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual([('C1', 'one\n'), ('C1', 'one\n')], self.posted())
+        metrics = self.outbox.metrics()
+        self.assertEqual(1, metrics['throttled'])
+        self.assertEqual(1, metrics['sent'])
+
+    def test_retries_failed_posts(self):
+        self.slack_client.api_call.side_effect = [
+            Exception('Boom'),
+            {'ok': False, 'error': 'ratelimited'},
+            {'ok': False, 'error': 'fatal_error'},
+            {'ok': True},
+        ]
+
+        with mock.patch.object(slack_outbox, 'RETRY_DELAY', 0.01):
+            self.outbox.send('C1', 'one\n')
+            self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual([('C1', 'one\n')] * 4, self.posted())
+        metrics = self.outbox.metrics()
+        self.assertEqual((1, 2, 1, 0), (metrics['throttled'],
+                                        metrics['retried'], metrics['sent'],
+                                        metrics['failed']))
+
+    def test_gives_up_after_max_attempts(self):
+        self.slack_client.api_call.return_value = {'ok': False,
+                                                   'error': 'fatal_error'}
+
+        with mock.patch.object(slack_outbox, 'RETRY_DELAY', 0.01):
+            self.outbox.send('C1', 'one\n')
+            self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual(slack_outbox.MAX_ATTEMPTS,
+                         self.slack_client.api_call.call_count)
+        metrics = self.outbox.metrics()
+        self.assertEqual((0, 1), (metrics['sent'], metrics['failed']))
+
+    def test_channel_rate(self):
+        outbox = slack_outbox.SlackOutbox(
+            self.slack_client, rate=5, burst=1, coalesce_window=0,
+            max_post_length=1)
+
+        for text in ('a', 'b', 'c'):
+            outbox.send('C1', text)
+        self.assertFalse(outbox.flush(timeout=0.2))
+        self.assertTrue(outbox.flush(timeout=5))
+
+        self.assertEqual([('C1', 'a'), ('C1', 'b'), ('C1', 'c')],
+                         self.posted())
+
+    def test_slack_sender_queues(self):
+        outbox = mock.Mock()
+        sender = SlackSender(self.slack_client, 'C1', outbox=outbox)
+
+        sender.send_message('hi\n')
+
+        outbox.send.assert_called_once_with('C1', 'hi\n')
+        self.slack_client.api_call.assert_not_called()
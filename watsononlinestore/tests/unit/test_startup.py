@@ -0,0 +1,61 @@
+import collections
+import threading
+import unittest
+
+from watsononlinestore import startup
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_timer(self):
+        clock = FakeClock()
+        timer = startup.StartupTimer(clock=clock)
+        clock.now += 0.25
+        timer.lap('env')
+        with timer.phase('import'):
+            clock.now += 0.5
+        clock.now += 0.1
+        timer.lap('clients')
+        timer.record('import', 0.125)
+
+        self.assertEqual(
+            'env=0.250s import=0.625s clients=0.600s total=0.850s',
+            timer.report())
+
+    def test_probes_run_concurrently(self):
+        timer = startup.StartupTimer()
+        # Each probe waits for the other, so only concurrent probes finish.
+        barrier = [threading.Event(), threading.Event()]
+
+        def probe(mine, other):
+            barrier[mine].set()
+            return barrier[other].wait(5)
+
+        results = startup.run_probes(timer, collections.OrderedDict([
+            ('bot_id', lambda: probe(0, 1)),
+            ('store', lambda: probe(1, 0))]))
+
+        self.assertEqual({'bot_id': True, 'store': True}, results)
+        self.assertEqual(['probe.bot_id', 'probe.store'],
+                         sorted(timer.phases))
+
+    def test_probe_failure(self):
+        finished = []
+
+        def fail():
+            raise ValueError("no workspace")
+
+        probes = collections.OrderedDict([
+            ('workspace', fail), ('store', lambda: finished.append(1))])
+        self.assertRaises(ValueError, startup.run_probes,
+                          startup.StartupTimer(), probes)
+        self.assertEqual([1], finished)
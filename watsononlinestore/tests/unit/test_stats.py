@@ -0,0 +1,39 @@
+import unittest
+
+import mock
+
+from watsononlinestore import stats
+
+
+class StatsLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats_logger = stats.StatsLogger(interval=60)
+
+    def test_logs_metrics_as_json(self):
+        self.stats_logger.add('outbox', lambda: {'sent': 2, 'failed': 0})
+
+        with mock.patch.object(stats.LOG, 'info') as info:
+            self.stats_logger.log()
+
+        info.assert_called_once_with('stats outbox {"failed":0,"sent":2}')
+
+    def test_failing_source_does_not_stop_the_others(self):
+        self.stats_logger.add('broken', mock.Mock(side_effect=ValueError))
+        self.stats_logger.add('cache', lambda: {'hits': 1})
+
+        with mock.patch.object(stats.LOG, 'info') as info, \
+                mock.patch.object(stats.LOG, 'exception') as exception:
+            self.stats_logger.log()
+
+        self.assertEqual(1, exception.call_count)
+        info.assert_called_once_with('stats cache {"hits":1}')
+
+    def test_stop_logs_a_last_time(self):
+        self.stats_logger.add('cache', lambda: {'hits': 1})
+        self.stats_logger.start()
+
+        with mock.patch.object(stats.LOG, 'info') as info:
+            self.stats_logger.stop()
+
+        info.assert_called_once_with('stats cache {"hits":1}')
@@ -0,0 +1,261 @@
+import collections
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+import mock
+
+from watsononlinestore import supervisor
+from watsononlinestore.inbound_queue import InboundQueue
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# Turns taken by the worker processes, as (pid, user).
+TURNS = None
+
+
+class RecordingBot(object):
+
+    inbound_queue = None
+
+    def init_store(self):
+        pass
+
+    def handle_accepted_output(self, slack_output):
+        for event in slack_output:
+            TURNS.put((os.getpid(), event['user']))
+        if self.inbound_queue is not None:
+            self.inbound_queue.ack(slack_output)
+
+    def finish_turns(self, timeout=None):
+        return True
+
+
+def make_recording_bot():
+    bot = RecordingBot()
+    bot.profiler = mock.Mock()
+    return bot
+
+
+class FakeProcess(object):
+
+    def __init__(self, target, name, args):
+        self.pid = None
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.pid = 1000
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        pass
+
+
+class FakeContext(object):
+    """multiprocessing stand-in that starts no processes."""
+
+    Process = FakeProcess
+
+    @staticmethod
+    def Queue(size):
+        return queue.Queue(size)
+
+    @staticmethod
+    def Value(typecode, value):
+        return mock.Mock(value=value)
+
+
+def event(user, text='hi', channel=None, ts='1.1'):
+    return {'type': 'message', 'user': user, 'text': text,
+            'channel': channel or 'D' + user, 'ts': ts}
+
+
+def inbound_queue(test):
+    tmp_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp_dir)
+    return os.path.join(tmp_dir, 'inbound.db')
+
+
+class HashRingTestCase(unittest.TestCase):
+
+    def test_spread_and_stable(self):
+        ring = supervisor.HashRing(range(4))
+        users = ['U%04d' % i for i in range(2000)]
+        owners = dict((user, ring.node_for(user)) for user in users)
+        counts = collections.Counter(owners.values())
+        self.assertEqual([0, 1, 2, 3], sorted(counts))
+        self.assertTrue(min(counts.values()) > 300, counts)
+
+        # Removing a node only moves the keys it owned.
+        smaller = supervisor.HashRing([0, 1, 2])
+        moved = [user for user in users
+                 if smaller.node_for(user) != owners[user]]
+        self.assertEqual(set([3]), set(owners[user] for user in moved))
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = supervisor.Supervisor(
+            mock.Mock(), 'UBOT', workers=3, check_interval=60,
+            context=FakeContext())
+        self.supervisor.start()
+        self.addCleanup(self.supervisor.stopping.set)
+
+    def inbox(self, index):
+        batches = []
+        while not self.supervisor.inboxes[index].empty():
+            batches.append(self.supervisor.inboxes[index].get_nowait())
+        return batches
+
+    def test_routes_by_user(self):
+        events = [event('U1'), event('U2', 'a'), event('U1', 'again'),
+                  event('U3', '<@UBOT> hats', channel='C1'),
+                  # Not for the bot.
+                  event('U4', 'lunch?', channel='C1'),
+                  event('UBOT', 'hello', channel='DU1'),
+                  {'type': 'presence_change', 'user': 'U1'},
+                  dict(event('U2'), user_profile={})]
+        self.supervisor.handle_slack_output(events)
+
+        routed = {}
+        for index in range(3):
+            for batch in self.inbox(index):
+                for routed_event in batch:
+                    routed.setdefault(routed_event['user'], set()).add(index)
+                    self.assertEqual(index,
+                                     self.supervisor.route(routed_event))
+        self.assertEqual(set(['U1', 'U2', 'U3']), set(routed))
+        self.assertTrue(all(len(indexes) == 1 for indexes in routed.values()))
+
+    def test_restarts_dead_and_hung_workers(self):
+        now = time.time()
+        dead, hung, healthy = self.supervisor.processes
+        dead.alive = False
+        self.supervisor.heartbeats[1].value = now - 120
+
+        with mock.patch.object(supervisor.Supervisor, '_kill') as kill:
+            self.assertEqual([0, 1], self.supervisor.check(now))
+        kill.assert_called_once_with(hung)
+        self.assertIsNot(dead, self.supervisor.processes[0])
+        self.assertIs(healthy, self.supervisor.processes[2])
+
+        # A worker crashing again is restarted after a growing backoff.
+        self.supervisor.processes[0].alive = False
+        self.assertEqual([], self.supervisor.check(now + 0.5))
+        self.assertEqual([0], self.supervisor.check(now + 1))
+        self.supervisor.processes[0].alive = False
+        self.assertEqual([], self.supervisor.check(now + 2))
+        self.assertEqual([0], self.supervisor.check(now + 3))
+        self.assertEqual(3, self.supervisor.status()[0]['restarts'])
+
+    def test_drain(self):
+        self.supervisor.processes[1].alive = True
+        with mock.patch.object(supervisor.Supervisor, '_kill') as kill:
+            for process in self.supervisor.processes:
+                process.alive = process is self.supervisor.processes[1]
+            self.assertFalse(self.supervisor.drain(timeout=0))
+        kill.assert_called_once_with(self.supervisor.processes[1])
+        self.assertEqual([[None]] * 3, [self.inbox(i) for i in range(3)])
+
+        # Nothing is accepted, routed or restarted once draining.
+        self.assertIsNone(self.supervisor.accept_slack_output([event('U1')]))
+        self.supervisor.handle_slack_output([event('U1')])
+        self.assertEqual([[]] * 3, [self.inbox(i) for i in range(3)])
+        self.assertEqual([], self.supervisor.check())
+
+    def test_inbound_queue_replays_unanswered_events(self):
+        path = inbound_queue(self)
+        queue = InboundQueue(path)
+        self.addCleanup(queue.close)
+        first = supervisor.Supervisor(
+            mock.Mock(), 'UBOT', workers=3, check_interval=60,
+            context=FakeContext(), inbound_queue=queue)
+        first.start()
+        self.addCleanup(first.stopping.set)
+        first.handle_slack_output([event('U1'), event('U2')])
+        first.handle_slack_output([event('U1')])
+        self.assertEqual(2, queue.pending())
+        first.drain(timeout=0)
+        queue.close()
+
+        # Not answered before the drain, so routed again.
+        queue = InboundQueue(path)
+        self.addCleanup(queue.close)
+        second = supervisor.Supervisor(
+            mock.Mock(), 'UBOT', workers=3, check_interval=60,
+            context=FakeContext(), inbound_queue=queue)
+        second.start()
+        self.addCleanup(second.stopping.set)
+        routed = [routed_event['user']
+                  for index in range(3)
+                  for batch in second.inboxes[index].queue
+                  for routed_event in batch]
+        self.assertEqual(['U1', 'U2'], sorted(routed))
+
+
+@unittest.skipUnless(hasattr(multiprocessing, 'get_context') and
+                     hasattr(os, 'fork'), "needs forked processes")
+class WorkerProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        global TURNS
+        context = multiprocessing.get_context('fork')
+        TURNS = context.Queue()
+        self.supervisor = supervisor.Supervisor(
+            make_recording_bot, 'UBOT', workers=2, check_interval=60,
+            context=context)
+        self.supervisor.start()
+        self.addCleanup(self.supervisor.drain, 5)
+
+    def turns(self, count):
+        return [TURNS.get(timeout=10) for _ in range(count)]
+
+    def test_affinity_restart_and_drain(self):
+        users = ['U%d' % i for i in range(8)]
+        for _ in range(2):
+            self.supervisor.handle_slack_output([event(u) for u in users])
+        pids = collections.defaultdict(set)
+        for pid, user in self.turns(16):
+            pids[user].add(pid)
+        self.assertEqual(set(users), set(pids))
+        self.assertTrue(all(len(user_pids) == 1
+                            for user_pids in pids.values()))
+
+        crashed = self.supervisor.processes[0]
+        os.kill(crashed.pid, signal.SIGKILL)
+        crashed.join(5)
+        self.assertEqual([0], self.supervisor.check())
+        self.supervisor.handle_slack_output([event(u) for u in users])
+        self.assertEqual(8, len(self.turns(8)))
+
+        self.assertTrue(self.supervisor.drain(timeout=10))
+        self.assertFalse(any(process.is_alive()
+                             for process in self.supervisor.processes))
+
+    def test_workers_acknowledge_events(self):
+        self.supervisor.drain(5)
+        queue = InboundQueue(inbound_queue(self))
+        self.addCleanup(queue.close)
+        self.supervisor = supervisor.Supervisor(
+            make_recording_bot, 'UBOT', workers=2, check_interval=60,
+            context=multiprocessing.get_context('fork'),
+            inbound_queue=queue)
+        self.supervisor.start()
+
+        self.supervisor.handle_slack_output([event('U%d' % i)
+                                             for i in range(4)])
+        self.assertEqual(4, len(self.turns(4)))
+        self.assertTrue(self.supervisor.drain(timeout=10))
+        self.assertEqual(0, queue.pending())
@@ -0,0 +1,87 @@
+import unittest
+
+import mock
+from requests.exceptions import HTTPError
+
+from watsononlinestore.database import throttle
+from watsononlinestore.resilience import Deadline
+
+
+def http_error(status_code):
+    return HTTPError(response=mock.Mock(status_code=status_code))
+
+
+class CloudantThrottleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        self.throttle = throttle.CloudantThrottle(
+            {throttle.WRITE: 2}, max_wait=1.0, retries=2, backoff=0.1,
+            clock=lambda: self.now, sleep=sleep)
+
+    def test_parse_budgets(self):
+        self.assertEqual({'lookup': 20.0, 'write': 10.0},
+                         throttle.parse_budgets('lookup=20, write=10'))
+        self.assertEqual({}, throttle.parse_budgets(None))
+        self.assertRaises(ValueError, throttle.parse_budgets, 'reads=1')
+
+    def test_burst_waits_for_budget(self):
+        for _ in range(3):
+            self.throttle.call(throttle.WRITE, lambda: None)
+
+        self.assertEqual([0.5], self.sleeps)
+        metrics = self.throttle.metrics()[throttle.WRITE]
+        self.assertEqual(3, metrics['requests'])
+        self.assertEqual(1, metrics['throttled'])
+        self.assertEqual(0.5, metrics['wait_time'])
+
+    def test_unlimited_class_does_not_wait(self):
+        for _ in range(10):
+            self.throttle.call(throttle.QUERY, lambda: None)
+
+        self.assertEqual([], self.sleeps)
+        self.assertEqual(10, self.throttle.metrics()['query']['requests'])
+
+    def test_wait_is_bounded_by_deadline(self):
+        self.throttle.call(throttle.WRITE, lambda: None)
+        self.throttle.call(throttle.WRITE, lambda: None)
+
+        self.throttle.call(throttle.WRITE, lambda: None,
+                           deadline=Deadline(0.1, clock=lambda: self.now))
+
+        self.assertEqual([], self.sleeps)
+        self.assertEqual(
+            1, self.throttle.metrics()[throttle.WRITE]['over_budget'])
+
+    def test_retries_rate_limited(self):
+        func = mock.Mock(side_effect=[http_error(429), 'ok'])
+
+        self.assertEqual('ok', self.throttle.call(
+            (throttle.LOOKUP, throttle.WRITE), func, 'arg'))
+
+        func.assert_called_with('arg')
+        self.assertEqual(1, len(self.sleeps))
+        metrics = self.throttle.metrics()
+        self.assertEqual(1, metrics[throttle.LOOKUP]['rate_limited'])
+        self.assertEqual(2, metrics[throttle.WRITE]['requests'])
+
+    def test_gives_up_after_retries(self):
+        func = mock.Mock(side_effect=http_error(429))
+
+        self.assertRaises(HTTPError, self.throttle.call, throttle.QUERY, func)
+
+        self.assertEqual(3, func.call_count)
+
+    def test_other_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=http_error(500))
+
+        self.assertRaises(HTTPError, self.throttle.call, throttle.QUERY, func)
+
+        self.assertEqual(1, func.call_count)
+        self.assertEqual([], self.sleeps)
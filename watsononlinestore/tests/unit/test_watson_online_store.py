@@ -11,6 +11,10 @@ class WOSTestCase(unittest.TestCase):
 
     def setUp(self):
         mock.Mock(watson_online_store.os.environ, return_value={})
+        breakers = mock.patch.dict(watson_online_store.resilience._breakers,
+                                   clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
         self.slack_client = mock.Mock()
         self.conv_client = mock.Mock()
         self.fake_workspace_id = 'fake workspace id'
@@ -238,3 +242,382 @@ class WOSTestCase(unittest.TestCase):
             counterexamples=ws_json['counterexamples'],
             metadata=ws_json['metadata'])
         self.assertEqual(expected_workspace_id, actual)
+
+    def test_handle_slack_output_session_read_once_write_once(self):
+        store = mock.Mock(wraps=watson_online_store.InMemorySessionStore())
+        self.wosbot.session_store = store
+        self.wosbot.init_customer = mock.Mock()
+        self.conv_client.message.return_value = {
+            'context': {'conversation_id': 'c1'},
+            'output': {'text': ['hi']},
+        }
+
+        self.wosbot.handle_slack_output(
+            [{'text': 'hello', 'channel': 'DXXX', 'user': 'U1'}])
+
+        store.load.assert_called_once_with('U1')
+        self.assertEqual(1, store.save.call_count)
+        self.assertEqual({'conversation_id': 'c1'},
+                         store.load('U1').context)
+
+    def test_handle_slack_output_session_unchanged_not_written(self):
+        store = mock.Mock(wraps=watson_online_store.InMemorySessionStore())
+        self.wosbot.session_store = store
+        self.wosbot.init_customer = mock.Mock()
+        self.conv_client.message.return_value = {
+            'output': {'text': ['hi']},
+        }
+
+        self.wosbot.handle_slack_output(
+            [{'text': 'hello', 'channel': 'DXXX', 'user': 'U1'}])
+
+        store.save.assert_not_called()
+
+    def test_handle_slack_output_sessions_per_user(self):
+        self.wosbot.init_customer = mock.Mock()
+        self.conv_client.message.side_effect = [
+            {'context': {'user': 'one'}, 'output': {'text': ['hi']}},
+            {'context': {'user': 'two'}, 'output': {'text': ['hi']}},
+            {'context': {'user': 'one', 'again': True},
+             'output': {'text': ['hi']}},
+        ]
+
+        for user in ('U1', 'U2', 'U1'):
+            self.wosbot.handle_slack_output(
+                [{'text': 'hello', 'channel': 'DXXX', 'user': user}])
+
+        contexts = [c[1]['context']
+                    for c in self.conv_client.message.call_args_list]
+        self.assertEqual([{}, {}, {'user': 'one'}], contexts)
+
+    def test_conversation_failure_apologizes(self):
+        sender = mock.Mock()
+        self.conv_client.message.side_effect = IOError("Boom")
+
+        get_input = self.wosbot.handle_message("hello", sender)
+
+        self.assertTrue(get_input)
+        sender.send_message.assert_called_once_with(
+            watson_online_store.CONVERSATION_UNAVAILABLE)
+
+    def test_discovery_failure_uses_cached_results(self):
+        self.wosbot.discovery_data_source = 'ibm_store'
+        self.discovery_client.query.return_value = {
+            'results': [{'text': 'x Product:Cap\nCategory:hats',
+                         'html': ''}]}
+        self.wosbot.context = {'discovery_string': 'cap'}
+        self.wosbot.handle_DiscoveryQuery()
+        good = self.wosbot.context['discovery_result']
+
+        self.discovery_client.query.side_effect = IOError("Boom")
+        self.wosbot.response_tuple = None
+        with mock.patch.object(watson_online_store.resilience.time,
+                               'sleep'):
+            self.wosbot.handle_DiscoveryQuery()
+
+        self.assertEqual(good, self.wosbot.context['discovery_result'])
+        self.assertEqual('Cap', self.wosbot.response_tuple[0]['name'])
+
+    def test_discovery_failure_without_cache(self):
+        self.discovery_client.query.side_effect = IOError("Boom")
+        self.wosbot.context = {'discovery_string': 'cap'}
+
+        with mock.patch.object(watson_online_store.resilience.time,
+                               'sleep'):
+            self.wosbot.handle_DiscoveryQuery()
+
+        self.assertEqual(watson_online_store.DISCOVERY_UNAVAILABLE,
+                         self.wosbot.context['discovery_result'])
+        self.assertEqual([], self.wosbot.response_tuple)
+
+    def test_category_query_skips_discovery(self):
+        self.wosbot.discovery_data_source = 'ibm_store'
+        self.wosbot.category_index = mock.Mock()
+        self.wosbot.category_index.lookup.return_value = [
+            {'name': 'Cap %d' % i, 'url': 'http://cap/%d' % i, 'image': ''}
+            for i in range(7)]
+        self.wosbot.context = {'discovery_string': 'show me hats'}
+
+        self.wosbot.handle_DiscoveryQuery()
+
+        self.wosbot.category_index.lookup.assert_called_once_with(
+            'show me hats', ['ibm_store'])
+        self.assertFalse(self.discovery_client.query.called)
+        self.assertEqual(['1', '7'], [self.wosbot.response_tuple[0][
+            'cart_number'], self.wosbot.response_tuple[-1]['cart_number']])
+        self.assertEqual(watson_online_store.DISCOVERY_KEEP_COUNT,
+                         self.wosbot.results_shown)
+        self.assertIn(watson_online_store.MORE_RESULTS_HINT,
+                      self.wosbot.context['discovery_result'])
+
+    def test_unknown_category_falls_back_to_discovery(self):
+        self.wosbot.discovery_data_source = 'amazon'
+        self.wosbot.category_index = mock.Mock()
+        self.wosbot.category_index.lookup.return_value = None
+        self.discovery_client.query.return_value = {'results': [
+            {'score': 1.0, 'extracted_metadata': {'title': 'Blue Hat'}}]}
+        self.wosbot.context = {'discovery_string': 'blue hats'}
+
+        self.wosbot.handle_DiscoveryQuery()
+
+        self.assertTrue(self.discovery_client.query.called)
+        self.assertEqual('Blue Hat', self.wosbot.response_tuple[0]['name'])
+
+    def test_without_discovery_only_categories_are_searched(self):
+        self.wosbot.discovery_client = None
+        self.wosbot.category_index = mock.Mock()
+        self.wosbot.category_index.lookup.side_effect = lambda query, _: (
+            [{'name': 'Cap', 'url': 'http://cap', 'image': ''}]
+            if query == 'show me hats' else None)
+        self.wosbot.get_fake_discovery_response = mock.Mock()
+        sender = mock.Mock()
+        self.conv_client.message.return_value = {
+            'context': {'discovery_string': 'blue cotton shirts'},
+            'output': {'text': ['Sorry, search is not available.']}}
+
+        self.assertTrue(self.wosbot.handle_message('blue cotton shirts',
+                                                   sender))
+        self.assertEqual([], self.wosbot.turn_branches)
+
+        self.conv_client.message.return_value = {
+            'context': {'discovery_string': 'show me hats'},
+            'output': {'text': ['Here are some hats.']}}
+        self.assertFalse(self.wosbot.handle_message('show me hats', sender))
+        self.assertEqual(['handle_DiscoveryQuery'], self.wosbot.turn_branches)
+        self.assertEqual('Cap', self.wosbot.response_tuple[0]['name'])
+        self.wosbot.get_fake_discovery_response.assert_not_called()
+
+    def test_federated_discovery_merges_by_normalized_score(self):
+        self.wosbot.discovery_sources = [('ibm', 'ibm_store'),
+                                         ('amz', 'amazon')]
+
+        def query(environment_id, collection_id, query_options):
+            if collection_id == 'ibm':
+                return {'results': [
+                    {'score': 2.0, 'text': 'x Product:Cap\nCategory:a'},
+                    {'score': 0.5, 'text': 'x Product:Mug\nCategory:a'}]}
+            return {'results': [
+                {'score': 20.0, 'extracted_metadata': {'title': 'Hat'}},
+                {'score': 16.0, 'extracted_metadata': {'title': 'Bag'}}]}
+
+        self.discovery_client.query.side_effect = query
+
+        response, _ = self.wosbot.query_discovery('cap')
+
+        self.assertEqual(['Cap', 'Hat', 'Bag', 'Mug'],
+                         [item['name'] for item in response])
+        self.assertEqual(['1', '2', '3', '4'],
+                         [item['cart_number'] for item in response])
+
+    def test_federated_discovery_keeps_count_after_merge(self):
+        self.wosbot.discovery_sources = [('ibm', 'ibm_store'),
+                                         ('amz', 'amazon')]
+        self.discovery_client.query.return_value = {'results': [
+            {'score': 1.0, 'extracted_metadata': {'title': 'Hat'}}] * 4}
+
+        response, result = self.wosbot.query_discovery('hat')
+
+        self.assertEqual(8, len(response))
+        self.assertEqual(watson_online_store.DISCOVERY_KEEP_COUNT,
+                         result['discovery_result'].count(') '))
+
+    def search_results(self, count):
+        self.discovery_client.query.return_value = {'results': [
+            {'score': 1.0 - i / 100.0,
+             'extracted_metadata': {'title': 'Hat %d' % i}}
+            for i in range(count)]}
+        self.wosbot.discovery_data_source = 'amazon'
+        self.wosbot.context = {'discovery_string': 'hats'}
+        self.wosbot.handle_DiscoveryQuery()
+
+    def test_more_results_are_paged_locally(self):
+        self.search_results(12)
+        self.wosbot.paging = True
+        self.assertIn(watson_online_store.MORE_RESULTS_HINT,
+                      self.wosbot.context['discovery_result'])
+        sender = mock.Mock()
+
+        self.assertTrue(self.wosbot.handle_message('More!', sender))
+        self.assertTrue(self.wosbot.handle_message('next', sender))
+        self.wosbot.handle_message('more', sender)
+
+        self.assertEqual(1, self.discovery_client.query.call_count)
+        self.conv_client.message.assert_not_called()
+        pages = [c[0][0] for c in sender.send_message.call_args_list]
+        self.assertIn('6) Hat 5', pages[0])
+        self.assertNotIn('5) Hat 4', pages[0])
+        self.assertIn('11) Hat 10', pages[1])
+        self.assertNotIn(watson_online_store.MORE_RESULTS_HINT, pages[1])
+        self.assertEqual(watson_online_store.NO_MORE_RESULTS, pages[2])
+
+    def test_add_to_cart_from_later_page(self):
+        self.search_results(8)
+        self.wosbot.handle_more_results(mock.Mock())
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.context = {'cart_item': '7'}
+
+        self.wosbot.handle_add_to_cart()
+
+        item = self.cloudant_store.add_to_shopping_cart.call_args[0][1]
+        self.assertEqual('Hat 6', item['name'])
+
+    def test_similar_to_listed_item(self):
+        self.wosbot.similar_products = mock.Mock()
+        self.wosbot.similar_products.similar.return_value = [
+            {'id': '9', 'name': 'Mug', 'url': 'http://m?pid=9', 'image': ''}]
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'name': 'Cap', 'url': 'http://c?pid=1'}]
+        sender = mock.Mock()
+
+        self.assertTrue(self.wosbot.handle_message('Similar to 1', sender))
+
+        self.wosbot.similar_products.similar.assert_called_once_with('1')
+        self.assertIn('1) Mug', sender.send_message.call_args[0][0])
+        self.assertEqual('9', self.wosbot.response_tuple[0]['id'])
+        self.conv_client.message.assert_not_called()
+
+    def test_similar_to_unknown_item(self):
+        self.wosbot.similar_products = mock.Mock()
+        self.wosbot.response_tuple = []
+        sender = mock.Mock()
+
+        self.wosbot.handle_message('similar to 3', sender)
+
+        sender.send_message.assert_called_once_with("There is no item 3.\n")
+
+    def test_recommendations_after_add(self):
+        self.wosbot.similar_products = mock.Mock()
+        self.wosbot.similar_products.similar.return_value = [
+            {'id': '9', 'name': 'Mug', 'url': 'http://mug', 'image': ''}]
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'name': 'Cap', 'url': 'http://c?pid=1'}]
+        self.wosbot.context = {'cart_item': '1'}
+        self.cloudant_store.list_shopping_cart.return_value = []
+
+        self.wosbot.handle_add_to_cart()
+        self.wosbot.handle_list_shopping_cart()
+
+        self.assertEqual("\nYou might also like:\nMug: http://mug\n",
+                         self.wosbot.context['shopping_cart'])
+        self.wosbot.handle_list_shopping_cart()
+        self.assertEqual("", self.wosbot.context['shopping_cart'])
+
+    def test_more_without_results_goes_to_conversation(self):
+        self.conv_client.message.return_value = {
+            'context': {}, 'output': {'text': ['hi']}}
+
+        self.wosbot.handle_message('more', mock.Mock())
+
+        self.assertTrue(self.conv_client.message.called)
+
+    def test_more_only_pages_right_after_results(self):
+        self.conv_client.message.return_value = {
+            'context': {}, 'output': {'text': ['hi']}}
+        self.search_results(12)
+        session = watson_online_store.Session('U1')
+        self.wosbot.turn_branches = ['handle_DiscoveryQuery']
+        self.wosbot.save_session(session, None)
+        self.wosbot.load_session('U1')
+        sender = mock.Mock()
+
+        self.wosbot.turn_branches = []
+        self.wosbot.handle_message('more', sender)
+        self.wosbot.turn_branches = ['handle_more_results']
+        self.wosbot.save_session(session, None)
+        self.wosbot.load_session('U1')
+        self.wosbot.handle_message('hello', sender)
+        self.wosbot.turn_branches = []
+        self.wosbot.save_session(session, None)
+        self.wosbot.load_session('U1')
+        self.wosbot.handle_message('more', sender)
+
+        self.assertIn('6) Hat 5', sender.send_message.call_args_list[0][0][0])
+        self.assertEqual(2, self.conv_client.message.call_count)
+
+    def test_federated_discovery_skips_failed_source(self):
+        self.wosbot.discovery_sources = [('ibm', 'ibm_store'),
+                                         ('amz', 'amazon')]
+
+        def query(environment_id, collection_id, query_options):
+            if collection_id == 'ibm':
+                raise IOError("Boom")
+            return {'results': [
+                {'score': 1.0, 'extracted_metadata': {'title': 'Hat'}}]}
+
+        self.discovery_client.query.side_effect = query
+
+        with mock.patch.object(watson_online_store.resilience.time,
+                               'sleep'):
+            response, _ = self.wosbot.query_discovery('hat')
+
+        self.assertEqual(['Hat'], [item['name'] for item in response])
+
+    def test_parse_discovery_sources(self):
+        self.assertEqual(
+            [('c1', 'ibm_store'), ('c2', 'amazon')],
+            self.wosbot.parse_discovery_sources('c1:ibm_store, c2:amazon'))
+        self.assertEqual([], self.wosbot.parse_discovery_sources(None))
+
+    def test_discovery_query_key_is_normalized(self):
+        self.wosbot.discovery_flight = mock.Mock()
+        self.wosbot.discovery_flight.do.return_value = ([], {})
+
+        self.wosbot.get_discovery_response('  Blue   Hats ')
+
+        key = self.wosbot.discovery_flight.do.call_args[0][0]
+        self.assertEqual('blue hats', key[0])
+
+    def test_handle_list_shopping_cart(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.cloudant_store.list_shopping_cart.return_value = [
+            {'id': '1', 'name': 'Cap', 'url': 'http://cap', 'qty': 2},
+            {'id': '2', 'name': 'Mug', 'url': 'http://mug', 'qty': 1}]
+
+        self.wosbot.handle_list_shopping_cart()
+
+        self.assertEqual("1) Cap: http://cap (x2)\n2) Mug: http://mug\n",
+                         self.wosbot.context['shopping_cart'])
+
+    def test_handle_add_to_cart(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.wosbot.response_tuple = [
+            {'cart_number': '1', 'name': 'Cap', 'url': 'http://c?pid=1'},
+            {'cart_number': '2', 'name': 'Mug', 'url': 'http://m?pid=2'}]
+        self.wosbot.context = {'cart_item': '2'}
+
+        self.wosbot.handle_add_to_cart()
+
+        email, item = self.cloudant_store.add_to_shopping_cart.call_args[0]
+        self.assertEqual('e@mail', email)
+        self.assertEqual(('2', 'Mug', 1),
+                         (item['id'], item['name'], item['qty']))
+
+    def test_handle_delete_from_cart(self):
+        self.wosbot.customer = watson_online_store.OnlineStoreCustomer(
+            email='e@mail')
+        self.cloudant_store.list_shopping_cart.return_value = [
+            {'id': '1', 'name': 'Cap', 'url': 'http://cap', 'qty': 2},
+            {'id': '2', 'name': 'Mug', 'url': 'http://mug', 'qty': 1}]
+        self.wosbot.context = {'cart_item': '1'}
+
+        self.wosbot.handle_delete_from_cart()
+
+        self.cloudant_store.delete_item_shopping_cart.assert_called_once_with(
+            'e@mail', '1')
+
+    def test_given_workspace_and_ready_store(self):
+        self.conv_client.reset_mock()
+        bot = watson_online_store.WatsonOnlineStore(
+            'UBOTID', self.slack_client, self.conv_client, None,
+            self.cloudant_store, workspace_id='probed workspace')
+        self.assertEqual('probed workspace', bot.workspace_id)
+        self.assertFalse(self.conv_client.list_workspaces.called)
+
+        bot.init_store()
+        bot.init_store()
+        self.cloudant_store.init.assert_called_once_with()
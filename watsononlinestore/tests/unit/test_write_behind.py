@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from watsononlinestore.database import cart
+from watsononlinestore.database import write_behind
+
+
+def item(pid, name='Cap'):
+    return cart.new_cart_item(name, 'http://store/?pid=' + pid, added=1)
+
+
+def applied(store, call=-1):
+    """Email and ops of a call to store.apply_cart_ops, without op IDs."""
+    email, ops = store.apply_cart_ops.call_args_list[call][0]
+    return email, [op[:2] for op in ops]
+
+
+class CartWriteBehindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.journal_path = os.path.join(self.tmp_dir, 'cart.journal')
+        self.store = mock.Mock()
+        self.store.list_stored_cart.return_value = [item('1')]
+
+    def buffer(self):
+        wb = write_behind.CartWriteBehind(self.store, flush_interval=60,
+                                          journal_path=self.journal_path)
+        wb.start()
+        self.addCleanup(wb.stop)
+        return wb
+
+    def test_record_updates_buffered_cart(self):
+        wb = self.buffer()
+
+        wb.record('e@mail', [cart.ADD, item('2')])
+        wb.record('e@mail', [cart.ADD, item('1')])
+
+        buffered = wb.get_cart('e@mail')
+        self.assertEqual(['1', '2'], [i['id'] for i in buffered])
+        self.assertEqual(2, buffered[0]['qty'])
+        self.store.list_stored_cart.assert_called_once_with('e@mail')
+        self.store.apply_cart_ops.assert_not_called()
+
+    def test_flush_merges_ops_per_customer(self):
+        wb = self.buffer()
+        wb.record('e@mail', [cart.ADD, item('2')])
+        wb.record('e@mail', [cart.DELETE, '1'])
+
+        wb.flush()
+
+        self.assertEqual(1, self.store.apply_cart_ops.call_count)
+        self.assertEqual(
+            ('e@mail', [[cart.ADD, item('2')], [cart.DELETE, '1']]),
+            applied(self.store))
+        self.assertIsNone(wb.get_cart('e@mail'))
+        with open(self.journal_path) as journal:
+            self.assertEqual('', journal.read())
+
+    def test_failed_flush_is_retried(self):
+        wb = self.buffer()
+        wb.record('e@mail', [cart.ADD, item('2')])
+        self.store.apply_cart_ops.side_effect = Exception('down')
+
+        wb.flush()
+
+        self.assertIsNotNone(wb.get_cart('e@mail'))
+        self.store.apply_cart_ops.side_effect = None
+        wb.record('e@mail', [cart.DELETE, '1'])
+        wb.flush()
+        self.assertEqual(
+            ('e@mail', [[cart.ADD, item('2')], [cart.DELETE, '1']]),
+            applied(self.store))
+        # The same op, with the same ID, in both attempts.
+        self.assertEqual(self.store.apply_cart_ops.call_args_list[0][0][1],
+                         self.store.apply_cart_ops.call_args_list[1][0][1][:1])
+        with open(self.journal_path) as journal:
+            self.assertEqual('', journal.read())
+
+    def test_failed_lookup_stays_journaled(self):
+        wb = self.buffer()
+        self.store.apply_cart_ops.side_effect = IOError('Cloudant down')
+        wb.record('e@mail', [cart.ADD, item('2')])
+
+        wb.flush()
+
+        with open(self.journal_path) as journal:
+            self.assertEqual(1, len(journal.readlines()))
+
+    def test_journal_replayed_after_crash(self):
+        crashed = write_behind.CartWriteBehind(
+            self.store, flush_interval=60, journal_path=self.journal_path)
+        crashed.start()
+        crashed.stopped.set()
+        crashed.record('e@mail', [cart.ADD, item('2')])
+        with open(self.journal_path, 'a') as journal:
+            journal.write('{"email": "e@')  # torn write
+
+        self.buffer()
+
+        self.assertEqual(1, self.store.apply_cart_ops.call_count)
+        self.assertEqual(('e@mail', [[cart.ADD, item('2')]]),
+                         applied(self.store))
+
+    def test_stop_flushes(self):
+        wb = write_behind.CartWriteBehind(self.store, flush_interval=60)
+        wb.start()
+        wb.record('e@mail', [cart.DELETE, '1'])
+
+        wb.stop()
+
+        self.assertEqual(1, self.store.apply_cart_ops.call_count)
+        self.assertEqual(('e@mail', [[cart.DELETE, '1']]),
+                         applied(self.store))
@@ -10,39 +10,80 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import json
 import logging
 import os
 import random
 import re
+import threading
 import time
 
+from watsononlinestore import profiling
+from watsononlinestore import resilience
+from watsononlinestore.database import cart
+from watsononlinestore.fair_scheduler import FairScheduler
+from watsononlinestore.fair_scheduler import turn_cost
+from watsononlinestore.log_config import Payload
+from watsononlinestore.session_store import InMemorySessionStore
+from watsononlinestore.session_store import Session
+from watsononlinestore.session_store import SessionConflict
+from watsononlinestore.singleflight import SingleFlight
 from watsononlinestore.tests.fake_discovery import FAKE_DISCOVERY
 
-logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
-# Limit the result count when calling Discovery query.
-DISCOVERY_QUERY_COUNT = 10
-# Limit more when formatting and filtering out "weak" results.
-# Also useful for allowing us to log more results for dev/test even
-# though we return fewer to the client.
+# Limit the result count when calling Discovery query. The ranked results
+# are kept in the session, so this is enough for a few pages.
+DISCOVERY_QUERY_COUNT = 20
+# Results shown at a time. Asking for "more" shows the next page from the
+# session without querying Discovery again.
 DISCOVERY_KEEP_COUNT = 5
+# Messages asking for the next page of results.
+MORE_RESULTS_REQUESTS = ('more', 'next', 'show more', 'more please')
+# Branches of a turn listing results. "more" only pages right after one.
+RESULTS_BRANCHES = ('handle_DiscoveryQuery', 'handle_similar_products',
+                    'handle_more_results')
+MORE_RESULTS_HINT = '\nSay "more" to see more results.'
+NO_MORE_RESULTS = "That's all I found. Try searching for something else.\n"
+# Messages asking for products similar to a listed item, e.g. "similar to 2".
+SIMILAR_REQUEST_RE = re.compile(r'^(?:similar to|more like) #?(\d+)$')
+# Recommendations shown with the cart after adding an item.
+RECOMMENDATION_COUNT = 3
 # Truncate the Discovery 'text'. It can be a lot. We'll add "..." if truncated.
 DISCOVERY_TRUNCATE = 500
+# Retries for Discovery queries, which are safe to repeat.
+DISCOVERY_RETRIES = 2
+# Remember the results of this many recent queries to fall back on when
+# Discovery is unavailable.
+DISCOVERY_CACHE_SIZE = 100
+# Seconds a whole turn may take, over all its external calls.
+TURN_DEADLINE = 10.0
+
+CONVERSATION_UNAVAILABLE = ("Sorry, I'm having trouble understanding you "
+                            "right now. Please try again in a minute.\n")
+DISCOVERY_UNAVAILABLE = ("\nSorry, product search is unavailable right "
+                         "now. Please try again in a minute.")
 
 
 class SlackSender:
 
-    def __init__(self, slack_client, channel):
+    def __init__(self, slack_client, channel, outbox=None):
         self.slack_client = slack_client
         self.channel = channel
+        self.outbox = outbox
 
     def send_message(self, message):
         """Sends message via Slack API.
 
+        With an outbox, the message is queued and posted asynchronously
+        within Slack's rate limits.
+
         :param str message: The message to be sent to slack
         """
+        if self.outbox:
+            self.outbox.send(self.channel, message)
+            return
         self.slack_client.api_call("chat.postMessage",
                                    channel=self.channel,
                                    text=message,
@@ -74,24 +115,100 @@ class OnlineStoreCustomer:
         return customer
 
 
-class WatsonOnlineStore:
+def parse_slack_event(event, bot_id):
+    """Message for the bot in a Slack event.
+
+    A message is for the bot when it mentions the bot, or when it is a
+    direct message from someone else.
+
+    :param dict event: Slack event
+    :param str bot_id: Slack user ID of the bot
+    :returns: text, channel, user, or three Nones when it is not for the
+              bot
+    :rtype: str, str, str
+    """
+    if event and 'text' in event and 'user' in event and (
+            'user_profile' not in event):
+        at_bot = "<@" + bot_id + ">"
+        if at_bot in event['text']:
+            return (''.join(event['text'].split(at_bot)).strip().lower(),
+                    event['channel'],
+                    event['user'])
+        elif (event['channel'].startswith('D') and
+              event['user'] != bot_id):
+            # Direct message!
+            return (event['text'].strip().lower(),
+                    event['channel'],
+                    event['user'])
+    return None, None, None
+
+
+class _TurnState(threading.local):
+    """State of the turn running on this thread, see WatsonOnlineStore."""
+
+    def __init__(self):
+        self.context = {}
+        self.customer = None
+        self.response_tuple = None
+        self.results_shown = 0
+        # Whether the last turn listed results, so "more" pages them.
+        self.paging = False
+        self.recommendations = []
+        # handle_* branches taken in the current turn, naming its profile.
+        self.turn_branches = []
+
+
+def _turn_attribute(name):
+    """Property keeping an attribute in the state of the thread's turn."""
+    return property(lambda self: getattr(self.turn_state, name),
+                    lambda self, value: setattr(self.turn_state, name, value))
+
+
+class WatsonOnlineStore(object):
+    # Shared by all bots in the process, so that identical searches
+    # running at the same time, in the turns of different users on the
+    # SlackEventsServer workers, make a single Discovery request.
+    discovery_flight = SingleFlight()
+
+    # The state of a turn is kept per thread, so that the turns of
+    # different users can run at the same time, see SlackEventsServer.
+    context = _turn_attribute('context')
+    customer = _turn_attribute('customer')
+    response_tuple = _turn_attribute('response_tuple')
+    results_shown = _turn_attribute('results_shown')
+    paging = _turn_attribute('paging')
+    recommendations = _turn_attribute('recommendations')
+    turn_branches = _turn_attribute('turn_branches')
+
     def __init__(self, bot_id, slack_client,
                  conversation_client, discovery_client,
-                 cloudant_online_store):
+                 cloudant_online_store, session_store=None,
+                 slack_outbox=None, similar_products=None,
+                 category_index=None, profiler=None, workspace_id=None):
 
         # specific for Slack as UI
         self.bot_id = bot_id
         self.slack_client = slack_client
         self.at_bot = "<@" + bot_id + ">"
+        # Optional SlackOutbox for rate limited, asynchronous posting
+        self.slack_outbox = slack_outbox
+        # Optional SimilarProducts table for recommendations
+        self.similar_products = similar_products
+        # Optional CategoryIndex answering browse queries without Discovery
+        self.category_index = category_index
 
         # IBM Watson Conversation
         self.conversation_client = conversation_client
         self.discovery_client = discovery_client
-        self.workspace_id = self.setup_conversation_workspace(
+        # run.py looks the workspace up while it makes its other startup
+        # calls, and passes it in.
+        self.workspace_id = workspace_id or self.setup_conversation_workspace(
             conversation_client, os.environ)
 
         # IBM Cloudant noSQL database
         self.cloudant_online_store = cloudant_online_store
+        # Whether init_store() already made sure the DB exists.
+        self.store_ready = False
 
         # IBM Discovery Service
         self.discovery_data_source = os.environ.get(
@@ -100,6 +217,10 @@ class WatsonOnlineStore:
             'DISCOVERY_ENVIRONMENT_ID')
         self.discovery_collection_id = os.environ.get(
             'DISCOVERY_COLLECTION_ID')
+        # Optional list of collections to search in parallel, overriding
+        # DISCOVERY_COLLECTION_ID and DISCOVERY_DATA_SOURCE.
+        self.discovery_sources = self.parse_discovery_sources(
+            os.environ.get('DISCOVERY_SOURCES'))
         try:
             self.discovery_score_filter = float(os.environ.get(
                 "DISCOVERY_SCORE_FILTER", 0))
@@ -108,10 +229,33 @@ class WatsonOnlineStore:
                       "0.0 and 1.0. Using default value of 0.0")
             self.discovery_score_filter = 0
             pass
+        # Last good results by query, for when Discovery is unavailable.
+        self.discovery_cache = collections.OrderedDict()
+        self.discovery_cache_lock = threading.Lock()
 
-        self.context = {}
-        self.customer = None
-        self.response_tuple = None
+        try:
+            self.turn_deadline = float(os.environ.get(
+                "TURN_DEADLINE", TURN_DEADLINE))
+        except ValueError:
+            LOG.error("TURN_DEADLINE must be a number of seconds. "
+                      "Using default value of %s" % TURN_DEADLINE)
+            self.turn_deadline = TURN_DEADLINE
+
+        # Profiles sampled turns when switched on, see profiling.
+        self.profiler = profiler or profiling.from_environ(os.environ)
+
+        # Optional FairScheduler queuing turns, see enable_fair_scheduling.
+        self.scheduler = None
+        # Optional InboundQueue keeping messages until their turn is over,
+        # see enable_inbound_queue.
+        self.inbound_queue = None
+
+        # Per-user state is loaded from and saved to the session store
+        # around each turn, so any process can continue a conversation.
+        self.session_store = session_store or InMemorySessionStore()
+
+        # Context, customer, results and so on of the current turn.
+        self.turn_state = _TurnState()
         self.delay = 0.5  # second
 
     @staticmethod
@@ -143,7 +287,7 @@ class WatsonOnlineStore:
         if env_workspace_id:
             # Optionally, we have an env var to give us a WORKSPACE_ID.
             # If one was set in the env, require that it can be found.
-            LOG.debug("Using WORKSPACE_ID=%s" % env_workspace_id)
+            LOG.debug("Using WORKSPACE_ID=%s", env_workspace_id)
             for workspace in workspaces:
                 if workspace['workspace_id'] == env_workspace_id:
                     ret = env_workspace_id
@@ -158,8 +302,8 @@ class WatsonOnlineStore:
             for workspace in workspaces:
                 if workspace['name'] == name:
                     ret = workspace['workspace_id']
-                    LOG.debug("Found WORKSPACE_ID=%(id)s using lookup by "
-                              "name=%(name)s" % {'id': ret, 'name': name})
+                    LOG.debug("Found WORKSPACE_ID=%s using lookup by "
+                              "name=%s", ret, name)
                     break
             else:
                 # Not found, so create it.
@@ -175,8 +319,7 @@ class WatsonOnlineStore:
                     counterexamples=workspace['counterexamples'],
                     metadata=workspace['metadata'])
                 ret = created['workspace_id']
-                LOG.debug("Created WORKSPACE_ID=%(id)s with "
-                          "name=%(name)s" % {'id': ret, 'name': name})
+                LOG.debug("Created WORKSPACE_ID=%s with name=%s", ret, name)
         return ret
 
     @staticmethod
@@ -208,22 +351,10 @@ class WatsonOnlineStore:
         :returns: text, channel, user
         :rtype: str, str, str
         """
-        if output_dict and len(output_dict) > 0:
-            for output in output_dict:
-                if output and 'text' in output and 'user' in output and (
-                        'user_profile' not in output):
-                    if self.at_bot in output['text']:
-                        return (
-                            ''.join(output['text'].split(self.at_bot
-                                                         )).strip().lower(),
-                            output['channel'],
-                            output['user'])
-                    elif (output['channel'].startswith('D') and
-                          output['user'] != self.bot_id):
-                        # Direct message!
-                        return (output['text'].strip().lower(),
-                                output['channel'],
-                                output['user'])
+        for output in output_dict or []:
+            parsed = parse_slack_event(output, self.bot_id)
+            if parsed[2]:
+                return parsed
         return None, None, None
 
     def post_to_slack(self, response, channel):
@@ -232,6 +363,9 @@ class WatsonOnlineStore:
         :param str response: text from Watson to post to Slack
         :param str channel: Slack channel
         """
+        if self.slack_outbox:
+            self.slack_outbox.send(channel, response)
+            return
         self.slack_client.api_call("chat.postMessage",
                                    channel=channel,
                                    text=response,
@@ -301,7 +435,7 @@ class WatsonOnlineStore:
             return
 
         # Not found returns json with error.
-        LOG.debug("user_from_slack:\n{}\n".format(user_json))
+        LOG.debug("user_from_slack:\n%s\n", Payload(user_json))
 
         if user_json and 'user' in user_json:
             cust = user_json['user'].get('profile', {}).get('email')
@@ -309,7 +443,7 @@ class WatsonOnlineStore:
                 user_data = self.cloudant_online_store.find_customer(cust)
                 if user_data:
                     # We found this Slack user in our Cloudant DB
-                    LOG.debug("user_from_DB\n{}\n".format(user_data))
+                    LOG.debug("user_from_DB\n%s\n", Payload(user_data))
                     self.customer_from_db(user_data)
                 else:
                     # Didn't find Slack user in DB, so add them
@@ -331,32 +465,105 @@ class WatsonOnlineStore:
         ret_string = {'discovery_result': FAKE_DISCOVERY[index]}
         return ret_string
 
-    def handle_DiscoveryQuery(self):
+    @staticmethod
+    def parse_discovery_sources(text):
+        """Parse sources like "<collection id>:ibm_store,<id>:amazon".
+
+        :param str text: comma separated collection_id:data_source pairs
+        :returns: (collection_id, data_source) pairs
+        :rtype: list
+        """
+        sources = []
+        for part in (text or '').split(','):
+            if part.strip():
+                collection_id, _, data_source = part.strip().partition(':')
+                sources.append((collection_id, data_source))
+        return sources
+
+    def get_discovery_sources(self):
+        """The (collection_id, data_source) pairs to search.
+
+        :rtype: list
+        """
+        if self.discovery_sources:
+            return self.discovery_sources
+        return [(self.discovery_collection_id, self.discovery_data_source)]
+
+    def handle_DiscoveryQuery(self, category_response=None):
         """Take query string from Watson Context and send to Discovery.
 
         Discovery reponse will be merged into context in order to allow it to
-        be returned to Watson. In the case where there is no discovery client,
-        a fake response will be returned, for testing purposes.
+        be returned to Watson. Queries naming a known category are answered
+        from the category index instead. In the case where there is no
+        discovery client, a fake response will be returned, for testing
+        purposes.
 
+        :param dict category_response: get_category_response() for the
+                                       query, when already looked up
         :returns: False indicating no need for UI input, just return to Watson
         :rtype: Bool
         """
         query_string = self.context['discovery_string']
-        if self.discovery_client:
+        response = (category_response or
+                    self.get_category_response(query_string))
+        if response is not None:
+            LOG.debug("Answered %r from the category index.", query_string)
+        elif self.discovery_client:
             try:
                 response = self.get_discovery_response(query_string)
-            except Exception as e:
-                response = {'discovery_result': repr(e)}
+            except Exception:
+                LOG.exception("Discovery query failed:")
+                response = self.get_cached_discovery_response(query_string)
         else:
             response = self.get_fake_discovery_response(query_string)
 
         self.context = self.context_merge(self.context, response)
-        LOG.debug("watson_discovery:\n{}\ncontext:\n{}".format(
-                   response, self.context))
+        LOG.debug("watson_discovery:\n%s\ncontext:\n%s",
+                  Payload(response), Payload(self.context))
 
         # no need for user input, return to Watson Dialogue
         return False
 
+    def get_category_response(self, input_text):
+        """Answer a browse query like "show me hats" from the category index.
+
+        :param str input_text: query from Watson Context
+        :returns: response in format for Watson Conversation, or None when
+                  the query is not a known category
+        :rtype: dict
+        """
+        if self.category_index is None:
+            return None
+        products = self.category_index.lookup(
+            input_text,
+            [data_source for _, data_source in self.get_discovery_sources()])
+        if not products:
+            return None
+        self.response_tuple = [dict(product, cart_number=str(number))
+                               for number, product in enumerate(products, 1)]
+        self.results_shown = min(len(products), DISCOVERY_KEEP_COUNT)
+        return {'discovery_result':
+                self.format_results_page(self.response_tuple, 0)}
+
+    def get_cached_discovery_response(self, input_text):
+        """Fallback for when Discovery fails or its breaker is open.
+
+        :param str input_text: query that was sent to Discovery
+        :returns: last good response for the query, or an apology
+        :rtype: dict
+        """
+        with self.discovery_cache_lock:
+            cached = self.discovery_cache.get(input_text)
+        if cached is None:
+            self.response_tuple = []
+            self.results_shown = 0
+            return {'discovery_result': DISCOVERY_UNAVAILABLE}
+        LOG.warning("Using cached Discovery results for %r" % input_text)
+        response_tuple, response = cached
+        self.response_tuple = list(response_tuple)
+        self.results_shown = min(len(response_tuple), DISCOVERY_KEEP_COUNT)
+        return response
+
     def get_watson_response(self, message):
         """Sends text and context to Watson and gets reply.
 
@@ -366,14 +573,17 @@ class WatsonOnlineStore:
         :returns: json dict from Watson
         :rtype: dict
         """
-        response = self.conversation_client.message(
+        response = resilience.guarded_call(
+            resilience.get_breaker('conversation'),
+            self.conversation_client.message,
             workspace_id=self.workspace_id,
             message_input={'text': message},
             context=self.context)
         return response
 
     @staticmethod
-    def format_discovery_response(response, data_source):
+    def format_discovery_response(response, data_source,
+                                  keep_count=DISCOVERY_KEEP_COUNT):
         """Format data for Slack based on discovery data source.
 
         This method handles the different data source data and formats
@@ -394,6 +604,7 @@ class WatsonOnlineStore:
 
         :param dict response: input from Discovery
         :param string data_source: name of the discovery data source
+        :param int keep_count: maximum number of results to format
         :returns: cart_numer, name, url, image for each item returned
         :rtype: dict
         """
@@ -528,7 +739,7 @@ class WatsonOnlineStore:
         results = response['results']
 
         cart_number = 1
-        for i in range(min(len(results), DISCOVERY_KEEP_COUNT)):
+        for i in range(min(len(results), keep_count)):
             result = results[i]
 
             product_data = {
@@ -549,38 +760,174 @@ class WatsonOnlineStore:
         to be easily added to shopping cart.
         Response is then further formatted to be passed to UI.
 
+        Concurrent callers with the same normalized query share a single
+        Discovery request and its formatted result.
+
         :param str input_text: query to be used with Watson Discovery Service
         :returns: Discovery response in format for Watson Conversation
         :rtype: dict
         """
+        key = (' '.join(input_text.lower().split()),
+               self.discovery_environment_id,
+               tuple(self.get_discovery_sources()),
+               self.discovery_score_filter)
+        response, result = self.discovery_flight.do(
+            key, self.query_discovery, input_text)
+        self.response_tuple = list(response)
+        self.results_shown = min(len(response), DISCOVERY_KEEP_COUNT)
+
+        with self.discovery_cache_lock:
+            self.discovery_cache[input_text] = (response, result)
+            if len(self.discovery_cache) > DISCOVERY_CACHE_SIZE:
+                self.discovery_cache.popitem(last=False)
+        return result
+
+    def query_discovery(self, input_text):
+        """Query Discovery, then filter, format and rank the results.
+
+        All sources are queried in parallel. Discovery scores are only
+        comparable within a collection, so each source's scores are
+        normalized by its best score before the results are merged.
+        Sources that fail are left out, unless all of them fail.
+
+        All the ranked results are returned, numbered for the cart. The
+        response for Watson Conversation only shows the first page.
 
-        discovery_response = self.discovery_client.query(
-            environment_id=self.discovery_environment_id,
-            collection_id=self.discovery_collection_id,
-            query_options={'query': input_text, 'count': DISCOVERY_QUERY_COUNT}
-        )
-
-        # Watson discovery assigns a confidence level to each result.
-        # Based on data mix, we can assign a minimum tolerance value in an
-        # attempt to filter out the "weakest" results.
-        if self.discovery_score_filter and 'results' in discovery_response:
-            fr = [x for x in discovery_response['results'] if 'score' in x and
-                  x['score'] > self.discovery_score_filter]
-
-            discovery_response['matching_results'] = len(fr)
-            discovery_response['results'] = fr
+        :param str input_text: query to be used with Watson Discovery Service
+        :returns: formatted items and the response for Watson Conversation
+        :rtype: list, dict
+        """
+        sources = self.get_discovery_sources()
+        outcomes = resilience.call_parallel(
+            [(self.query_discovery_source, (input_text, collection_id))
+             for collection_id, _ in sources])
+        if not any(ok for ok, _ in outcomes):
+            raise outcomes[0][1]
+
+        ranked = []
+        for index, (source, outcome) in enumerate(zip(sources, outcomes)):
+            ok, results = outcome
+            if not ok:
+                LOG.error("Discovery query of %s failed: %s" %
+                          (source[0], results))
+                continue
+            products = self.format_discovery_response(
+                {'results': results}, source[1], keep_count=len(results))
+            best = max([r.get('score', 0) for r in results] or [0])
+            for rank, (result, product) in enumerate(zip(results,
+                                                         products)):
+                score = result.get('score', 0) / best if best else 0
+                ranked.append((-score, rank, index, product))
+        ranked.sort(key=lambda entry: entry[:3])
+
+        response = [dict(entry[3], cart_number=str(number))
+                    for number, entry in enumerate(ranked, 1)]
+        return response, {
+            'discovery_result': self.format_results_page(response, 0)}
 
-        response = self.format_discovery_response(discovery_response,
-                                                  self.discovery_data_source)
-        self.response_tuple = response
+    @staticmethod
+    def format_results_page(response_tuple, offset):
+        """Format a page of ranked results for the UI.
 
+        :param list response_tuple: all ranked results
+        :param int offset: index of the first result on the page
+        :returns: text listing the results with their cart numbers
+        :rtype: str
+        """
         formatted_response = ""
-        for item in response:
+        for item in response_tuple[offset:offset + DISCOVERY_KEEP_COUNT]:
             formatted_response += "\n" + item['cart_number'] + ") " + \
                                   item['name'] + \
                                   "\n" + item['image']  # "\n" + item['url']
+        if len(response_tuple) > offset + DISCOVERY_KEEP_COUNT:
+            formatted_response += MORE_RESULTS_HINT
+        return formatted_response
+
+    @staticmethod
+    def is_more_results_request(message):
+        """Whether the user is asking for the next page of results.
+
+        :param str message: text from UI
+        :rtype: bool
+        """
+        text = ' '.join(message.lower().strip(' .!?').split())
+        return text in MORE_RESULTS_REQUESTS
+
+    def handle_more_results(self, sender):
+        """Show the next page of the last search results.
+
+        The page comes from the results kept in the session, and cart
+        numbers stay the same as on the first page.
+
+        :param SlackSender sender: used for send_message
+        :returns: True, the user picks an item or asks for more
+        :rtype: Bool
+        """
+        if self.results_shown >= len(self.response_tuple):
+            sender.send_message(NO_MORE_RESULTS)
+            return True
+        page = self.format_results_page(self.response_tuple,
+                                        self.results_shown)
+        self.results_shown = min(len(self.response_tuple),
+                                 self.results_shown + DISCOVERY_KEEP_COUNT)
+        sender.send_message("Here's more of what I found:" + page + "\n")
+        return True
+
+    def handle_similar_products(self, cart_item, sender):
+        """Show products similar to a listed item.
+
+        The similar products replace the listed results, so they can be
+        added to the cart by number.
+
+        :param int cart_item: number of the listed item
+        :param SlackSender sender: used for send_message
+        :returns: True, the user picks an item
+        :rtype: Bool
+        """
+        if not 0 < cart_item <= len(self.response_tuple or []):
+            sender.send_message("There is no item %d.\n" % cart_item)
+            return True
+        entry = self.response_tuple[cart_item - 1]
+        similar = self.similar_products.similar(
+            cart.product_id(entry['url'], entry['name']))
+        if not similar:
+            sender.send_message("I don't know anything similar to %s.\n" %
+                                entry['name'])
+            return True
+        self.response_tuple = [dict(product, cart_number=str(number))
+                               for number, product in enumerate(similar, 1)]
+        self.results_shown = len(self.response_tuple)
+        sender.send_message(
+            "Products similar to %s:" % entry['name'] +
+            self.format_results_page(self.response_tuple, 0) + "\n")
+        return True
+
+    def query_discovery_source(self, input_text, collection_id):
+        """Query one Discovery collection and filter out weak results.
+
+        :param str input_text: query to be used with Watson Discovery Service
+        :param str collection_id: collection to search
+        :returns: Discovery results
+        :rtype: list
+        """
+        discovery_response = resilience.guarded_call(
+            resilience.get_breaker('discovery'),
+            self.discovery_client.query,
+            environment_id=self.discovery_environment_id,
+            collection_id=collection_id,
+            query_options={'query': input_text,
+                           'count': DISCOVERY_QUERY_COUNT},
+            guard_retries=DISCOVERY_RETRIES
+        )
+        results = discovery_response.get('results') or []
 
-        return {'discovery_result': formatted_response}
+        # Watson discovery assigns a confidence level to each result.
+        # Based on data mix, we can assign a minimum tolerance value in an
+        # attempt to filter out the "weakest" results.
+        if self.discovery_score_filter:
+            results = [x for x in results if 'score' in x and
+                       x['score'] > self.discovery_score_filter]
+        return results
 
     def handle_list_shopping_cart(self):
         """Get shopping_cart from DB and return formatted version to Watson
@@ -593,7 +940,14 @@ class WatsonOnlineStore:
         shopping_list = self.cloudant_online_store.list_shopping_cart(cust)
         for index, item in enumerate(shopping_list):
             formatted_out += str(index+1) + ") " + \
-                             str(item.encode('utf-8')) + "\n"
+                             cart.format_item(item) + "\n"
+
+        if self.recommendations:
+            formatted_out += "\nYou might also like:\n"
+            for product in self.recommendations:
+                formatted_out += product['name'] + ": " + \
+                                 product['url'] + "\n"
+            self.recommendations = []
 
         self.context['shopping_cart'] = formatted_out
 
@@ -621,8 +975,8 @@ class WatsonOnlineStore:
 
         for index, item in enumerate(shopping_list):
             if index+1 == item_num:
-                self.cloudant_online_store.delete_item_shopping_cart(email,
-                                                                     item)
+                self.cloudant_online_store.delete_item_shopping_cart(
+                    email, item['id'])
         self.clear_shopping_cart()
 
         # no need for user input, return to Watson Dialogue
@@ -642,13 +996,25 @@ class WatsonOnlineStore:
 
         for index, entry in enumerate(self.response_tuple):
             if index+1 == cart_item:
-                item = entry['name'] + ': ' + entry['url'] + '\n'
+                item = cart.new_cart_item(entry['name'], entry['url'])
                 self.cloudant_online_store.add_to_shopping_cart(email, item)
+                if self.similar_products is not None:
+                    self.recommendations = self.similar_products.similar(
+                        item['id'], RECOMMENDATION_COUNT)
         self.clear_shopping_cart()
 
         # no need for user input, return to Watson Dialogue
         return False
 
+    def take_branch(self, handler, *args):
+        """Run a handle_* branch, noting it for the turn's profile.
+
+        :param handler: bound handle_* method
+        :returns: what the handler returns
+        """
+        self.turn_branches.append(handler.__name__)
+        return handler(*args)
+
     def handle_message(self, message, sender):
         """Handler for messages coming from Watson Conversation using context.
 
@@ -662,8 +1028,24 @@ class WatsonOnlineStore:
         :rtype: Bool
         """
 
-        watson_response = self.get_watson_response(message)
-        LOG.debug("watson_response:\n{}\n".format(watson_response))
+        if (self.paging and self.response_tuple and
+                self.is_more_results_request(message)):
+            # Paging is local. Conversation still waits for an item.
+            return self.take_branch(self.handle_more_results, sender)
+        similar_request = SIMILAR_REQUEST_RE.match(
+            ' '.join(message.lower().split()))
+        if similar_request and self.similar_products is not None:
+            return self.take_branch(self.handle_similar_products,
+                                    int(similar_request.group(1)), sender)
+
+        try:
+            watson_response = self.get_watson_response(message)
+        except Exception:
+            LOG.exception("Conversation call failed:")
+            # Fail fast and wait for the user instead of looping.
+            sender.send_message(CONVERSATION_UNAVAILABLE)
+            return True
+        LOG.debug("watson_response:\n%s\n", Payload(watson_response))
         if 'context' in watson_response:
             self.context = watson_response['context']
 
@@ -674,24 +1056,32 @@ class WatsonOnlineStore:
         sender.send_message(response)
 
         if ('discovery_string' in self.context.keys() and
-           self.context['discovery_string'] and self.discovery_client):
-            return self.handle_DiscoveryQuery()
+                self.context['discovery_string']):
+            if self.discovery_client:
+                return self.take_branch(self.handle_DiscoveryQuery)
+            # Without Discovery, only queries naming a known category are
+            # answered. Conversation's reply stands for the others.
+            response = self.get_category_response(
+                self.context['discovery_string'])
+            if response is not None:
+                return self.take_branch(self.handle_DiscoveryQuery,
+                                        response)
 
         if ('shopping_cart' in self.context.keys() and
                 self.context['shopping_cart'] == 'list'):
-            return self.handle_list_shopping_cart()
+            return self.take_branch(self.handle_list_shopping_cart)
 
         if ('shopping_cart' in self.context.keys() and
                 self.context['shopping_cart'] == 'add' and
             'cart_item' in self.context.keys() and
                 self.context['cart_item'] != ''):
-            return self.handle_add_to_cart()
+            return self.take_branch(self.handle_add_to_cart)
 
         if ('shopping_cart' in self.context.keys() and
                 self.context['shopping_cart'] == 'delete' and
             'cart_item' in self.context.keys() and
                 self.context['cart_item'] != ''):
-            return self.handle_delete_from_cart()
+            return self.take_branch(self.handle_delete_from_cart)
 
         if ('get_input' in self.context.keys() and
                 self.context['get_input'] == 'no'):
@@ -699,31 +1089,229 @@ class WatsonOnlineStore:
 
         return True
 
+    def load_session(self, user):
+        """Load the session of a user into this instance.
+
+        :param str user: Slack user ID
+        :returns: the loaded session
+        :rtype: Session
+        """
+        try:
+            session = self.session_store.load(user)
+        except Exception:
+            # Carry on with a fresh session. It can't overwrite the stored
+            # one, because its version is out of date.
+            LOG.exception("Session load failed:")
+            session = Session(user)
+        self.context = session.context
+        self.response_tuple = session.response_tuple
+        self.results_shown = session.results_shown
+        self.paging = session.paging
+        self.recommendations = []
+        self.customer = None
+        if session.customer:
+            self.customer = OnlineStoreCustomer(shopping_cart=[],
+                                                **session.customer)
+        return session
+
+    def save_session(self, session, loaded_data):
+        """Save the state of this instance to the session, if changed.
+
+        :param Session session: session returned by load_session
+        :param str loaded_data: session.dumps() from when it was loaded
+        """
+        session.context = self.context
+        session.response_tuple = self.response_tuple
+        session.results_shown = self.results_shown
+        session.paging = any(branch in RESULTS_BRANCHES
+                             for branch in self.turn_branches)
+        session.customer = None
+        if self.customer:
+            session.customer = {'email': self.customer.email,
+                                'first_name': self.customer.first_name,
+                                'last_name': self.customer.last_name}
+        if session.dumps() == loaded_data:
+            return
+        try:
+            self.session_store.save(session)
+        except SessionConflict:
+            LOG.warning("Session for %s was updated concurrently. "
+                        "Keeping the other update." % session.session_id)
+        except Exception:
+            LOG.exception("Session save failed:")
+
+    def enable_fair_scheduling(self, **kwargs):
+        """Queue turns per user and take them fairly between users.
+
+        See fair_scheduler.FairScheduler. handle_slack_output() then only
+        queues turns, which a scheduler thread takes.
+
+        :param kwargs: settings of FairScheduler, like rate and burst
+        :returns: the started scheduler
+        :rtype: FairScheduler
+        """
+        self.scheduler = FairScheduler(
+            self.take_turn,
+            lambda channel, text: self.post_to_slack(text, channel),
+            **kwargs)
+        self.scheduler.start()
+        return self.scheduler
+
+    def finish_turns(self, timeout=None):
+        """Wait for the turns queued by fair scheduling to be taken.
+
+        :param float timeout: seconds to wait, None for ever
+        :returns: whether all turns were taken
+        :rtype: bool
+        """
+        if self.scheduler is None:
+            return True
+        return self.scheduler.join(timeout)
+
+    def enable_inbound_queue(self, inbound_queue):
+        """Keep messages in a durable queue until their turn is over.
+
+        Messages left in the queue by the last run are taken first. Call
+        after enable_fair_scheduling(), if at all, so they are scheduled.
+
+        :param InboundQueue inbound_queue: see inbound_queue
+        :returns: number of messages replayed
+        :rtype: int
+        """
+        self.inbound_queue = inbound_queue
+        replayed = inbound_queue.open()
+        self.take_turns(replayed)
+        return len(replayed)
+
+    def handle_slack_output(self, slack_output):
+        """Process a batch of Slack events.
+
+        Shared by the RTM run loop and the Events API receiver, so both
+        modes pick messages and customers the same way. Without fair
+        scheduling or an inbound queue, the batch is taken as one turn.
+        With them, each message is a turn of its user, and the inbound
+        queue drops messages Slack delivered again.
+
+        :param list slack_output: Slack events (RTM read or Events API)
+        """
+        self.handle_accepted_output(self.accept_slack_output(slack_output))
+
+    def accept_slack_output(self, slack_output):
+        """Store the messages of a batch before telling Slack they arrived.
+
+        With an inbound queue, the messages are on disk when this returns,
+        so the Events API receiver only answers 200 for messages that
+        survive a crash. Pass the result to handle_accepted_output().
+
+        :param list slack_output: Slack events (RTM read or Events API)
+        :returns: the events to handle, without redelivered messages
+        :rtype: list
+        :raise Exception: when the messages could not be stored
+        """
+        if self.inbound_queue is None:
+            return slack_output
+        return self.inbound_queue.append(
+            [event for event in slack_output or []
+             if self.parse_slack_output([event])[2]])
+
+    def handle_accepted_output(self, slack_output):
+        """Take the turns of events returned by accept_slack_output().
+
+        :param list slack_output: Slack events
+        """
+        if self.inbound_queue is None and self.scheduler is None:
+            self.take_turn(slack_output)
+        else:
+            self.take_turns(slack_output)
+
+    def take_turns(self, slack_output):
+        """Take a turn on each message for the bot, or schedule it.
+
+        :param list slack_output: Slack events
+        """
+        for event in slack_output or []:
+            message, channel, user = self.parse_slack_output([event])
+            if not user:
+                # Not for the bot, no turn will acknowledge it.
+                if self.inbound_queue is not None:
+                    self.inbound_queue.ack([event])
+                continue
+            if self.scheduler is None:
+                self.take_turn([event])
+            elif not self.scheduler.submit(user, channel, [event]):
+                # The user's queue is full. They were told to send it
+                # again, so it is not answered after a restart either.
+                if self.inbound_queue is not None:
+                    self.inbound_queue.ack([event])
+
+    def take_turn(self, slack_output):
+        """Take one bot turn on a batch of Slack events.
+
+        The user's session is read once before the turn and written at
+        most once after it. With an inbound queue, the events are
+        acknowledged once the turn is over, even if it failed, so only
+        turns cut short by a crash are taken again.
+
+        :param list slack_output: Slack events (RTM read or Events API)
+        :returns: cost of the turn, see fair_scheduler.turn_cost(), or
+                  None when there was no message for the bot
+        :rtype: float
+        """
+        try:
+            return self._take_turn(slack_output)
+        finally:
+            if self.inbound_queue is not None:
+                self.inbound_queue.ack(slack_output)
+
+    def _take_turn(self, slack_output):
+        message, channel, user = self.parse_slack_output(slack_output)
+        if not user:
+            return None
+
+        session = self.load_session(user)
+        loaded_data = session.dumps()
+
+        self.turn_branches = []
+        # Every external call of the turn shares one time budget.
+        with self.profiler.turn(self.turn_branches), \
+                resilience.deadline_scope(
+                    resilience.Deadline(self.turn_deadline)):
+            if not self.customer:
+                self.init_customer(user)
+
+            if message:
+                LOG.debug("message:\n %s\n channel:\n %s\n",
+                          Payload(message), channel)
+            if message and channel:
+                sender = SlackSender(self.slack_client, channel,
+                                     outbox=self.slack_outbox)
+                get_input = self.handle_message(message, sender)
+                while not get_input:
+                    get_input = self.handle_message(message, sender)
+
+        self.save_session(session, loaded_data)
+        return turn_cost(self.turn_branches)
+
+    def init_store(self):
+        """Make sure the DB exists, unless that was already done."""
+        if not self.store_ready:
+            self.cloudant_online_store.init()
+            self.store_ready = True
+
     def run(self):
         """Main run loop of the application
         """
         # make sure DB exists
-        self.cloudant_online_store.init()
+        self.init_store()
 
         if self.slack_client.rtm_connect():
             LOG.info("Watson Online Store bot is connected and running!")
             while True:
                 slack_output = self.slack_client.rtm_read()
                 if slack_output:
-                    LOG.debug("slack output\n:{}\n".format(slack_output))
-
-                message, channel, user = self.parse_slack_output(slack_output)
-                if user and not self.customer:
-                    self.init_customer(user)
+                    LOG.debug("slack output\n:%s\n", Payload(slack_output))
 
-                if message:
-                    LOG.debug("message:\n %s\n channel:\n %s\n" %
-                              (message, channel))
-                if message and channel:
-                    sender = SlackSender(self.slack_client, channel)
-                    get_input = self.handle_message(message, sender)
-                    while not get_input:
-                        get_input = self.handle_message(message, sender)
+                self.handle_slack_output(slack_output)
 
                 time.sleep(self.delay)
         else: